@@ -80,6 +80,7 @@ setup(
     # for example:
     # $ pip install -e .[dev,test]
     extras_require={
+        'async': ['aiohttp'],
     },
 
     # If there are data files included in your packages that need to be
@@ -5,27 +5,27 @@ import re
 import sys
 import json
 import time
+import heapq
+import random
 import shutil
-import tempfile
 import codecs
+import threading
 
-try:
-    from urllib import urlretrieve
-except ImportError:
-    from urllib.request import urlretrieve
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 
 from getpass import getpass
 
-import yaml
 import argh
-import twitter
 
-from mastodon import Mastodon
+from t2m import metrics, statuses
+from t2m.ratelimit import get_rate_limiter
+from t2m.sessions import get_session
+from t2m.storage import get_storage, get_target, migrate as _migrate_storage
 
-try:
-    from HTMLParser import HTMLParser
-except ImportError:
-    from html.parser import HTMLParser
+# Heavy dependencies (python-twitter, Mastodon.py, PyYAML, requests...)
+# are imported by the functions using them, so that commands which do not
+# need them, like "t2m list", start fast. See test_import_time.
 
 
 HERE = os.path.abspath(os.path.dirname(__file__))
@@ -34,46 +34,276 @@ ENDS_WITH_TCO_URL_REGEX = re.compile(
     '.*(?P<stripme> https://t\.co/[^/ ]{10})$')
 
 
-def _get_content_warnings_db():
-    if os.path.exists("cw.json"):
-        return json.load(open("cw.json", "r"))
+_content_warnings_matchers = {}
+
+
+def _get_content_warnings_db(path="cw.json"):
+    if os.path.exists(path):
+        with open(path, "r") as fobj:
+            return json.load(fobj, object_pairs_hook=OrderedDict)
 
     return {}
 
 
-def _get_db(path="db.json"):
-    """Return the database content from `path` (defaults to "db.json").
+class _ContentWarningMatcher(object):
+    """Compiled content warnings rules, as given by a list of (content
+    warning, pattern) couples.
 
-    It is stored on disk in the json format and as the following
-    model:
+    The patterns are tried one by one, in order: combining them in a
+    single alternation is much slower with the hundreds of simple
+    patterns of a typical cw.json (see tests/bench_t2m.py).
+
+    """
+
+    def __init__(self, rules):
+        self.rules = [(content_warning, re.compile(pattern))
+                      for content_warning, pattern in rules]
+
+    def search(self, text):
+        """Return the (content warning, compiled pattern, match) of the
+        first rule matching `text`, or None.
+
+        """
+        for content_warning, regex in self.rules:
+            match = regex.search(text)
+            if match is not None:
+                return content_warning, regex, match
+        return None
 
-    {
-        <twitter handle>: {
-            "mastodon": <mastodon complete handle>,
-            "done": [<list of tweet ids (integers)>]
-        }
-    }
+
+def _get_content_warnings_matcher(path="cw.json"):
+    """Return the `_ContentWarningMatcher` for the rules of `path`.
+
+    It is built once, and only built again when the file changes.
 
     """
-    if os.path.isfile(path):
-        with open(path) as fobj:
-            return json.load(fobj)
-    return {}
+    try:
+        stat = os.stat(path)
+        version = (stat.st_mtime, stat.st_size)
+    except OSError:
+        version = None
+
+    key = os.path.abspath(path)
+    cached = _content_warnings_matchers.get(key)
+    if cached is None or cached[0] != version:
+        rules = [(content_warning, pattern)
+                 for content_warning, patterns
+                 in _get_content_warnings_db(path).items()
+                 for pattern in patterns]
+        cached = _content_warnings_matchers[key] = (
+            version, _ContentWarningMatcher(rules))
+    return cached[1]
+
 
+# number of forwarded tweet ids kept in the "done" sets
+DONE_KEEP = 200
 
-def _save_db(db, path="db.json"):
-    """Save given `db` python structure to a json file at `path` (defaults
-    to "db.json")
+
+def _prune_done(done, keep=DONE_KEEP):
+    """Return the `keep` most recent ids of the `done` set.
+
+    If at least `keep` already forwarded tweets are more recent than a
+    given tweet, it is out of the window of the last `keep` tweets
+    the timeline fetch can return, and there is no need to remember it
+    anymore.
 
     """
-    with open(path, "w") as fobj:
-        json.dump(db, fobj, indent=4)
+    if len(done) <= keep:
+        return done
+    return set(sorted(done)[-keep:])
+
+
+# number of times a request is retried when it hits the rate limit
+RATE_LIMIT_RETRIES = 3
+
+# toots which could not be sent are sent again after OUTBOX_BASE_DELAY
+# seconds, this delay being doubled after each failed attempt, up to
+# OUTBOX_MAX_DELAY seconds, and are given up after OUTBOX_MAX_ATTEMPTS
+OUTBOX_BASE_DELAY = 60
+OUTBOX_MAX_DELAY = 6 * 60 * 60
+OUTBOX_MAX_ATTEMPTS = 10
+
+# Mastodon removes the medias not attached to a status after a day, the
+# ids of the medias uploaded for a toot are forgotten sooner than that
+OUTBOX_MEDIA_IDS_LIFETIME = 12 * 60 * 60
+
+# videos are forwarded in the best quality whose size (estimated from
+# its bitrate) is below the default limit of Mastodon
+VIDEO_SIZE_LIMIT = 40 * 1024 * 1024
+
+# how long (in seconds) a toot waits for its videos to be processed by
+# the instance before being put in the outbox, and the polling interval
+MEDIA_PROCESSING_WAIT = 10
+MEDIA_POLL_INTERVAL = 1
+
+# Twitter only gives the last 3200 tweets of an account, 200 at a time
+BACKFILL_MAX_TWEETS = 3200
+TIMELINE_PAGE_SIZE = 200
+
+# time (in seconds) between two toots of a backfill
+BACKFILL_WAIT_SECONDS = 5
+
+# bounds (in seconds) of the polling interval of an account in daemon mode
+MIN_POLL_INTERVAL = 60
+MAX_POLL_INTERVAL = 4 * 60 * 60
+
+# clients shared by the whole process, the Twitter one being stored as
+# "twitter" and the Mastodon ones by handle
+_clients = {}
+_clients_lock = threading.RLock()
+
+# serializes the database accesses of concurrently forwarded accounts
+_db_lock = threading.RLock()
+
+# number of rendered retweets and quotes kept by the process, so that
+# the statuses retweeted by several accounts are rendered once
+RENDERED_TOOTS_CACHE_SIZE = 1024
+
+_retweet_template = None
+_html_parser = None
+
+
+def _get_db(path=None):
+    """Return the database content from `path`.
+
+    When `path` is not given, "db.sqlite" is used if it exists, and
+    "db.json" otherwise. See the `t2m.storage` module for the model of
+    the returned structure.
+
+    """
+    with _db_lock:
+        return get_storage(path).load()
+
+
+def _save_db(db, path=None):
+    "Save given `db` python structure to the database at `path`."
+    with _db_lock, metrics.timed("save"):
+        get_storage(path).save(db)
+
+
+def _mark_done(db, twitter_handle, tweet_id, path=None, mirror=None):
+    """Record in `db` and in the database at `path` that `tweet_id` of
+    `twitter_handle` was forwarded, without saving the whole database.
+
+    If `mirror` is given, the tweet is recorded as forwarded to this
+    mirror of the account (see `t2m.storage.get_target`).
+
+    """
+    with _db_lock, metrics.timed("mark_done", account=twitter_handle):
+        get_storage(path).mark_done(db, twitter_handle, tweet_id, mirror)
+
+
+def _update_outbox(db, twitter_handle, tweet_id, entry, path=None,
+                   mirror=None):
+    """Set, in `db` and in the database at `path`, the outbox `entry` of
+    `tweet_id` of `twitter_handle`, or remove it if `entry` is None.
+
+    See the `t2m.storage` module for the model of outbox entries, and
+    `_mark_done` for the `mirror` parameter.
+
+    """
+    with _db_lock:
+        get_storage(path).update_outbox(db, twitter_handle, tweet_id, entry,
+                                        mirror)
+
+
+def _update_backfill(db, twitter_handle, windows, path=None):
+    """Set, in `db` and in the database at `path`, the backfill `windows`
+    of `twitter_handle` (see `backfill`), without saving the whole
+    database.
+
+    """
+    with _db_lock:
+        get_storage(path).update_backfill(db, twitter_handle, windows)
+
+
+def _forgotten_before(account):
+    """Return the tweet id below which the tweets forwarded from the
+    `account` database entry may have been forgotten, or None.
+
+    Once a "done" set holds `DONE_KEEP` ids, it may have been pruned
+    (see `_prune_done`): the tweets older than its oldest id may have
+    been forwarded.
+
+    """
+    bounds = [min(target["done"]) for target
+              in [account] + [account["mirrors"][mirror]
+                              for mirror in account.get("mirrors", {})]
+              if len(target.get("done", ())) >= DONE_KEEP]
+    return max(bounds) if bounds else None
+
+
+def _outbox_delay(attempts):
+    """Return the number of seconds to wait before sending again a toot
+    after `attempts` failed attempts.
+
+    The delay grows exponentially, and is randomized between half and
+    all of it, so that the toots which failed together (for instance
+    while an instance was down) are not all sent again at once.
+
+    """
+    delay = min(OUTBOX_BASE_DELAY * 2 ** (attempts - 1), OUTBOX_MAX_DELAY)
+    return random.uniform(delay / 2.0, delay)
+
+
+def _defer_toot(db, twitter_handle, toot, media_ids=None, attempts=1,
+                created=None, mirror=None):
+    """Put `toot` of `twitter_handle` in the outbox, to be sent again
+    later without fetching it again from Twitter, after `attempts`
+    failed attempts to send it.
+
+    The `media_ids` of the medias already uploaded for the toot (see
+    `_send_toot`) are kept for the next attempt, for a while. The tweet
+    is marked as forwarded in `db`, the outbox being in charge of it
+    from now on. Once `OUTBOX_MAX_ATTEMPTS` attempts failed, the toot
+    is given up.
+
+    With `mirror`, the outbox of this mirror of the account is used
+    (see `t2m.storage.get_target`).
+
+    """
+    now = time.time()
+    created = now if created is None else created
+    if attempts >= OUTBOX_MAX_ATTEMPTS:
+        print("ERROR: giving up forwarding the tweet [%s] '%s' after %s"
+              " attempts" % (toot["id"], toot["text"], attempts),
+              file=sys.stderr)
+        _update_outbox(db, twitter_handle, toot["id"], None, mirror=mirror)
+        return
+
+    if now - created > OUTBOX_MEDIA_IDS_LIFETIME:
+        media_ids = {}
+
+    _update_outbox(db, twitter_handle, toot["id"], {
+        "toot": toot,
+        "media_ids": media_ids or {},
+        "attempts": attempts,
+        "next_retry": now + _outbox_delay(attempts),
+        "created": created,
+    }, mirror=mirror)
+    with _db_lock:
+        done = get_target(db, twitter_handle, mirror).get("done", ())
+        if toot["id"] not in done:
+            _mark_done(db, twitter_handle, toot["id"], mirror=mirror)
+
+
+def _due_outbox(db, twitter_handle, now=None, mirror=None):
+    """Return the outbox entries of `twitter_handle` (or of its `mirror`)
+    to be sent again by now, oldest tweet first.
+
+    """
+    now = time.time() if now is None else now
+    with _db_lock:
+        outbox = get_target(db, twitter_handle, mirror).get("outbox", {})
+        return [outbox[tweet_id] for tweet_id in sorted(outbox)
+                if outbox[tweet_id]["next_retry"] <= now]
 
 
 def _ensure_client_exists_for_instance(instance):
     "Create the client creds file if it does not exist, and return its path."
     client_id = "t2m_%s_clientcred.txt" % instance
     if not os.path.exists(client_id):
+        from mastodon import Mastodon
         Mastodon.create_app('t2m', to_file=client_id,
                             api_base_url='https://%s' % instance,
                             )
@@ -82,27 +312,18 @@ def _ensure_client_exists_for_instance(instance):
 
 def _find_potential_content_warning(toot_text):
     "Based on cw.json, find a potential automatic content warning based on the toot content."
-    warning = None
-
-    for content_warning, patterns in _get_content_warnings_db().items():
-        for pattern in patterns:
-            match = re.search(pattern=pattern, string=toot_text)
-            if not match:
-                continue
+    found = _get_content_warnings_matcher().search(toot_text)
+    if found is None:
+        return None, toot_text
 
-            # If there is a group in the re then use it for the cw text
-            if match.groups():
-                warning = match.group(1)
-                toot_text = re.sub(pattern, "", toot_text)
-
-            else:
-                # If no group then use the key from the json for the cw text
-                warning = content_warning
+    content_warning, regex, match = found
 
-            # once we get our first content warning, stop
-            return warning, toot_text
+    # If there is a group in the re then use it for the cw text
+    if match.groups():
+        return match.group(1), regex.sub("", toot_text)
 
-    return warning, toot_text
+    # If no group then use the key from the json for the cw text
+    return content_warning, toot_text
 
 
 def _check_complete_mastodon_handle(mastodon_handle, twitter_handle):
@@ -124,17 +345,159 @@ def _check_complete_mastodon_handle(mastodon_handle, twitter_handle):
         sys.exit(1)
 
 
+def _fetch_timeline(twitter_client, twitter_handle, since_id=None,
+                    max_tweets=200):
+    """Return the last statuses of `twitter_handle`, most recent first.
+
+    When `since_id` is given, only the statuses more recent than this
+    tweet id are requested, which usually is a handful of them instead
+    of the last `max_tweets` (defaults to 200). If Twitter refuses the
+    `since_id` request, the complete fetch is used as a fallback.
+
+    """
+    import twitter
+
+    if since_id is not None:
+        try:
+            return statuses.user_timeline(
+                twitter_client, screen_name=twitter_handle,
+                count=max_tweets, since_id=since_id)
+        except twitter.TwitterError as e:
+            print("WARNING: could not fetch tweets of %s since %s because"
+                  " '%s', fetching the last %s tweets instead"
+                  % (twitter_handle, since_id, e, max_tweets),
+                  file=sys.stderr)
+
+    return statuses.user_timeline(twitter_client, screen_name=twitter_handle,
+                                  count=max_tweets)
+
+
+def _fetch_history(twitter_client, twitter_handle, since_id=None, max_id=None,
+                   max_tweets=BACKFILL_MAX_TWEETS):
+    """Return the statuses of `twitter_handle` more recent than the
+    `since_id` tweet and older than the `max_id` one (when given), most
+    recent first, up to `max_tweets` of them.
+
+    The timeline is paged backwards, `TIMELINE_PAGE_SIZE` statuses at a
+    time, until `since_id` or the end of the history Twitter gives.
+
+    """
+    history = []
+    while len(history) < max_tweets:
+        kwargs = {"screen_name": twitter_handle, "count": TIMELINE_PAGE_SIZE}
+        if since_id is not None:
+            kwargs["since_id"] = since_id
+        if max_id is not None:
+            # max_id is included by Twitter
+            kwargs["max_id"] = max_id - 1
+        with metrics.timed("fetch", account=twitter_handle):
+            page = statuses.user_timeline(twitter_client, **kwargs)
+        if not page:
+            break
+        history.extend(page)
+        max_id = min(status.id for status in page)
+    return history[:max_tweets]
+
+
+def _record_gap(account, twitter_handle, timeline, since_id,
+                max_tweets=TIMELINE_PAGE_SIZE):
+    """Record in the `account` database entry of `twitter_handle` the
+    tweets which may have been missed by the fetch of its `timeline`
+    since the `since_id` tweet.
+
+    When the timeline holds `max_tweets` statuses, the tweets between
+    `since_id` and the oldest of them may not have fit in it: this
+    range is recorded, to be forwarded by the `backfill` command.
+
+    """
+    if since_id is None or len(timeline) < max_tweets:
+        return
+    oldest = min(status.id for status in timeline)
+    if oldest <= since_id:
+        return
+    with _db_lock:
+        account.setdefault("backfill", []).append([since_id, oldest])
+    print("WARNING: more than %s tweets of %s since the last run, use"
+          " 't2m backfill %s' to forward the older ones"
+          % (max_tweets, twitter_handle, twitter_handle), file=sys.stderr)
+
+
+def _compute_since_id(timeline, pending_ids=(), since_id=None, newest=None):
+    """Return the new `since_id` watermark once `timeline` was handled.
+
+    All the statuses of `timeline` are considered handled (forwarded,
+    marked as seen or filtered out) except those which ids are in
+    `pending_ids`: the watermark stays below the oldest of them so
+    that they are fetched again on the next run. The previous
+    `since_id` is returned when there is nothing newer.
+
+    When the statuses of `timeline` were picked out of a larger one
+    (see `t2m.lists`), `newest` is the most recent tweet id it covered.
+
+    """
+    ids = [status.id for status in timeline or ()]
+    if newest is not None:
+        ids.append(newest)
+    if pending_ids:
+        new_since_id = min(pending_ids) - 1
+    elif ids:
+        new_since_id = max(ids)
+    else:
+        return since_id
+
+    if since_id is not None:
+        return max(since_id, new_since_id)
+    return new_since_id
+
+
+def _update_since_id(account, timeline, pending_ids=(), newest=None):
+    """Update the `since_id` watermark of the `account` database entry
+    once its `timeline` was handled, except the `pending_ids` tweets
+    (see `_compute_since_id` for `newest`), and prune its "done" sets.
+
+    """
+    with _db_lock:
+        account["since_id"] = _compute_since_id(
+            timeline, pending_ids, since_id=account.get("since_id"),
+            newest=newest)
+        for target in [account] + [account["mirrors"][mirror]
+                                   for mirror in account.get("mirrors", {})]:
+            target["done"] = _prune_done(target.get("done", set()))
+
+
 def _collect_toots(twitter_client, twitter_handle, done=(), retweets=False,
-                   max_tweets=200, strip_trailing_url=False):
-    """Return a list of dicts describing toots to be sent.
+                   max_tweets=200, strip_trailing_url=False, timeline=None):
+    """Return the list of dicts describing toots to be sent.
+
+    See the `_iter_toots` function for the parameters and the model of
+    the dicts.
+
+    """
+    # not list(), shadowed by the list command below
+    return [toot for toot in _iter_toots(
+        twitter_client, twitter_handle, done=done, retweets=retweets,
+        max_tweets=max_tweets, strip_trailing_url=strip_trailing_url,
+        timeline=timeline)]
 
-    Given `twitter_handle` and the `done` list of already sent tweet
-    ids (defaults to the empty list), `twitter_client` is used to
+
+def _iter_toots(twitter_client, twitter_handle, done=(), retweets=False,
+                max_tweets=200, strip_trailing_url=False, timeline=None):
+    """Yield dicts describing toots to be sent, oldest first, each one
+    as soon as it is rendered.
+
+    Given `twitter_handle` and the `done` set of already sent tweet
+    ids (defaults to the empty set), `twitter_client` is used to
     fetch tweets' textual content and medias. The last `max_tweets` are
     fetched (defaults to 200), and retweets are ignored unless the
     `retweets` parameter is set to a truthy value.
 
-    An item of the return list as the following model:
+    If the statuses were already fetched (see `_fetch_timeline`), they
+    can be given as the `timeline` parameter, in which case
+    `twitter_client` is not used.
+
+    The `done` set is checked as tweets are rendered, so it must not be
+    modified for tweets not yet yielded. A yielded item has the
+    following model:
 
     {
         "text": <the textual content of the tweet>,
@@ -143,201 +506,766 @@ def _collect_toots(twitter_client, twitter_handle, done=(), retweets=False,
     }
 
     """
-    toots = []
-
-    if retweets:
-        with codecs.open(os.path.join(HERE, "retweet.tmpl"),
-                         encoding="utf-8") as fobj:
-            retweet_template = fobj.read()
-
-    h = HTMLParser()
+    if timeline is None:
+        timeline = _fetch_timeline(twitter_client, twitter_handle,
+                                   max_tweets=max_tweets)
 
     # "i" is a status http://python-twitter.readthedocs.io/en/latest/_modules/twitter/models.html#Status
-    for i in reversed(twitter_client.GetUserTimeline(
-            screen_name=twitter_handle, count=max_tweets)):
+    for i in reversed(timeline):
 
         quoted_status = getattr(i, "quoted_status", None)
         retweeted_status = i.retweeted_status or quoted_status
 
         if retweeted_status:
-            if retweets:
-                text = retweet_template % {
-                    "text": retweeted_status.full_text,
-                    "user": retweeted_status.user.screen_name,
-                    "id": retweeted_status.id
-                }
-
-                # can only be greater than 500 chars if it's a quoted tweet so checking here
-                # delete the text of the quoted tweet from the toot end replace it with a much shorter string
-                if quoted_status and len(text) > 500:
-                    text = retweet_template % {
-                        "text": "Quoted tweet's link below",
-                        "user": retweeted_status.user.screen_name,
-                        "id": retweeted_status.id
-                    }
-                    text = i.full_text + "\n\n" + text
-
-                if quoted_status:
-                    text = i.full_text + "\n\n" + text
-
-                urls = retweeted_status.urls
-                media = retweeted_status.media
-            else:
-                continue
-        else:
-            # do not forward pseudo-private answer for now
-            if i.full_text.startswith("@"):
+            if not retweets:
                 continue
-
-            text = i.full_text
-            urls = i.urls
-            media = i.media
+        # do not forward pseudo-private answer for now
+        elif i.full_text.startswith("@"):
+            continue
 
         # do not forward already forwarded tweets
         if i.id in done:
             continue
 
-        # remove this t.co crap
-        for url in urls:
-            text = text.replace(url.url, url.expanded_url)
-
-        # strip last t.co URL, which is a reference to the tweet
-        # itself (other URLs were expanded above, so there is no risk
-        # to remove an important, part of the text, URL)
-        if strip_trailing_url:
-            match = ENDS_WITH_TCO_URL_REGEX.search(text)
-            if match is not None:
-                text = text[:-len(match.group('stripme'))]
-
-        toot_text = h.unescape(text)
-        warning, toot_text = _find_potential_content_warning(toot_text)
+        if retweeted_status:
+            # the same status is often retweeted by several accounts:
+            # it is rendered once, unless cw.json changes meanwhile
+            key = (retweeted_status.id,
+                   i.full_text if quoted_status else None,
+                   strip_trailing_url, _get_content_warnings_matcher())
+            rendered = _rendered_toots.get(key)
+            if rendered is None:
+                rendered = _render_retweet(i, twitter_handle,
+                                           strip_trailing_url)
+                _rendered_toots.put(key, rendered)
+            else:
+                metrics.count("render_cache_hits", account=twitter_handle)
+        else:
+            rendered = _render(i.full_text, i.urls, i.media, twitter_handle,
+                               strip_trailing_url)
 
-        toots.append({
+        toot_text, warning, medias = rendered
+        yield {
             "text": toot_text,
             "content_warning": warning,
             "id": i.id,
-            "medias": [x.media_url for x in media] if media else []
-        })
+            "medias": medias[:]
+        }
+
+
+def _render_retweet(status, twitter_handle, strip_trailing_url=False):
+    """Return the (text, content warning, media URLs) of the toot of the
+    retweet or quote `status` (see `_render`).
+
+    """
+    quoted_status = getattr(status, "quoted_status", None)
+    retweeted_status = status.retweeted_status or quoted_status
+    retweet_template = _get_retweet_template()
+
+    text = retweet_template % {
+        "text": retweeted_status.full_text,
+        "user": retweeted_status.user.screen_name,
+        "id": retweeted_status.id
+    }
+
+    # can only be greater than 500 chars if it's a quoted tweet so checking here
+    # delete the text of the quoted tweet from the toot end replace it with a much shorter string
+    if quoted_status and len(text) > 500:
+        text = retweet_template % {
+            "text": "Quoted tweet's link below",
+            "user": retweeted_status.user.screen_name,
+            "id": retweeted_status.id
+        }
+        text = status.full_text + "\n\n" + text
+
+    if quoted_status:
+        text = status.full_text + "\n\n" + text
+
+    return _render(text, retweeted_status.urls, retweeted_status.media,
+                   twitter_handle, strip_trailing_url)
+
+
+def _render(text, urls, media, twitter_handle, strip_trailing_url=False):
+    """Return the (text, content warning, media URLs) of the toot of the
+    tweet `text` of `twitter_handle`, given the `urls` and `media` of
+    the status.
+
+    """
+    # remove this t.co crap
+    for url in urls:
+        text = text.replace(url.url, url.expanded_url)
+
+    # strip last t.co URL, which is a reference to the tweet
+    # itself (other URLs were expanded above, so there is no risk
+    # to remove an important, part of the text, URL)
+    if strip_trailing_url:
+        match = ENDS_WITH_TCO_URL_REGEX.search(text)
+        if match is not None:
+            text = text[:-len(match.group('stripme'))]
+
+    toot_text = _get_html_parser().unescape(text)
+    with metrics.timed("content_warning", account=twitter_handle):
+        warning, toot_text = _find_potential_content_warning(toot_text)
+
+    return toot_text, warning, [_media_url(x) for x in media] if media else []
+
 
-    return toots
+def _media_url(media):
+    """Return the URL of the file of the `media` of a tweet.
 
+    The `media_url` of videos and animated GIFs is only a thumbnail: the
+    MP4 variant of the best quality below `VIDEO_SIZE_LIMIT` is used
+    instead.
 
-def _send_toot(mastodon, toot):
+    """
+    if getattr(media, "type", None) not in ("video", "animated_gif"):
+        return media.media_url
+
+    video_info = media.video_info or {}
+    duration = video_info.get("duration_millis", 0) / 1000.0
+    variants = sorted((variant for variant in video_info.get("variants", ())
+                       if variant.get("content_type") == "video/mp4"),
+                      key=lambda variant: variant.get("bitrate", 0),
+                      reverse=True)
+    for variant in variants:
+        if variant.get("bitrate", 0) / 8.0 * duration <= VIDEO_SIZE_LIMIT:
+            return variant["url"]
+    if variants:
+        # the instance may accept larger videos than the default
+        return variants[-1]["url"]
+    return media.media_url
+
+
+def _get_retweet_template():
+    "Return the content of the retweet.tmpl template, read once."
+    global _retweet_template
+    if _retweet_template is None:
+        with codecs.open(os.path.join(HERE, "retweet.tmpl"),
+                         encoding="utf-8") as fobj:
+            _retweet_template = fobj.read()
+    return _retweet_template
+
+
+def _get_html_parser():
+    "Return the HTML parser used to unescape the tweets."
+    global _html_parser
+    if _html_parser is None:
+        try:
+            from HTMLParser import HTMLParser
+        except ImportError:
+            from html.parser import HTMLParser
+        _html_parser = HTMLParser()
+    return _html_parser
+
+
+class MediaProcessing(Exception):
+    "The instance is still processing the videos of a toot."
+
+
+class _LRUCache(object):
+    "Thread-safe mapping keeping its `size` most recently used items."
+
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        "Return the value of `key`, or None."
+        with self.lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                return None
+            self.items[key] = value
+            return value
+
+    def put(self, key, value):
+        "Set the value of `key`, evicting the least recently used items."
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+# (text, content warning, media URLs) of the rendered retweets and quotes
+_rendered_toots = _LRUCache(RENDERED_TOOTS_CACHE_SIZE)
+
+
+def _send_toot(mastodon, toot, labels=None, media_ids=None):
     """Send a toot given its description in the `toot` parameter.
 
     See the `_collect_toots` function for the expected description
     format.
 
-    This function fetches all media URLs of `toot` in a temporary
-    directory (removed afterwards) and uses the given Mastodon client
-    `mastodon` to send them along with the toot's textual content.
+    This function downloads all media URLs of `toot` (large ones to
+    temporary files) and uses the given Mastodon client `mastodon` to
+    send them along with the toot's textual content. Medias are
+    downloaded concurrently (unless they are in the media cache), and
+    each one is uploaded as soon as it is downloaded.
+
+    Videos are uploaded asynchronously (see `_media_post_async`): if the
+    instance is still processing them after `MEDIA_PROCESSING_WAIT`
+    seconds, `MediaProcessing` is raised, so that the toot is sent later
+    instead of holding the other ones.
 
     It may raise an AssertionError if the client does not succeed to
     send to given toot.
 
+    The time spent in each stage is recorded with the `labels` of the
+    toot (see `t2m.metrics`).
+
+    The ids of the uploaded medias are added to the `media_ids` dict,
+    by URL, as soon as they are uploaded, and the medias already in it
+    are not uploaded again: if sending the toot fails, the uploaded
+    medias can be reused by the next attempt (see `_defer_toot`).
+
     """
-    tmp_dir = tempfile.mkdtemp()
+    from t2m import media
+
+    labels = labels or {}
+    media_ids = {} if media_ids is None else media_ids
+    processed = set()
+
+    def upload(url, media_file, mime_type, file_name):
+        metrics.count("media_bytes", media.size(media_file), **labels)
+        with metrics.timed("upload", **labels):
+            if media.is_video(mime_type):
+                posted = _rate_limited(mastodon, _media_post_async, mastodon,
+                                       media_file, mime_type, file_name)
+            else:
+                posted = _rate_limited(mastodon, mastodon.media_post,
+                                       media_file, mime_type=mime_type,
+                                       file_name=file_name)
+        if posted.get("url") is not None:
+            processed.add(url)
+        media_ids[url] = posted["id"]
+
+    media.transfer([url for url in toot["medias"] if url not in media_ids],
+                   upload, cache=media.get_cache(), labels=labels)
+
+    # including the videos uploaded by a previous attempt
+    _wait_processed(mastodon, [
+        media_ids[url] for url in toot["medias"]
+        if url not in processed and media.is_video(media.describe(url, {})[0])
+    ], labels)
+
+    with metrics.timed("status_post", **labels):
+        response = _rate_limited(mastodon, mastodon.status_post,
+                                 toot["text"],
+                                 media_ids=[media_ids[url]
+                                            for url in toot["medias"]],
+                                 spoiler_text=toot["content_warning"])
+    assert not response.get("error"), response
+
+
+def _media_post_async(mastodon, media_file, mime_type, file_name):
+    """Upload a media with the asynchronous endpoint of Mastodon (3.1.3
+    or later) and return its media dict, whose "url" is None until the
+    instance has processed it (see `_wait_processed`).
+
+    Older instances lack this endpoint, in which case the media is
+    uploaded synchronously.
+
+    """
+    from mastodon import MastodonNotFoundError
+
+    # Mastodon.py does not know this endpoint, its request method still
+    # handles the authentication, errors and rate limit headers
     try:
-        medias = []
-        for number, media_url in enumerate(toot["medias"]):
-            dl_file_path = os.path.join(tmp_dir, str(number) + "." +
-                                        media_url.split(".")[-1])
-            urlretrieve(media_url, dl_file_path)
-            medias.append(mastodon.media_post(dl_file_path)["id"])
-
-        response = mastodon.status_post(toot["text"],
-                                        media_ids=medias,
-                                        spoiler_text=toot["content_warning"])
-        assert not response.get("error"), response
-    finally:
-        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return mastodon._Mastodon__api_request(
+            "POST", "/api/v2/media",
+            files={"file": (file_name, media_file, mime_type)})
+    except MastodonNotFoundError:
+        media_file.seek(0)
+        return mastodon.media_post(media_file, mime_type=mime_type,
+                                   file_name=file_name)
+
+
+def _wait_processed(mastodon, media_ids, labels=None):
+    """Wait up to `MEDIA_PROCESSING_WAIT` seconds for the instance of the
+    `mastodon` client to process the medias `media_ids`, and raise
+    `MediaProcessing` if it is still processing some of them.
+
+    The wait is bounded for all the medias of a toot, not for each one,
+    but it blocks the calling thread: with the threads engine of `t2m
+    all`, its worker does not forward other toots meanwhile (the
+    asyncio engine goes on with them, see `t2m.aio`).
+
+    """
+    from mastodon import MastodonNotFoundError
+
+    def processed(media_id):
+        try:
+            return _rate_limited(
+                mastodon, mastodon._Mastodon__api_request, "GET",
+                "/api/v1/media/%s" % media_id)["url"] is not None
+        except MastodonNotFoundError:
+            # uploaded synchronously to an older instance
+            return True
+
+    if not media_ids:
+        return
+
+    deadline = time.time() + MEDIA_PROCESSING_WAIT
+    with metrics.timed("processing", **(labels or {})):
+        while media_ids:
+            media_ids = [media_id for media_id in media_ids
+                         if not processed(media_id)]
+            if not media_ids:
+                break
+            if time.time() >= deadline:
+                raise MediaProcessing(media_ids)
+            time.sleep(MEDIA_POLL_INTERVAL)
+
+
+def _rate_limited(mastodon, method, *args, **kwargs):
+    """Call `method` of the `mastodon` client with the given arguments,
+    paced by the rate limiter shared by all the accounts of its instance
+    (the one of the media uploads for `_media_post_async` and
+    `media_post`, see `t2m.ratelimit`).
+
+    If the instance answers that its rate limit is hit anyway, the call
+    is retried up to `RATE_LIMIT_RETRIES` times, once the limit is
+    reset.
+
+    """
+    from mastodon import MastodonRatelimitError
+
+    media_upload = method in (_media_post_async, mastodon.media_post)
+    limiter = get_rate_limiter(mastodon.api_base_url,
+                               "media" if media_upload else None)
+    instance = mastodon.api_base_url.split("://", 1)[-1]
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        with metrics.timed("rate_limit_wait", instance=instance):
+            limiter.acquire()
+        try:
+            result = method(*args, **kwargs)
+        except MastodonRatelimitError:
+            metrics.count("rate_limit_hits", instance=instance)
+            if attempt == RATE_LIMIT_RETRIES:
+                raise
+            reset = mastodon.ratelimit_reset
+            if reset <= time.time():
+                # the instance gave no reset time, wait a minute
+                reset = time.time() + 60
+            limiter.update(0, reset)
+            continue
+        limiter.update(mastodon.ratelimit_remaining, mastodon.ratelimit_reset)
+        return result
+
+
+def _get_twitter_client():
+    "Return the Twitter client of the process, built from conf.yaml."
+    import twitter
+    import yaml
+
+    with _clients_lock:
+        if "twitter" not in _clients:
+            with open("conf.yaml") as fobj:
+                _clients["twitter"] = twitter.Api(
+                    tweet_mode='extended', **yaml.safe_load(fobj))
+        return _clients["twitter"]
 
 
 def _get_mastodon_client(mastodon_handle):
-    " Return a Mastodon client for the given handle. "
-    instance = mastodon_handle.split("@", 1)[1]
+    """Return the Mastodon client for the given handle.
+
+    Clients are built once per process, and the clients of the same
+    instance share their HTTP connections.
+
+    """
+    from mastodon import Mastodon
+
+    with _clients_lock:
+        if mastodon_handle not in _clients:
+            instance = mastodon_handle.split("@", 1)[1]
+            client_id, access_token = _login_to_mastodon(mastodon_handle)
+
+            # rate limits are handled by t2m, see _rate_limited
+            _clients[mastodon_handle] = Mastodon(
+                client_id=client_id,
+                access_token=access_token,
+                api_base_url='https://%s' % instance,
+                ratelimit_method="throw",
+                session=get_session('https://%s' % instance))
+        return _clients[mastodon_handle]
+
+
+def _send_outbox(db, twitter_handle, mastodon, labels=None, mirror=None):
+    """Send again the toots of the outbox of `twitter_handle` (or of its
+    `mirror`) which are due, using the `mastodon` client, and return the
+    number of sent toots, and whether sending one of them failed.
+
+    After a failure, the other toots are left for later, so that an
+    instance having trouble is not flooded with attempts.
+
+    """
+    forwarded = 0
+    for entry in _due_outbox(db, twitter_handle, mirror=mirror):
+        toot, media_ids = entry["toot"], dict(entry["media_ids"])
+        try:
+            _send_toot(mastodon, toot, labels, media_ids)
+        except MediaProcessing:
+            metrics.count("media_processing", **(labels or {}))
+            _defer_toot(db, twitter_handle, toot, media_ids,
+                        entry["attempts"] + 1, entry["created"], mirror)
+            continue
+        except Exception as e:
+            print("ERROR: could not forward the tweet [%s] '%s' because"
+                  " '%s' (attempt %s), sending it again later"
+                  % (toot["id"], toot["text"], e, entry["attempts"] + 1),
+                  file=sys.stderr)
+            metrics.count("errors", **(labels or {}))
+            _defer_toot(db, twitter_handle, toot, media_ids,
+                        entry["attempts"] + 1, entry["created"], mirror)
+            return forwarded, True
+
+        forwarded += 1
+        metrics.count("forwarded", **(labels or {}))
+        print("[forwarding] >>", toot["text"].encode("utf-8"),
+              " ".join(toot["medias"]))
+        _update_outbox(db, twitter_handle, toot["id"], None, mirror=mirror)
+    return forwarded, False
 
-    client_id, access_token = _login_to_mastodon(mastodon_handle)
 
-    return Mastodon(client_id=client_id,
-                    access_token=access_token,
-                    api_base_url='https://%s' % instance)
+def _targets(db, twitter_handle, mastodon_handle):
+    """Return the targets of the forwarding of `twitter_handle`, to
+    `mastodon_handle` and to the mirrors of the account, and the set of
+    the tweets already forwarded to all of them.
+
+    Each target is a dict holding its "mastodon" handle, its "mirror"
+    (None for `mastodon_handle`, see `t2m.storage.get_target`), its
+    "done" set, its metrics "labels", and whether sending a toot to it
+    "failed" during this run.
+
+    """
+    with _db_lock:
+        account = db.setdefault(twitter_handle, {})
+        targets = [{"mastodon": mastodon_handle, "mirror": None}] + [
+            {"mastodon": mirror, "mirror": mirror}
+            for mirror in sorted(account.get("mirrors", {}))]
+        for target in targets:
+            target["done"] = get_target(
+                db, twitter_handle, target["mirror"]).setdefault(
+                    "done", set())
+            target["labels"] = {
+                "account": twitter_handle,
+                "instance": target["mastodon"].split("@", 1)[-1]}
+            target["failed"] = False
+        done = set.intersection(*[target["done"] for target in targets])
+    return targets, done
+
+
+def _send_to_target(db, twitter_handle, target, toot):
+    """Send `toot` to the `target` Mastodon account of `twitter_handle`
+    (see `_forward`), unless it was already forwarded to it, and return
+    whether it was sent.
+
+    If sending the toot fails, or if a previous toot failed, it is put
+    in the outbox of the target (see `_defer_toot`).
+
+    """
+    mirror, labels = target["mirror"], target["labels"]
+    with _db_lock:
+        if toot["id"] in get_target(db, twitter_handle, mirror)["done"]:
+            return False
+
+    if target["failed"]:
+        # do not insist while the instance fails, the next toots are
+        # sent later, spread over time
+        _defer_toot(db, twitter_handle, toot, attempts=0, mirror=mirror)
+        return False
+
+    media_ids = {}
+    try:
+        _send_toot(_get_mastodon_client(target["mastodon"]), toot, labels,
+                   media_ids)
+    except MediaProcessing:
+        # the other toots are not held meanwhile
+        print("[forwarding] %s is still processing the videos of the tweet"
+              " [%s], sending it later" % (target["mastodon"], toot["id"]))
+        metrics.count("media_processing", **labels)
+        _defer_toot(db, twitter_handle, toot, media_ids, mirror=mirror)
+        return False
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        print("ERROR: could not forward the tweet [%s] '%s' to %s "
+              "because '%s', sending it again later"
+              % (toot["id"], toot["text"], target["mastodon"], e),
+              file=sys.stderr)
+        metrics.count("errors", **labels)
+        _defer_toot(db, twitter_handle, toot, media_ids, mirror=mirror)
+        target["failed"] = True
+        return False
+
+    metrics.count("forwarded", **labels)
+    print("[forwarding] >>",
+          toot["text"].encode("utf-8"),
+          " ".join(toot["medias"]))
+    _mark_done(db, twitter_handle, toot["id"], mirror=mirror)
+    return True
+
+
+def _prefetch_medias(toot, labels=None):
+    """Download the medias of `toot` to the media cache, so that they
+    are downloaded once for all the targets of the toot.
+
+    """
+    from t2m import media
+
+    try:
+        media.transfer(toot["medias"], lambda *downloaded: None,
+                       cache=media.get_cache(), labels=labels)
+    except Exception as e:
+        # each target tries again, and handles the failure
+        print("WARNING: could not download the medias of the tweet [%s]"
+              " because '%s'" % (toot["id"], e), file=sys.stderr)
 
 
 def _forward(db, twitter_handle, mastodon_handle, number=None,
              only_mark_as_seen=False, retweets=False, debug=False,
-             wait_seconds=30, strip_trailing_url=False):
+             wait_seconds=None, strip_trailing_url=False, timeline=None,
+             on_sent=None):
     """Internal function that does the actual tweet forwarding job.
 
-    This function modifies the given `db` parameter.
+    This function modifies the given `db` parameter, holding `_db_lock`
+    while doing so: several accounts of the same `db` can be forwarded
+    concurrently. It returns the number of forwarded (or marked as seen)
+    tweets.
 
     See the `one` function doc for more information about its
     parameters.
 
     The `wait_seconds` parameter is the time between we wait between
-    two sendings.
+    two sendings. When it is not given, toots are only paced by the
+    rate limits of the Mastodon instance (see `_rate_limited`).
+
+    The tweets are forwarded to `mastodon_handle`, and to the mirrors
+    of the account (see `add`): the timeline is fetched and rendered
+    once, and each toot is sent to all of them concurrently, each one
+    having its own forwarded tweets and outbox.
+
+    The statuses to forward can be given as `timeline` instead of being
+    fetched (see `backfill`), and `on_sent` is called with each toot
+    once it was sent (or deferred).
 
     """
-    with open("conf.yaml") as fobj:
-        twitter_client = twitter.Api(
-            tweet_mode='extended', **yaml.safe_load(fobj))
+    forwarding = _Forwarding(db, twitter_handle, mastodon_handle,
+                             number=number,
+                             only_mark_as_seen=only_mark_as_seen,
+                             retweets=retweets, debug=debug,
+                             strip_trailing_url=strip_trailing_url,
+                             timeline=timeline)
+    try:
+        attempted = False
+        for toot in forwarding.start():
+            if wait_seconds and attempted and forwarding.trying():
+                with metrics.timed("sleep", **forwarding.labels):
+                    time.sleep(float(wait_seconds))
+            attempted = forwarding.send(toot) or attempted
+            if on_sent is not None:
+                on_sent(toot)
+        return forwarding.finish()
+    finally:
+        forwarding.close()
 
-    done = db.setdefault(twitter_handle, {}).setdefault("done", [])
 
-    to_toot = _collect_toots(twitter_client, twitter_handle,
-                             done=done, retweets=retweets,
-                             strip_trailing_url=strip_trailing_url)
-    if only_mark_as_seen:
-        done.extend([t["id"] for t in to_toot])
-        print("Marked all available tweets as seen (%s tweets marked)"
-              % len(to_toot))
-        return
+class _Forwarding(object):
+    """Forwarding of the tweets of `twitter_handle` to `mastodon_handle`
+    and to its mirrors (see `_forward`), in steps, so that the toots of
+    several accounts can be interleaved (see `t2m.scheduler`):
 
-    # slices selected tweets if specified
-    if number is not None:
-        to_toot = to_toot[-int(number):]
+    - `start` sends the toots of the outbox which are due, fetches the
+      timeline (unless it is given as `timeline`), and returns an
+      iterator on the toots to send, rendered as they are iterated,
+    - `send` sends one of these toots,
+    - `finish` records the progress of the account, and returns the
+      number of forwarded (or marked as seen) tweets,
+    - `close` frees the threads of the mirrors.
 
-    # actually forward
-    forwarded = 0
-    _check_complete_mastodon_handle(mastodon_handle, twitter_handle)
-    mastodon = _get_mastodon_client(mastodon_handle)
+    When `latest` is given, the given `timeline` holds the last statuses
+    of the account, up to the `latest` tweet id of the timeline it was
+    picked from (see `t2m.lists`), and the progress of the account is
+    recorded as if it was fetched.
+
+    """
 
-    for num, toot in enumerate(to_toot):
-        if debug:
+    def __init__(self, db, twitter_handle, mastodon_handle, number=None,
+                 only_mark_as_seen=False, retweets=False, debug=False,
+                 strip_trailing_url=False, timeline=None, latest=None):
+        self.db = db
+        self.twitter_handle = twitter_handle
+        self.number = number
+        self.only_mark_as_seen = only_mark_as_seen
+        self.retweets = retweets
+        self.debug = debug
+        self.strip_trailing_url = strip_trailing_url
+        self.twitter_client = _get_twitter_client()
+
+        with _db_lock:
+            self.account = db.setdefault(twitter_handle, {})
+        self.targets, self.done = _targets(db, twitter_handle,
+                                           mastodon_handle)
+        self.labels = self.targets[0]["labels"]
+        self.forwarded = 0
+        self.timeline = timeline
+        self.latest = latest
+        # a given timeline is not the last statuses of the account,
+        # unless told otherwise
+        self.fetched = timeline is None or latest is not None
+        # ids of all the rendered toots, as the ones left out by the
+        # `number` slicing are still pending
+        self.collected = []
+
+        # threads of the mirrors, started when first needed
+        self.pool = None
+        self.concurrent = len(self.targets) > 1 and not debug
+
+    def on_targets(self, function):
+        "Call `function` on each target, concurrently if there are several."
+        if not self.concurrent:
+            return [function(target) for target in self.targets]
+        if self.pool is None:
+            from multiprocessing.pool import ThreadPool
+            self.pool = ThreadPool(len(self.targets))
+        return self.pool.map(function, self.targets)
+
+    def trying(self):
+        "Return the targets which did not fail during this run."
+        return [target for target in self.targets if not target["failed"]]
+
+    def start(self):
+        "Return an iterator on the toots to send (see `_Forwarding`)."
+        db, twitter_handle = self.db, self.twitter_handle
+        if not self.only_mark_as_seen:
+            for target in self.targets:
+                _check_complete_mastodon_handle(target["mastodon"],
+                                                twitter_handle)
+
+        # toots which failed during previous runs are sent again first,
+        # without fetching them again from Twitter
+        def send_outbox(target):
+            if not _due_outbox(db, twitter_handle, mirror=target["mirror"]):
+                return 0
+            forwarded, target["failed"] = _send_outbox(
+                db, twitter_handle, _get_mastodon_client(target["mastodon"]),
+                target["labels"], target["mirror"])
+            return forwarded
+
+        if not (self.debug or self.only_mark_as_seen):
+            self.forwarded += sum(self.on_targets(send_outbox))
+
+        if self.timeline is None:
+            since_id = self.account.get("since_id")
+            with metrics.timed("fetch", account=twitter_handle):
+                self.timeline = _fetch_timeline(
+                    self.twitter_client, twitter_handle, since_id=since_id)
+            if not (self.debug or self.only_mark_as_seen):
+                _record_gap(self.account, twitter_handle, self.timeline,
+                            since_id)
+        toots = _iter_toots(self.twitter_client, twitter_handle,
+                            done=self.done, retweets=self.retweets,
+                            strip_trailing_url=self.strip_trailing_url,
+                            timeline=self.timeline)
+        if self.only_mark_as_seen:
+            seen = [t["id"] for t in toots]
+            with _db_lock:
+                for target in self.targets:
+                    target["done"].update(seen)
+            if self.fetched:
+                _update_since_id(self.account, self.timeline,
+                                 newest=self.latest)
+            print("Marked all available tweets as seen (%s tweets marked)"
+                  % len(seen))
+            self.forwarded = len(seen)
+            return iter(())
+
+        def collect(toots):
+            for toot in toots:
+                self.collected.append(toot["id"])
+                yield toot
+
+        for target in self.targets:
+            _get_mastodon_client(target["mastodon"])
+
+        # toots are sent as soon as they are rendered, except when only
+        # the last `number` ones are selected: they are only known once
+        # all the toots are rendered, and kept in a bounded buffer
+        # meanwhile
+        if self.number is not None:
+            return iter(deque(collect(toots), maxlen=int(self.number)))
+        return collect(toots)
+
+    def send(self, toot):
+        """Send `toot` to the targets, and return whether it was attempted
+        for some of them (instead of being deferred to their outbox).
+
+        """
+        if self.debug:
             print(">>", toot["text"].encode("utf-8"),
                   " ".join(toot["medias"]))
-            continue
-        if wait_seconds and num > 0:
-            time.sleep(wait_seconds)
-        try:
-            _send_toot(mastodon, toot)
-        except Exception as e:
-            import traceback
-            traceback.print_exc()
-            print("ERROR: could not forward the tweet [%s] '%s' "
-                  "because '%s', skipping for now"
-                  % (toot["id"], toot["text"], e), file=sys.stderr)
-            continue
+            return False
+        trying = self.trying()
+        if len(trying) > 1 and toot["medias"]:
+            _prefetch_medias(toot, self.labels)
+        self.forwarded += sum(self.on_targets(
+            lambda target: _send_to_target(self.db, self.twitter_handle,
+                                           target, toot)))
+        return bool(trying)
+
+    def finish(self):
+        "Record the progress of the account (see `_Forwarding`)."
+        if self.only_mark_as_seen:
+            return self.forwarded
+
+        if self.fetched and not self.debug:
+            with _db_lock:
+                _update_since_id(self.account, self.timeline, [
+                    tweet_id for tweet_id in self.collected
+                    if any(tweet_id not in target["done"]
+                           for target in self.targets)], newest=self.latest)
+
+        if not self.collected and not self.forwarded:
+            print("Nothing to do for %s" % self.twitter_handle)
+        else:
+            print("Forwarded %s tweets from %s to %s"
+                  % (self.forwarded, self.twitter_handle,
+                     ", ".join(target["mastodon"]
+                               for target in self.targets)))
+        return self.forwarded
 
-        forwarded += 1
-        print("[forwarding] >>",
-              toot["text"].encode("utf-8"),
-              " ".join(toot["medias"]))
-        done.append(toot["id"])
-        _save_db(db)
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
 
-    if not to_toot:
-        print("Nothing to do for %s" % twitter_handle)
-    else:
-        print("Forwarded %s tweets from %s to %s"
-              % (forwarded, twitter_handle, mastodon_handle))
 
-    return
+@contextmanager
+def _saving_only(twitter_handle):
+    """Only save the progress of `twitter_handle` with `_save_db` for the
+    duration of the `with` block: the other accounts may be forwarded by
+    other t2m processes meanwhile (see `_claimed_shard`).
+
+    """
+    get_storage().restrict(lambda handle: handle == twitter_handle)
+    try:
+        yield
+    finally:
+        get_storage().restrict(None)
 
 
 def one(twitter_handle, mastodon_handle=None, number=None,
         only_mark_as_seen=False, retweets=False, debug=False,
-        wait_seconds=30, strip_trailing_url=False):
+        wait_seconds=None, strip_trailing_url=False,
+        prometheus_file=None):
     """Forward tweets of *one* twitter account to Mastodon.
 
     If the `mastodon_handle` parameter is not specified, the given
@@ -365,6 +1293,14 @@ def one(twitter_handle, mastodon_handle=None, number=None,
     would be forwarded if unset (the default), but does not actually
     forward any tweet.
 
+    By default, toots are sent as fast as the rate limits of the
+    Mastodon instance allow. If `wait_seconds` is given, t2m also
+    waits that many seconds between two toots.
+
+    A summary of the time spent in each stage of the forwarding is
+    printed at the end. If `prometheus_file` is given, the metrics are
+    also written to it, in the text format of Prometheus.
+
     """
 
     db = _get_db()
@@ -381,18 +1317,105 @@ def one(twitter_handle, mastodon_handle=None, number=None,
     _check_complete_mastodon_handle(mastodon_handle, twitter_handle)
 
     # force set new mastodon handle
+    if db.get(twitter_handle, {}).get("mastodon") != mastodon_handle:
+        get_storage().set_mastodon(twitter_handle, mastodon_handle)
     db.setdefault(twitter_handle, {})["mastodon"] = mastodon_handle
 
-    _forward(db, twitter_handle, mastodon_handle, number=number,
-             only_mark_as_seen=only_mark_as_seen, retweets=retweets,
-             debug=debug, wait_seconds=wait_seconds,
-             strip_trailing_url=strip_trailing_url)
+    with _saving_only(twitter_handle):
+        _forward(db, twitter_handle, mastodon_handle, number=number,
+                 only_mark_as_seen=only_mark_as_seen, retweets=retweets,
+                 debug=debug, wait_seconds=wait_seconds,
+                 strip_trailing_url=strip_trailing_url)
+
+        _save_db(db)
+    _print_media_cache_stats()
+    _report_metrics(prometheus_file)
+
+
+def backfill(twitter_handle, since_id=None, retweets=False, debug=False,
+             wait_seconds=BACKFILL_WAIT_SECONDS, strip_trailing_url=False,
+             prometheus_file=None):
+    """Forward the tweets of *one* twitter account missed by the previous
+    runs, oldest first.
+
+    Each run only sees the last 200 tweets of an account: when more
+    were posted since the previous run (after an outage, for instance),
+    the older ones are recorded as missed, and forwarded by this
+    command. With `since_id`, the tweets more recent than this tweet id,
+    up to the last run, are forwarded too (unless they already were):
+    only the last forwarded tweets are remembered (see `_prune_done`),
+    older ones being skipped.
 
-    _save_db(db)
+    The timeline is paged backwards, up to the last 3200 tweets which
+    Twitter gives. The progress is recorded as toots are sent: an
+    interrupted backfill resumes where it stopped. In `debug` mode, the
+    toots of the first window are only displayed, and nothing is
+    recorded.
 
+    Toots are sent every `wait_seconds` seconds (5 by default). See the
+    `one` command for the other parameters.
 
-def all(retweets=False, debug=False, wait_seconds=30,
-        strip_trailing_url=False):
+    """
+    db = _get_db()
+    account = db.get(twitter_handle, {})
+    if not account.get("mastodon"):
+        print("ERROR: No associated mastodon account for twitter account"
+              " %r. Use the 't2m one' command first." % twitter_handle,
+              file=sys.stderr)
+        sys.exit(1)
+
+    # [since_id, max_id] windows of missed tweets, both excluded
+    windows = [window[:] for window in account.get("backfill", [])]
+    if since_id is not None:
+        since_id = int(since_id)
+        forgotten = _forgotten_before(account)
+        if forgotten is not None and since_id < forgotten:
+            print("WARNING: the tweets of %s older than %s may already have"
+                  " been forwarded, backfilling the ones since %s only"
+                  % (twitter_handle, forgotten, forgotten), file=sys.stderr)
+            since_id = forgotten
+        windows.append([since_id, account.get("since_id")])
+    if not windows:
+        print("Nothing to backfill for %s" % twitter_handle)
+        return
+    windows.sort()
+
+    twitter_client = _get_twitter_client()
+
+    def checkpoint(toot):
+        # toots are sent oldest first, the older ones are done: the
+        # window is recorded along with each toot, as the "done" sets
+        # may be pruned by other runs meanwhile
+        window[0] = toot["id"]
+        _update_backfill(db, twitter_handle, windows)
+
+    with _saving_only(twitter_handle):
+        if not debug:
+            _update_backfill(db, twitter_handle, windows)
+        while windows:
+            window = windows[0]
+            timeline = _fetch_history(twitter_client, twitter_handle,
+                                      since_id=window[0], max_id=window[1])
+            _forward(db, twitter_handle, account["mastodon"],
+                     retweets=retweets, debug=debug,
+                     wait_seconds=wait_seconds,
+                     strip_trailing_url=strip_trailing_url,
+                     timeline=timeline,
+                     on_sent=None if debug else checkpoint)
+            if debug:
+                break
+            windows.pop(0)
+            _update_backfill(db, twitter_handle, windows)
+
+        if not debug:
+            _save_db(db)
+    _print_media_cache_stats()
+    _report_metrics(prometheus_file)
+
+
+def all(retweets=False, debug=False, wait_seconds=None,
+        strip_trailing_url=False, workers=1, engine="threads",
+        total_shards=1, lock_dir=".", batch_list=None, prometheus_file=None):
     """Forward the tweets of all known twitter accounts to Mastodon.
 
     Only not already forwarded tweets are forwarded. Note that you
@@ -405,21 +1428,377 @@ def all(retweets=False, debug=False, wait_seconds=30,
     When optional `retweets` parameter is True (it is False by
     default), the retweets are also forwarded to Mastodon.
 
+    The tweets of all the accounts are fetched first, and their toots
+    are then interleaved by weighted round-robin, so that an account
+    with many toots to send does not hold the other ones: each account
+    gets its priority (1 by default, see the `priority` command) worth
+    of turns. `wait_seconds` is then the time between two toots of the
+    same account, the other accounts going on meanwhile.
+
+    By default (`workers` is 1), the accounts are forwarded one after
+    the other. When `workers` is greater than 1, that many accounts are
+    forwarded concurrently.
+
+    With the "asyncio" `engine` (instead of the default "threads" one),
+    all the accounts are forwarded by a single thread, keeping up to
+    `workers` of them in flight. It requires Python 3.5 or later and
+    aiohttp.
+
+    The accounts can be split between several t2m processes, on one or
+    several hosts: each one claims one of the `total_shards` shards of
+    the accounts, and only forwards the accounts of its shard. The
+    claims are locks on files of `lock_dir` (the current directory by
+    default), which must be shared by the processes. A run started
+    while the previous one still holds all the shards does nothing.
+
+    When `batch_list` is given, the timelines are fetched in a few
+    requests from the private Twitter list of that name, whose members
+    are kept in sync with the accounts of the database, instead of one
+    request per account (see `t2m.lists`). It requires the "threads"
+    engine.
+
+    See the `one` command for the `prometheus_file` parameter.
+
     """
-    db = _get_db()
+    with _claimed_shard(total_shards, lock_dir) as owns:
+        if owns is None:
+            return
 
-    for twitter_handle in db:
-        if not db[twitter_handle].get("mastodon"):
-            print("WARNING: no mastodon handle for twitter account %r, "
-                  "add one using the 't2m add' command. Skipped."
-                  % twitter_handle)
-            continue
+        db = _get_db()
 
-        _forward(db, twitter_handle, db[twitter_handle]["mastodon"],
-                 retweets=retweets, debug=debug, wait_seconds=wait_seconds,
-                 strip_trailing_url=strip_trailing_url)
+        twitter_handles = []
+        for twitter_handle in db:
+            if not owns(twitter_handle):
+                continue
+            if not db[twitter_handle].get("mastodon"):
+                print("WARNING: no mastodon handle for twitter account %r, "
+                      "add one using the 't2m add' command. Skipped."
+                      % twitter_handle)
+                continue
+            twitter_handles.append(twitter_handle)
+
+        if batch_list and engine != "threads":
+            print("ERROR: the batch list needs the 'threads' engine",
+                  file=sys.stderr)
+            sys.exit(1)
+
+        if engine == "asyncio":
+            from t2m import aio
+            aio.forward_all(db, twitter_handles, workers=workers,
+                            retweets=retweets, debug=debug,
+                            wait_seconds=wait_seconds,
+                            strip_trailing_url=strip_trailing_url)
+        elif engine != "threads":
+            print("ERROR: unknown engine %r, use 'threads' or 'asyncio'"
+                  % engine, file=sys.stderr)
+            sys.exit(1)
+        else:
+            timelines, newest = None, None
+            if batch_list:
+                timelines, newest = _fetch_list_timelines(db, batch_list)
+            _forward_all(db, twitter_handles, workers=int(workers),
+                         timelines=timelines, newest=newest,
+                         retweets=retweets, debug=debug,
+                         wait_seconds=wait_seconds,
+                         strip_trailing_url=strip_trailing_url)
+
+        _save_db(db)
+    _print_media_cache_stats()
+    _report_metrics(prometheus_file)
+
+
+@contextmanager
+def _claimed_shard(total_shards=1, lock_dir="."):
+    """Claim one of the `total_shards` shards of the accounts (see
+    `t2m.shards`) for the duration of the `with` block, and yield the
+    function telling whether a twitter account belongs to it, or None
+    if all the shards are held by other t2m processes.
+
+    Meanwhile, `_save_db` only saves the progress of the accounts of the
+    claimed shard (see `t2m.storage.JsonStorage.restrict`): the other
+    ones, and the configuration changed by other t2m commands, are kept
+    as they are in the database.
+
+    """
+    from t2m import shards
+
+    total_shards = int(total_shards)
+    lease = shards.claim(lock_dir, total_shards)
+    if lease is None:
+        holders = [shards.Lease(lock_dir, shard, total_shards).holder()
+                   for shard in range(total_shards)]
+        print("WARNING: all the shards of the accounts are held by other t2m"
+              " processes (%s), nothing to do" % ", ".join(
+                  holder or "?" for holder in holders), file=sys.stderr)
+        yield None
+        return
+
+    ring = shards.HashRing(total_shards)
+
+    def owns(twitter_handle):
+        return ring.shard(twitter_handle) == lease.shard
+
+    if total_shards > 1:
+        print("Forwarding the accounts of shard %s of %s"
+              % (lease.shard + 1, total_shards))
+    get_storage().restrict(owns)
+    try:
+        yield owns
+    finally:
+        get_storage().restrict(None)
+        lease.release()
+
+
+def _fetch_list_timelines(db, name):
+    """Return the {twitter handle: timeline} dict of the accounts of
+    `db` whose last statuses were fetched from the `name` Twitter list
+    (see `t2m.lists`), which is empty if the list could not be used,
+    and the most recent tweet id of the timeline of the list.
+
+    """
+    import twitter
+    from t2m import lists
+
+    with _db_lock:
+        since_ids = dict((twitter_handle, account.get("since_id"))
+                         for twitter_handle, account in db.items()
+                         if account.get("mastodon"))
+    try:
+        timelines, newest = lists.timelines(_get_twitter_client(), name,
+                                            since_ids)
+    except twitter.TwitterError as e:
+        print("WARNING: could not fetch the timeline of the %r list because"
+              " '%s', fetching the accounts one by one" % (name, e),
+              file=sys.stderr)
+        return {}, None
+    print("Fetched %s accounts out of %s from the %r list"
+          % (len(timelines), len(since_ids), name))
+    return timelines, newest
+
+
+def _forward_all(db, twitter_handles, workers=1, wait_seconds=None,
+                 timelines=None, newest=None, **kwargs):
+    """Forward the tweets of `twitter_handles`, interleaving the toots of
+    all the accounts with a `t2m.scheduler.Scheduler` (see `all`).
+
+    The timelines are fetched, and the toots sent, by `workers` threads,
+    except the ones given in the `timelines` {twitter handle: last
+    statuses} dict, picked up to the `newest` tweet id (see
+    `_fetch_list_timelines`). The other keyword arguments are the ones
+    of `_forward`.
+
+    An account which fails (a deleted or protected Twitter account, for
+    instance) is skipped, and the other ones go on.
+
+    """
+    from t2m.scheduler import Scheduler
+
+    scheduler = Scheduler()
+    forwardings = OrderedDict((twitter_handle, None)
+                              for twitter_handle in twitter_handles)
+
+    def fail(twitter_handle, error):
+        import traceback
+        traceback.print_exc()
+        print("ERROR: could not forward the tweets of %s because '%s',"
+              " skipped" % (twitter_handle, error), file=sys.stderr)
+        forwarding, forwardings[twitter_handle] = \
+            forwardings[twitter_handle], None
+        if forwarding is not None:
+            forwarding.close()
+
+    def guarded(twitter_handle, forwarding, toots):
+        try:
+            for toot in toots:
+                if forwardings[twitter_handle] is None:
+                    return
+                yield toot
+        except Exception as e:
+            fail(twitter_handle, e)
+            return
+        # the threads of the mirrors are not needed by `finish`
+        forwarding.close()
+
+    def start(twitter_handle):
+        timeline = (timelines or {}).get(twitter_handle)
+        try:
+            forwarding = forwardings[twitter_handle] = _Forwarding(
+                db, twitter_handle, db[twitter_handle]["mastodon"],
+                timeline=timeline,
+                latest=newest if timeline is not None else None, **kwargs)
+            toots = guarded(twitter_handle, forwarding, forwarding.start())
+        except Exception as e:
+            fail(twitter_handle, e)
+            return
+        scheduler.add(twitter_handle, toots,
+                      weight=db[twitter_handle].get("priority", 1),
+                      interval=wait_seconds)
+
+    def send(_):
+        while True:
+            taken = scheduler.take()
+            if taken is None:
+                return
+            twitter_handle, toot = taken
+            attempted = False
+            try:
+                attempted = forwardings[twitter_handle].send(toot)
+            except Exception as e:
+                fail(twitter_handle, e)
+            finally:
+                scheduler.release(twitter_handle, attempted)
+
+    pool = None
+    if workers > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(workers)
+    try:
+        if pool is None:
+            for twitter_handle in twitter_handles:
+                start(twitter_handle)
+            send(None)
+        else:
+            pool.map(start, twitter_handles)
+            pool.map(send, range(workers))
+
+        for twitter_handle, forwarding in forwardings.items():
+            if forwarding is None:
+                continue
+            try:
+                forwarding.finish()
+            except Exception as e:
+                fail(twitter_handle, e)
+    finally:
+        for forwarding in forwardings.values():
+            if forwarding is not None:
+                forwarding.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def _print_media_cache_stats():
+    "Print the hits and misses of the media cache, if it was used."
+    from t2m import media
+
+    cache = media.get_cache()
+    if cache.hits or cache.misses:
+        print("Media cache: %s hits, %s misses" % (cache.hits, cache.misses))
+
+
+def _report_metrics(prometheus_file=None, summary=True):
+    """Print the summary of the metrics of the run, unless `summary` is
+    False, and write them to `prometheus_file` if given.
+
+    """
+    if summary:
+        print(metrics.summary())
+    if prometheus_file:
+        metrics.write_prometheus(prometheus_file)
+
+
+def _next_poll_interval(interval, forwarded, min_interval=MIN_POLL_INTERVAL,
+                        max_interval=MAX_POLL_INTERVAL):
+    """Return the polling interval of an account, polled every `interval`
+    seconds so far, after a poll which `forwarded` that many tweets.
+
+    The interval is halved for accounts which tweeted since the last
+    poll, and doubled for the other ones, within `min_interval` and
+    `max_interval`.
+
+    """
+    if forwarded:
+        interval = interval / 2.0
+    else:
+        interval = interval * 2.0
+    return min(max(interval, min_interval), max_interval)
+
+
+def daemon(retweets=False, wait_seconds=None, strip_trailing_url=False,
+           min_interval=MIN_POLL_INTERVAL, max_interval=MAX_POLL_INTERVAL,
+           total_shards=1, lock_dir=".", prometheus_file=None):
+    """Keep forwarding the tweets of all known twitter accounts to
+    Mastodon, until interrupted.
+
+    Each account is polled on its own schedule, between every
+    `min_interval` seconds (defaults to a minute) for the accounts which
+    tweet a lot, and every `max_interval` seconds (defaults to 4 hours)
+    for dormant ones. Accounts added or changed with `t2m add` while the
+    daemon runs are picked up when the database is saved, every
+    `min_interval` seconds, and the `prometheus_file` is written then too.
+
+    See the `all` command for the `total_shards` and `lock_dir`
+    parameters, and the `one` command for the other ones.
 
-    _save_db(db)
+    """
+    with _claimed_shard(total_shards, lock_dir) as owns:
+        if owns is None:
+            return
+
+        db = _get_db()
+        min_interval, max_interval = float(min_interval), float(max_interval)
+
+        # (next poll time, twitter handle, polling interval) heap
+        schedule = []
+        scheduled = set()
+        next_save = time.time() + min_interval
+
+        def schedule_new_accounts():
+            saved = _get_db()
+            for twitter_handle, account in saved.items():
+                mastodon_handle = account.get("mastodon")
+                if not mastodon_handle or not owns(twitter_handle):
+                    continue
+                with _db_lock:
+                    if twitter_handle not in db:
+                        db[twitter_handle] = account
+                    # changed with `t2m add` meanwhile
+                    db[twitter_handle]["mastodon"] = mastodon_handle
+                    for mirror, target in account.get("mirrors", {}).items():
+                        db[twitter_handle].setdefault(
+                            "mirrors", {}).setdefault(mirror, target)
+                if twitter_handle in scheduled:
+                    continue
+                scheduled.add(twitter_handle)
+                heapq.heappush(schedule, (time.time(), twitter_handle,
+                                          min_interval))
+
+        schedule_new_accounts()
+        try:
+            while schedule:
+                due, twitter_handle, interval = heapq.heappop(schedule)
+                delay = due - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+                try:
+                    forwarded = _forward(
+                        db, twitter_handle, db[twitter_handle]["mastodon"],
+                        retweets=retweets, wait_seconds=wait_seconds,
+                        strip_trailing_url=strip_trailing_url)
+                except Exception as e:
+                    import traceback
+                    traceback.print_exc()
+                    print("ERROR: could not forward the tweets of %s because"
+                          " '%s', retrying later" % (twitter_handle, e),
+                          file=sys.stderr)
+                    forwarded = 0
+
+                interval = _next_poll_interval(interval, forwarded,
+                                               min_interval, max_interval)
+                heapq.heappush(schedule, (time.time() + interval,
+                                          twitter_handle, interval))
+
+                if time.time() >= next_save:
+                    _save_db(db)
+                    _report_metrics(prometheus_file, summary=False)
+                    schedule_new_accounts()
+                    next_save = time.time() + min_interval
+        except KeyboardInterrupt:
+            pass
+        finally:
+            _save_db(db)
+            _report_metrics(prometheus_file)
 
 
 def _login_to_mastodon(mastodon_handle):
@@ -435,6 +1814,7 @@ def _login_to_mastodon(mastodon_handle):
     client_id = _ensure_client_exists_for_instance(instance)
     access_token = "t2m_%s_creds.txt" % mastodon_handle
     if not os.path.exists(access_token):
+        from mastodon import Mastodon
         mastodon = Mastodon(client_id=client_id,
                             api_base_url="https://%s" % instance)
 
@@ -450,10 +1830,15 @@ def _login_to_mastodon(mastodon_handle):
     return client_id, access_token
 
 
-def add(twitter_handle, mastodon_handle):
-    "Add the link between given twitter and mastodon handles in the database."
-    db = _get_db()
+def add(twitter_handle, mastodon_handle, mirror=False):
+    """Add the link between given twitter and mastodon handles in the database.
 
+    With `mirror`, the mastodon account is added as a mirror of the
+    twitter account: its tweets are forwarded to it too, along with
+    the mastodon account it is already linked to, from now on. The
+    timeline is fetched once for all of them.
+
+    """
     _check_complete_mastodon_handle(mastodon_handle, twitter_handle)
 
     # retrocompatibility
@@ -464,17 +1849,49 @@ def add(twitter_handle, mastodon_handle):
 
     _login_to_mastodon(mastodon_handle)
 
-    db.setdefault(twitter_handle, {})["mastodon"] = mastodon_handle
+    if mirror:
+        get_storage().add_mirror(twitter_handle, mastodon_handle)
+    else:
+        get_storage().set_mastodon(twitter_handle, mastodon_handle)
+    print("done")
+
 
-    _save_db(db)
+def priority(twitter_handle, priority):
+    """Set the priority of a twitter account: while they have toots to
+    send, `t2m all` sends that many toots of the account for each toot
+    of the accounts of priority 1, the default.
+
+    """
+    if int(priority) < 1:
+        print("ERROR: the priority must be at least 1", file=sys.stderr)
+        sys.exit(1)
+    get_storage().set_priority(twitter_handle, int(priority))
     print("done")
 
 
 def list():
     "List known twitter accounts, which tweets can be forwarded to Mastodon."
-    db = _get_db()
-    for i in db:
-        print(" *", i)
+    for twitter_handle, _ in get_storage().accounts():
+        print(" *", twitter_handle)
+
+
+def migrate():
+    """Migrate the "db.json" database to a SQLite one, "db.sqlite".
+
+    Once done, "db.json" is renamed to "db.json.migrated" and all the
+    commands use "db.sqlite".
+
+    """
+    if not os.path.exists("db.json"):
+        print("ERROR: there is no db.json database to migrate",
+              file=sys.stderr)
+        sys.exit(1)
+    if os.path.exists("db.sqlite"):
+        print("ERROR: db.sqlite already exists", file=sys.stderr)
+        sys.exit(1)
+
+    db = _migrate_storage("db.json", "db.sqlite")
+    print("Migrated %s accounts to db.sqlite" % len(db))
 
 
 def main():
@@ -485,7 +1902,8 @@ def main():
         sys.exit(1)
 
     parser = argh.ArghParser()
-    parser.add_commands([one, all, add, list])
+    parser.add_commands([one, backfill, all, daemon, add, priority, list,
+                         migrate])
     parser.dispatch()
 
 
@@ -0,0 +1,481 @@
+"""Asyncio forwarding engine, selected with `t2m all --engine asyncio`.
+
+Accounts are forwarded the same way as by `t2m._forward`, reusing its
+toot building logic and database, but all the HTTP requests (timeline
+fetches, media transfers and status posts) go through a single aiohttp
+session, so that a single thread keeps many accounts in flight.
+
+This module requires Python 3.5 or later and aiohttp (installed with
+the "async" extra).
+
+"""
+
+import sys
+import time
+import asyncio
+import tempfile
+import calendar
+import functools
+import traceback
+
+from urllib.parse import urlencode, urlparse
+
+import aiohttp
+import dateutil.parser
+import twitter
+import yaml
+
+from oauthlib.oauth1 import Client as OAuth1Client
+
+import t2m
+
+from t2m import media, metrics, statuses
+from t2m.ratelimit import endpoint_family, get_rate_limiter
+
+TIMELINE_URL = "https://api.twitter.com/1.1/statuses/user_timeline.json"
+
+
+class NotFound(AssertionError):
+    "Raised when a Mastodon instance does not know a requested endpoint."
+
+
+def forward_all(db, twitter_handles, workers=100, **kwargs):
+    """Forward the tweets of `twitter_handles`, keeping up to `workers`
+    accounts in flight.
+
+    `db` is modified as `t2m._forward` does, and the other keyword
+    arguments are the ones of `AsyncForwarder.forward`.
+
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(
+            _forward_all(db, twitter_handles, int(workers), **kwargs))
+    finally:
+        loop.close()
+
+
+async def _forward_all(db, twitter_handles, workers, **kwargs):
+    with open("conf.yaml") as fobj:
+        twitter_conf = yaml.safe_load(fobj)
+
+    semaphore = asyncio.Semaphore(workers)
+    connector = aiohttp.TCPConnector(limit=workers)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        forwarder = AsyncForwarder(session, twitter_conf)
+
+        async def forward(twitter_handle):
+            async with semaphore:
+                try:
+                    await forwarder.forward(db, twitter_handle,
+                                            db[twitter_handle]["mastodon"],
+                                            **kwargs)
+                except Exception as e:
+                    traceback.print_exc()
+                    print("ERROR: could not forward the tweets of %s"
+                          " because '%s'" % (twitter_handle, e),
+                          file=sys.stderr)
+
+        await asyncio.gather(*[forward(twitter_handle)
+                               for twitter_handle in twitter_handles])
+
+
+def _in_executor(function, *args, **kwargs):
+    """Call `function` with the given arguments in the default executor
+    of the event loop, so that its disk I/O (database records, media
+    cache accesses) does not hold the other accounts.
+
+    """
+    return asyncio.get_event_loop().run_in_executor(
+        None, functools.partial(function, *args, **kwargs))
+
+
+def _update_rate_limiter(limiter, headers):
+    "Feed `limiter` with the rate limit `headers` of a Mastodon response."
+    if "X-RateLimit-Remaining" not in headers:
+        return
+    reset = dateutil.parser.parse(headers["X-RateLimit-Reset"])
+    limiter.update(int(headers["X-RateLimit-Remaining"]),
+                   calendar.timegm(reset.utctimetuple()))
+
+
+class AsyncForwarder(object):
+    """Forwarder sending all its requests through the aiohttp `session`,
+    and authenticating to Twitter with the credentials of
+    `twitter_conf` (the content of conf.yaml).
+
+    """
+
+    def __init__(self, session, twitter_conf):
+        self.session = session
+        self.oauth = OAuth1Client(
+            twitter_conf["consumer_key"],
+            client_secret=twitter_conf["consumer_secret"],
+            resource_owner_key=twitter_conf["access_token_key"],
+            resource_owner_secret=twitter_conf["access_token_secret"])
+        self.mastodon_accounts = {}
+
+    async def forward(self, db, twitter_handle, mastodon_handle,
+                      retweets=False, debug=False, wait_seconds=None,
+                      strip_trailing_url=False):
+        """Forward the tweets of `twitter_handle` to `mastodon_handle`.
+
+        See the `t2m._forward` function for the parameters.
+
+        """
+        with t2m._db_lock:
+            account = db.setdefault(twitter_handle, {})
+        targets, done = t2m._targets(db, twitter_handle, mastodon_handle)
+        for target in targets:
+            t2m._check_complete_mastodon_handle(target["mastodon"],
+                                                twitter_handle)
+
+        forwarded = 0
+        if not debug:
+            forwarded = sum(await asyncio.gather(*[
+                self.send_outbox(db, twitter_handle, target)
+                for target in targets]))
+
+        since_id = account.get("since_id")
+        with metrics.timed("fetch", account=twitter_handle):
+            timeline = await self.fetch_timeline(twitter_handle,
+                                                 since_id=since_id)
+        if not debug:
+            t2m._record_gap(account, twitter_handle, timeline, since_id)
+        to_toot = t2m._iter_toots(None, twitter_handle,
+                                  done=done, retweets=retweets,
+                                  strip_trailing_url=strip_trailing_url,
+                                  timeline=timeline)
+
+        collected = []
+        attempted = False
+        for toot in to_toot:
+            collected.append(toot["id"])
+            if debug:
+                print(">>", toot["text"].encode("utf-8"),
+                      " ".join(toot["medias"]))
+                continue
+            trying = [target for target in targets if not target["failed"]]
+            if wait_seconds and attempted and trying:
+                with metrics.timed("sleep", **targets[0]["labels"]):
+                    await asyncio.sleep(float(wait_seconds))
+            attempted = attempted or bool(trying)
+            if len(trying) > 1 and toot["medias"]:
+                await self.prefetch_medias(toot, targets[0]["labels"])
+            forwarded += sum(await asyncio.gather(*[
+                self.send_to_target(db, twitter_handle, target, toot)
+                for target in targets]))
+
+        if not debug:
+            with t2m._db_lock:
+                t2m._update_since_id(account, timeline, [
+                    tweet_id for tweet_id in collected
+                    if any(tweet_id not in target["done"]
+                           for target in targets)])
+
+        if not collected and not forwarded:
+            print("Nothing to do for %s" % twitter_handle)
+        else:
+            print("Forwarded %s tweets from %s to %s"
+                  % (forwarded, twitter_handle,
+                     ", ".join(target["mastodon"] for target in targets)))
+
+        return forwarded
+
+    async def send_to_target(self, db, twitter_handle, target, toot):
+        """Send `toot` to the `target` Mastodon account of
+        `twitter_handle`, and return whether it was sent (see
+        `t2m._send_to_target`).
+
+        """
+        mirror, labels = target["mirror"], target["labels"]
+        with t2m._db_lock:
+            if toot["id"] in t2m.get_target(db, twitter_handle,
+                                            mirror)["done"]:
+                return False
+
+        if target["failed"]:
+            await _in_executor(t2m._defer_toot, db, twitter_handle, toot,
+                               attempts=0, mirror=mirror)
+            return False
+
+        media_ids = {}
+        try:
+            await self.send_toot(target["mastodon"], toot, labels,
+                                 media_ids)
+        except t2m.MediaProcessing:
+            print("[forwarding] %s is still processing the videos of the"
+                  " tweet [%s], sending it later"
+                  % (target["mastodon"], toot["id"]))
+            metrics.count("media_processing", **labels)
+            await _in_executor(t2m._defer_toot, db, twitter_handle, toot,
+                               media_ids, mirror=mirror)
+            return False
+        except Exception as e:
+            traceback.print_exc()
+            print("ERROR: could not forward the tweet [%s] '%s' to %s "
+                  "because '%s', sending it again later"
+                  % (toot["id"], toot["text"], target["mastodon"], e),
+                  file=sys.stderr)
+            metrics.count("errors", **labels)
+            await _in_executor(t2m._defer_toot, db, twitter_handle, toot,
+                               media_ids, mirror=mirror)
+            target["failed"] = True
+            return False
+
+        metrics.count("forwarded", **labels)
+        print("[forwarding] >>",
+              toot["text"].encode("utf-8"),
+              " ".join(toot["medias"]))
+        await _in_executor(t2m._mark_done, db, twitter_handle, toot["id"],
+                           mirror=mirror)
+        return True
+
+    async def prefetch_medias(self, toot, labels=None):
+        """Download the medias of `toot` to the media cache, once for all
+        its targets (see `t2m._prefetch_medias`).
+
+        """
+        cache = media.get_cache()
+
+        async def prefetch(url):
+            cached = await _in_executor(cache.open, url)
+            if cached is None:
+                with metrics.timed("download", **(labels or {})):
+                    cached = await self.download(url)
+                await _in_executor(cache.put, url, *cached)
+            cached[0].close()
+        try:
+            await asyncio.gather(*[prefetch(url) for url in toot["medias"]])
+        except Exception as e:
+            print("WARNING: could not download the medias of the tweet [%s]"
+                  " because '%s'" % (toot["id"], e), file=sys.stderr)
+
+    async def fetch_timeline(self, twitter_handle, since_id=None,
+                             max_tweets=200):
+        """Return the last statuses of `twitter_handle`, most recent
+        first (see `t2m._fetch_timeline`).
+
+        """
+        if since_id is not None:
+            try:
+                return await self._fetch_timeline(twitter_handle, max_tweets,
+                                                  since_id)
+            except twitter.TwitterError as e:
+                print("WARNING: could not fetch tweets of %s since %s"
+                      " because '%s', fetching the last %s tweets instead"
+                      % (twitter_handle, since_id, e, max_tweets),
+                      file=sys.stderr)
+
+        return await self._fetch_timeline(twitter_handle, max_tweets)
+
+    async def _fetch_timeline(self, twitter_handle, max_tweets,
+                              since_id=None):
+        params = [("screen_name", twitter_handle), ("count", max_tweets),
+                  ("tweet_mode", "extended")]
+        if since_id is not None:
+            params.append(("since_id", since_id))
+
+        url, headers, _ = self.oauth.sign(
+            TIMELINE_URL + "?" + urlencode(params))
+        async with self.session.get(url, headers=headers) as response:
+            data = await response.json()
+            if response.status != 200:
+                raise twitter.TwitterError(data)
+        return [statuses.Status.from_json(x) for x in data]
+
+    async def send_outbox(self, db, twitter_handle, target):
+        """Send again the toots of the outbox of the `target` of
+        `twitter_handle` which are due, and return the number of sent
+        toots (see `t2m._send_outbox`).
+
+        """
+        mirror, labels = target["mirror"], target["labels"]
+        forwarded = 0
+        for entry in t2m._due_outbox(db, twitter_handle, mirror=mirror):
+            toot, media_ids = entry["toot"], dict(entry["media_ids"])
+            try:
+                await self.send_toot(target["mastodon"], toot, labels,
+                                     media_ids)
+            except t2m.MediaProcessing:
+                metrics.count("media_processing", **labels)
+                await _in_executor(t2m._defer_toot, db, twitter_handle,
+                                   toot, media_ids, entry["attempts"] + 1,
+                                   entry["created"], mirror)
+                continue
+            except Exception as e:
+                print("ERROR: could not forward the tweet [%s] '%s' because"
+                      " '%s' (attempt %s), sending it again later"
+                      % (toot["id"], toot["text"], e, entry["attempts"] + 1),
+                      file=sys.stderr)
+                metrics.count("errors", **labels)
+                await _in_executor(t2m._defer_toot, db, twitter_handle,
+                                   toot, media_ids, entry["attempts"] + 1,
+                                   entry["created"], mirror)
+                target["failed"] = True
+                return forwarded
+
+            forwarded += 1
+            metrics.count("forwarded", **labels)
+            print("[forwarding] >>", toot["text"].encode("utf-8"),
+                  " ".join(toot["medias"]))
+            await _in_executor(t2m._update_outbox, db, twitter_handle,
+                               toot["id"], None, mirror=mirror)
+        return forwarded
+
+    async def send_toot(self, mastodon_handle, toot, labels=None,
+                        media_ids=None):
+        """Send a toot given its description in the `toot` parameter to
+        `mastodon_handle` (see `t2m._send_toot`).
+
+        """
+        cache = media.get_cache()
+        labels = labels or {}
+        media_ids = {} if media_ids is None else media_ids
+
+        async def upload(url):
+            if url in media_ids:
+                if media.is_video(media.describe(url, {})[0]):
+                    # uploaded by a previous attempt, maybe not processed
+                    await self.wait_processed(mastodon_handle,
+                                              media_ids[url], labels)
+                return
+            cached = await _in_executor(cache.open, url)
+            if cached is None:
+                with metrics.timed("download", **labels):
+                    cached = await self.download(url)
+                await _in_executor(cache.put, url, *cached)
+            media_file, mime_type, file_name = cached
+            with media_file:
+                metrics.count("media_bytes", media.size(media_file),
+                              **labels)
+
+                def form():
+                    media_file.seek(0)
+                    data = aiohttp.FormData()
+                    data.add_field("file", media_file, content_type=mime_type,
+                                   filename=file_name)
+                    return {"data": data}
+                # videos are processed asynchronously by the instance
+                video = media.is_video(mime_type)
+                with metrics.timed("upload", **labels):
+                    try:
+                        media_post = await self.mastodon_request(
+                            mastodon_handle,
+                            "/api/v2/media" if video else "/api/v1/media",
+                            form)
+                    except NotFound:
+                        if not video:
+                            raise
+                        # older instances only upload synchronously
+                        media_post = await self.mastodon_request(
+                            mastodon_handle, "/api/v1/media", form)
+            media_ids[url] = media_post["id"]
+            if video and media_post.get("url") is None:
+                await self.wait_processed(mastodon_handle, media_post["id"],
+                                          labels)
+
+        await asyncio.gather(*[upload(url) for url in toot["medias"]])
+        with metrics.timed("status_post", **labels):
+            await self.mastodon_request(
+                mastodon_handle, "/api/v1/statuses",
+                lambda: {"json": {"status": toot["text"],
+                                  "media_ids": [media_ids[url] for url
+                                                in toot["medias"]],
+                                  "spoiler_text": toot["content_warning"]}})
+
+    async def wait_processed(self, mastodon_handle, media_id, labels=None):
+        """Wait up to `t2m.MEDIA_PROCESSING_WAIT` seconds for the instance
+        of `mastodon_handle` to process the media `media_id`, and raise
+        `t2m.MediaProcessing` if it is still processing it (see
+        `t2m._wait_processed`). The other toots go on meanwhile.
+
+        """
+        deadline = time.time() + t2m.MEDIA_PROCESSING_WAIT
+        with metrics.timed("processing", **(labels or {})):
+            while True:
+                try:
+                    processed = await self.mastodon_request(
+                        mastodon_handle, "/api/v1/media/%s" % media_id,
+                        lambda: {}, method="GET")
+                except NotFound:
+                    # uploaded synchronously to an older instance
+                    return
+                if processed.get("url") is not None:
+                    return
+                if time.time() >= deadline:
+                    raise t2m.MediaProcessing([media_id])
+                await asyncio.sleep(t2m.MEDIA_POLL_INTERVAL)
+
+    async def download(self, url):
+        """Return the (file, mime type, file name) of the media at `url`
+        (see `t2m.media.download`).
+
+        """
+        if urlparse(url).scheme not in ("http", "https"):
+            return await _in_executor(media.download, url)
+
+        media_file = tempfile.SpooledTemporaryFile(max_size=media.SPOOL_SIZE)
+        try:
+            async with self.session.get(url) as response:
+                response.raise_for_status()
+                async for chunk in response.content.iter_chunked(
+                        media.CHUNK_SIZE):
+                    media_file.write(chunk)
+                media_file.seek(0)
+                return (media_file,) + media.describe(url, response.headers)
+        except Exception:
+            media_file.close()
+            raise
+
+    async def mastodon_request(self, mastodon_handle, path, payload,
+                               method="POST"):
+        """Send a `method` request to the `path` endpoint of the instance
+        of `mastodon_handle` and return the decoded response.
+
+        `payload` returns the keyword arguments of the request (a new
+        one is needed each time the request is sent). Requests are paced
+        by the rate limiter of the instance for their endpoint (see
+        `t2m._rate_limited`).
+        An AssertionError is raised if the instance returns an error,
+        `NotFound` if it does not know the endpoint.
+
+        """
+        base_url, headers = self._mastodon_account(mastodon_handle)
+        limiter = get_rate_limiter(base_url, endpoint_family(method, path))
+        instance = urlparse(base_url).netloc
+        for attempt in range(t2m.RATE_LIMIT_RETRIES + 1):
+            with metrics.timed("rate_limit_wait", instance=instance):
+                await asyncio.sleep(limiter.reserve())
+            async with self.session.request(method, base_url + path,
+                                            headers=headers,
+                                            **payload()) as response:
+                _update_rate_limiter(limiter, response.headers)
+                if response.status == 429:
+                    metrics.count("rate_limit_hits", instance=instance)
+                if (response.status == 429 and
+                        attempt < t2m.RATE_LIMIT_RETRIES):
+                    if "X-RateLimit-Reset" not in response.headers:
+                        # wait at least a minute without a reset time
+                        limiter.update(0, time.time() + 60)
+                    continue
+                data = await response.json()
+                if response.status == 404:
+                    raise NotFound(data)
+                assert response.status < 400, data
+                return data
+
+    def _mastodon_account(self, mastodon_handle):
+        """Return the base URL and the authentication headers of the
+        Mastodon API of `mastodon_handle`.
+
+        """
+        if mastodon_handle not in self.mastodon_accounts:
+            instance = mastodon_handle.split("@", 1)[1]
+            _, access_token = t2m._login_to_mastodon(mastodon_handle)
+            with open(access_token) as fobj:
+                token = fobj.readline().strip()
+            self.mastodon_accounts[mastodon_handle] = (
+                "https://%s" % instance,
+                {"Authorization": "Bearer %s" % token})
+        return self.mastodon_accounts[mastodon_handle]
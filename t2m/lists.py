@@ -0,0 +1,137 @@
+"""Batched fetching of the timelines through a Twitter list.
+
+Fetching the timeline of each account takes one request of the
+per-user timeline rate limit of Twitter, which caps the number of
+accounts t2m can forward. With `t2m all --batch-list <name>`, t2m
+instead keeps the members of a private Twitter list of that name (of
+the Twitter user of conf.yaml) in sync with the accounts of its
+database, and fetches the combined timeline of the list in a few paged
+requests. Its statuses are then dispatched to the accounts by author.
+
+The timeline of a list only goes back a few hundred statuses: the
+accounts which may have more statuses since their last fetch than it
+gives, and the new accounts, are fetched one by one as before.
+
+"""
+
+from t2m import metrics, statuses
+
+# members of a Twitter list, at most
+LIST_MAX_MEMBERS = 5000
+# members added or removed per request
+MEMBERS_BATCH = 100
+# statuses of the timeline of a list given by Twitter, at most
+LIST_MAX_TWEETS = 800
+LIST_PAGE_SIZE = 200
+
+
+def _batches(items, size=MEMBERS_BATCH):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def sync(twitter_client, name, twitter_handles):
+    """Make the `twitter_handles` the members of the private list `name`,
+    created if needed, and return its (id, lowercased member handles)
+    couple.
+
+    Only the first `LIST_MAX_MEMBERS` handles, in alphabetical order,
+    fit in the list. Accounts Twitter refuses to add (suspended ones,
+    for instance) are not members.
+
+    """
+    twitter_list = None
+    for candidate in twitter_client.GetLists():
+        if candidate.name == name:
+            twitter_list = candidate
+            break
+    if twitter_list is None:
+        twitter_list = twitter_client.CreateList(
+            name, mode="private", description="Accounts forwarded by t2m")
+
+    def members():
+        return set(user.screen_name.lower() for user in
+                   twitter_client.GetListMembers(list_id=twitter_list.id))
+
+    wanted = dict((handle.lower(), handle) for handle in twitter_handles)
+    wanted = dict((handle, wanted[handle])
+                  for handle in sorted(wanted)[:LIST_MAX_MEMBERS])
+    current = members()
+    added = [wanted[handle] for handle in sorted(set(wanted) - current)]
+    removed = sorted(current - set(wanted))
+    for batch in _batches(removed):
+        twitter_client.DestroyListsMember(list_id=twitter_list.id,
+                                          screen_name=batch)
+    for batch in _batches(added):
+        twitter_client.CreateListsMember(list_id=twitter_list.id,
+                                         screen_name=batch)
+    if added or removed:
+        current = members()
+    return twitter_list.id, current
+
+
+def fetch(twitter_client, list_id, since_id=None, max_tweets=LIST_MAX_TWEETS):
+    """Return the statuses of the timeline of the `list_id` list more
+    recent than the `since_id` tweet, most recent first, up to
+    `max_tweets` of them.
+
+    """
+    timeline = []
+    max_id = None
+    while len(timeline) < max_tweets:
+        kwargs = {"list_id": list_id, "count": LIST_PAGE_SIZE}
+        if since_id is not None:
+            kwargs["since_id"] = since_id
+        if max_id is not None:
+            # max_id is included by Twitter
+            kwargs["max_id"] = max_id - 1
+        with metrics.timed("fetch", account="list"):
+            page = statuses.list_timeline(twitter_client, **kwargs)
+        if not page:
+            break
+        timeline.extend(page)
+        max_id = min(status.id for status in page)
+    return timeline[:max_tweets]
+
+
+def timelines(twitter_client, name, since_ids, max_tweets=LIST_MAX_TWEETS):
+    """Return the {twitter handle: timeline} dict of the accounts of the
+    `since_ids` {twitter handle: since_id} dict, fetched from the `name`
+    list (see `sync`), most recent first, and the most recent tweet id
+    of the timeline of the list (None if it is empty).
+
+    The accounts missing from the dict must be fetched one by one: the
+    ones not yet fetched (without since_id), the ones which are not
+    members of the list, and the ones which may have more statuses
+    since their since_id than the `max_tweets` the list gives.
+
+    The timelines of the accounts of the dict are complete up to this
+    most recent tweet id, even when they are empty: their since_id can
+    be moved to it, so that quiet accounts do not hold the since_id of
+    the next fetches of the list.
+
+    """
+    list_id, members = sync(twitter_client, name, since_ids)
+    accounts = dict((handle.lower(), handle) for handle in since_ids
+                    if handle.lower() in members and
+                    since_ids[handle] is not None)
+    if not accounts:
+        return {}, None
+
+    since_id = min(since_ids[handle] for handle in accounts.values())
+    timeline = fetch(twitter_client, list_id, since_id, max_tweets)
+    # the list gave all the statuses since `since_id`, or the ones
+    # since `oldest` only
+    oldest = newest = None
+    if timeline:
+        newest = max(status.id for status in timeline)
+    if len(timeline) >= max_tweets:
+        oldest = min(status.id for status in timeline)
+
+    result = dict((handle, []) for handle in accounts.values()
+                  if oldest is None or since_ids[handle] >= oldest)
+    for status in timeline:
+        handle = accounts.get(status.user.screen_name.lower())
+        if handle in result and status.id > since_ids[handle]:
+            result[handle].append(status)
+    return result, newest
@@ -0,0 +1,321 @@
+"""Transfer of the medias attached to the forwarded tweets."""
+
+import os
+import io
+import json
+import shutil
+import hashlib
+import tempfile
+import posixpath
+import mimetypes
+import threading
+
+from contextlib import closing
+from multiprocessing.pool import ThreadPool
+
+try:
+    from urllib2 import urlopen
+    from urlparse import urlparse
+except ImportError:
+    from urllib.request import urlopen
+    from urllib.parse import urlparse
+
+from t2m import metrics
+from t2m.sessions import get_session
+
+# number of medias transferred concurrently
+MEDIA_WORKERS = 4
+
+# timeout (in seconds) of media downloads
+DOWNLOAD_TIMEOUT = 60
+
+# size (in bytes) of the chunks of media downloads, and size above which
+# a downloaded media is spooled to disk instead of being kept in memory
+CHUNK_SIZE = 64 * 1024
+SPOOL_SIZE = 1024 * 1024
+
+# directory and maximum size (in bytes) of the media cache
+MEDIA_CACHE_DIR = "media_cache"
+MEDIA_CACHE_SIZE = 256 * 1024 * 1024
+
+_pool = None
+_pool_lock = threading.Lock()
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(path=MEDIA_CACHE_DIR):
+    "Return the `MediaCache` stored in the `path` directory."
+    key = os.path.abspath(path)
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = MediaCache(path)
+        return _caches[key]
+
+
+def download(url, cache=None, labels=None):
+    """Return the (file, mime type, file name) of the media at `url`.
+
+    The content is streamed in chunks to a temporary file, kept in
+    memory while it is small, which is to be closed by the caller. The
+    mime type is guessed from the URL, and taken from the response
+    headers when it cannot be. HTTP downloads use the keep-alive session
+    of their host (see `t2m.sessions`).
+
+    If a `MediaCache` is given as `cache`, the media is only downloaded
+    when it is not already in it, and it is added to it afterwards.
+
+    Downloads are timed with the given metrics `labels` (see
+    `t2m.metrics`).
+
+    """
+    if cache is not None:
+        cached = cache.open(url)
+        if cached is not None:
+            return cached
+
+    media_file = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    try:
+        with metrics.timed("download", **(labels or {})):
+            if urlparse(url).scheme in ("http", "https"):
+                response = get_session(url).get(
+                    url, timeout=DOWNLOAD_TIMEOUT, stream=True)
+                with closing(response):
+                    response.raise_for_status()
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        media_file.write(chunk)
+                    headers = response.headers
+            else:
+                with closing(urlopen(url)) as response:
+                    shutil.copyfileobj(response, media_file, CHUNK_SIZE)
+                    headers = response.info()
+
+        mime_type, file_name = describe(url, headers)
+        media_file.seek(0)
+        if cache is not None:
+            cache.put(url, media_file, mime_type, file_name)
+            media_file.seek(0)
+    except Exception:
+        media_file.close()
+        raise
+    return media_file, mime_type, file_name
+
+
+def describe(url, headers):
+    """Return the (mime type, file name) of the media downloaded from
+    `url`, given the `headers` of the response.
+
+    """
+    mime_type = mimetypes.guess_type(urlparse(url).path)[0]
+    if mime_type is None:
+        mime_type = headers.get(
+            "Content-Type", "application/octet-stream").split(";")[0]
+    return mime_type, posixpath.basename(urlparse(url).path)
+
+
+def is_video(mime_type):
+    "Return whether medias of `mime_type` are processed as videos."
+    return mime_type.startswith("video/")
+
+
+def size(media_file):
+    "Return the size (in bytes) of the content of `media_file`."
+    position = media_file.tell()
+    media_file.seek(0, os.SEEK_END)
+    try:
+        return media_file.tell()
+    finally:
+        media_file.seek(position)
+
+
+def transfer(urls, upload, cache=None, labels=None):
+    """Download the medias at `urls` concurrently, calling `upload` with
+    the URL, file, mime type and file name of each one as soon as it
+    is downloaded, and return the results of the `upload` calls, in the
+    order of `urls`. The files are closed once uploaded.
+
+    See `download` for the `cache` and `labels` parameters.
+
+    """
+    def download_and_upload(url):
+        media_file, mime_type, file_name = download(url, cache=cache,
+                                                    labels=labels)
+        with closing(media_file):
+            return upload(url, media_file, mime_type, file_name)
+
+    if len(urls) < 2:
+        return [download_and_upload(url) for url in urls]
+    return _get_pool().map(download_and_upload, urls)
+
+
+def _get_pool():
+    "Return the pool of threads shared by all the media transfers."
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(MEDIA_WORKERS)
+        return _pool
+
+
+class MediaCache(object):
+    """Content-addressed on-disk cache of downloaded medias, shared by
+    all the accounts.
+
+    Each content is stored once in the "objects" subdirectory of `path`,
+    named after its SHA-256 hash. The "urls" subdirectory maps the SHA-1
+    hash of each URL to the hash, mime type and file name of its
+    content, so that a media is not downloaded again, and that the
+    same media found at several URLs is stored once.
+
+    Once the contents take more than `max_size` bytes, the least
+    recently used ones are evicted, along with the URLs mapped to them.
+    The `hits` and `misses` counters tell how useful the cache is.
+
+    """
+
+    def __init__(self, path=MEDIA_CACHE_DIR, max_size=MEDIA_CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.size = None
+        self.lock = threading.Lock()
+        for directory in ("objects", "urls"):
+            if not os.path.isdir(os.path.join(path, directory)):
+                os.makedirs(os.path.join(path, directory))
+
+    def get(self, url):
+        "Return the cached (content, mime type, file name) of `url`, or None."
+        cached = self.open(url)
+        if cached is None:
+            return None
+        with closing(cached[0]) as fobj:
+            return (fobj.read(),) + cached[1:]
+
+    def open(self, url):
+        """Return the cached (file, mime type, file name) of `url`, or
+        None. The file is to be closed by the caller.
+
+        """
+        url_path = self._url_path(url)
+        try:
+            with open(url_path) as fobj:
+                entry = json.load(fobj)
+            object_path = self._object_path(entry["hash"])
+            media_file = open(object_path, "rb")
+        except (IOError, OSError, ValueError):
+            if os.path.exists(url_path):
+                # its content was evicted meanwhile
+                self._remove(url_path)
+            with self.lock:
+                self.misses += 1
+            return None
+
+        # the modification time of contents tells the least recently
+        # used ones, the content may be evicted meanwhile but is open
+        try:
+            os.utime(object_path, None)
+        except OSError:
+            pass
+        with self.lock:
+            self.hits += 1
+        return media_file, entry["mime_type"], entry["file_name"]
+
+    def put(self, url, content, mime_type, file_name):
+        """Add the `content` of `url` to the cache, given as bytes or as
+        a file, which is read in chunks.
+
+        """
+        if isinstance(content, bytes):
+            content = io.BytesIO(content)
+
+        objects = os.path.join(self.path, "objects")
+        fd, tmp_path = tempfile.mkstemp(prefix=".", dir=objects)
+        content_hash, added = hashlib.sha256(), 0
+        with os.fdopen(fd, "wb") as fobj:
+            for chunk in iter(lambda: content.read(CHUNK_SIZE), b""):
+                content_hash.update(chunk)
+                fobj.write(chunk)
+                added += len(chunk)
+
+        content_hash = content_hash.hexdigest()
+        object_path = self._object_path(content_hash)
+        if os.path.exists(object_path):
+            os.remove(tmp_path)
+            added = 0
+        else:
+            os.rename(tmp_path, object_path)
+        self._write(self._url_path(url), json.dumps({
+            "hash": content_hash,
+            "mime_type": mime_type,
+            "file_name": file_name,
+        }).encode("utf-8"))
+
+        with self.lock:
+            if self.size is None:
+                self.size = sum(size for _, size, _ in self._objects())
+            else:
+                self.size += added
+            if self.size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        """Remove the least recently used contents until they take less
+        than 90% of `max_size`, and the URLs mapped to them.
+
+        """
+        self.size = 0
+        evicted = set()
+        objects = sorted(self._objects(), key=lambda o: o[2], reverse=True)
+        for object_path, size, _ in objects:
+            if self.size + size > self.max_size * 0.9:
+                self._remove(object_path)
+                evicted.add(os.path.basename(object_path))
+            else:
+                self.size += size
+        if not evicted:
+            return
+
+        directory = os.path.join(self.path, "urls")
+        for name in os.listdir(directory):
+            url_path = os.path.join(directory, name)
+            try:
+                with open(url_path) as fobj:
+                    content_hash = json.load(fobj)["hash"]
+            except (IOError, OSError, ValueError, KeyError):
+                continue  # being written by `put`
+            if content_hash in evicted:
+                self._remove(url_path)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _objects(self):
+        "Yield the (path, size, modification time) of all the contents."
+        directory = os.path.join(self.path, "objects")
+        for name in os.listdir(directory):
+            if name.startswith("."):
+                continue  # being written by `put`
+            try:
+                stat = os.stat(os.path.join(directory, name))
+            except OSError:
+                continue
+            yield os.path.join(directory, name), stat.st_size, stat.st_mtime
+
+    def _object_path(self, content_hash):
+        return os.path.join(self.path, "objects", content_hash)
+
+    def _url_path(self, url):
+        return os.path.join(self.path, "urls",
+                            hashlib.sha1(url.encode("utf-8")).hexdigest())
+
+    def _write(self, path, content):
+        "Atomically write `content` to `path`."
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as fobj:
+            fobj.write(content)
+        os.rename(tmp_path, path)
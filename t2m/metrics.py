@@ -0,0 +1,209 @@
+"""Instrumentation of the stages of the forwarding of tweets.
+
+The time spent in each stage (Twitter fetches, content warning
+matching, media downloads, uploads and processing, status posts,
+sleeps, rate limit waits and database saves) is recorded with `timed`
+in latency histograms, and the events (forwarded toots, errors,
+medias...) with `count` in counters, both labelled with the Twitter
+account and the Mastodon instance they are about when they are known.
+
+`summary` returns a human readable summary of the run, and
+`write_prometheus` writes all the metrics in the text format of
+Prometheus, for the textfile collector of its node exporter.
+
+"""
+
+import os
+import time
+import tempfile
+import threading
+
+from contextlib import contextmanager
+
+# upper bounds (in seconds) of the buckets of the latency histograms
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+           120, 300)
+
+# stages, in the order of the summary
+STAGES = ("fetch", "content_warning", "download", "upload", "processing",
+          "status_post", "sleep", "rate_limit_wait", "mark_done", "save")
+
+_clock = getattr(time, "monotonic", time.time)
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, v) for k, v in labels.items()
+                              if v is not None))
+
+
+@contextmanager
+def timed(stage, **labels):
+    "Record the time spent in the `with` block as the `stage` stage."
+    start = _clock()
+    try:
+        yield
+    finally:
+        observe(stage, _clock() - start, **labels)
+
+
+def observe(stage, duration, **labels):
+    "Record `duration` seconds spent in the `stage` stage."
+    key = _key(stage, labels)
+    with _lock:
+        if key not in _histograms:
+            _histograms[key] = Histogram()
+        _histograms[key].observe(duration)
+
+
+def count(name, value=1, **labels):
+    "Add `value` to the `name` counter."
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def reset():
+    "Forget all the recorded metrics."
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+
+class Histogram(object):
+    "Latency histogram, with the buckets of `BUCKETS`."
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, duration):
+        for num, bound in enumerate(BUCKETS):
+            if duration <= bound:
+                self.buckets[num] += 1
+                break
+        self.count += 1
+        self.sum += duration
+        self.max = max(self.max, duration)
+
+    def quantile(self, q):
+        "Return the upper bound of the bucket of the `q` quantile."
+        rank, seen = q * self.count, 0
+        for num, bound in enumerate(BUCKETS):
+            seen += self.buckets[num]
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def merge(self, other):
+        for num, value in enumerate(other.buckets):
+            self.buckets[num] += value
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+
+def summary(top=5):
+    """Return the summary of the recorded metrics: the time spent in
+    each stage, the `top` accounts which took the most time, and the
+    counters.
+
+    """
+    with _lock:
+        histograms = dict(_histograms)
+        counters = dict(_counters)
+
+    stages, accounts = {}, {}
+    for (stage, labels), histogram in histograms.items():
+        stages.setdefault(stage, Histogram()).merge(histogram)
+        account = dict(labels).get("account")
+        if account is not None:
+            accounts[account] = accounts.get(account, 0) + histogram.sum
+
+    lines = ["%-16s %8s %10s %9s %9s %9s"
+             % ("stage", "count", "total (s)", "mean (s)", "p95 (s)",
+                "max (s)")]
+    for stage in sorted(stages, key=lambda s: (STAGES + (s,)).index(s)):
+        histogram = stages[stage]
+        lines.append("%-16s %8d %10.2f %9.3f %9.3f %9.3f"
+                     % (stage, histogram.count, histogram.sum,
+                        histogram.sum / histogram.count,
+                        histogram.quantile(0.95), histogram.max))
+
+    if accounts:
+        lines.append("")
+        lines.append("slowest accounts:")
+        for account, total in sorted(accounts.items(),
+                                     key=lambda a: -a[1])[:top]:
+            lines.append("  %-30s %10.2f s" % (account, total))
+
+    totals = {}
+    for (name, _), value in counters.items():
+        totals[name] = totals.get(name, 0) + value
+    if totals:
+        lines.append("")
+        lines.extend("%-24s %d" % (name, value)
+                     for name, value in sorted(totals.items()))
+    return "\n".join(lines)
+
+
+def _format_labels(labels, **extra):
+    labels = sorted(labels + tuple(extra.items()))
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in labels)
+
+
+def prometheus():
+    "Return all the recorded metrics in the text format of Prometheus."
+    with _lock:
+        histograms = sorted(_histograms.items())
+        counters = sorted(_counters.items())
+
+    lines = ["# HELP t2m_stage_seconds Time spent in each stage of t2m.",
+             "# TYPE t2m_stage_seconds histogram"]
+    for (stage, labels), histogram in histograms:
+        cumulated = 0
+        for bound, value in zip(BUCKETS, histogram.buckets):
+            cumulated += value
+            lines.append("t2m_stage_seconds_bucket%s %d" % (_format_labels(
+                labels, stage=stage, le=repr(float(bound))), cumulated))
+        lines.append("t2m_stage_seconds_bucket%s %d" % (_format_labels(
+            labels, stage=stage, le="+Inf"), histogram.count))
+        lines.append("t2m_stage_seconds_sum%s %r" % (
+            _format_labels(labels, stage=stage), histogram.sum))
+        lines.append("t2m_stage_seconds_count%s %d" % (
+            _format_labels(labels, stage=stage), histogram.count))
+
+    names = set()
+    for (name, labels), value in counters:
+        if name not in names:
+            names.add(name)
+            lines.append("# TYPE t2m_%s_total counter" % name)
+        lines.append("t2m_%s_total%s %d" % (name, _format_labels(labels),
+                                            value))
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path):
+    """Write all the recorded metrics to `path`, in the text format of
+    Prometheus.
+
+    The file is written atomically, as required by the textfile
+    collector of the node exporter.
+
+    """
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=os.path.basename(path) + ".",
+        dir=os.path.dirname(os.path.abspath(path)))
+    with os.fdopen(fd, "w") as fobj:
+        fobj.write(prometheus())
+    os.chmod(tmp_path, 0o644)
+    os.rename(tmp_path, path)
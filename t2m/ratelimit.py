@@ -0,0 +1,104 @@
+"""Pacing of the requests sent to Mastodon instances.
+
+Mastodon reports in the X-RateLimit-Remaining and X-RateLimit-Reset
+headers of its responses how many requests are still allowed until
+the rate limit window resets. Mastodon.py keeps the last reported
+values as the `ratelimit_remaining` and `ratelimit_reset` attributes of
+its clients, which feed a `RateLimiter` shared by all the accounts of
+the same instance.
+
+Mastodon counts the media uploads apart from the other requests (30
+every 30 minutes by default), and reports this limit in the responses
+to the uploads: they have their own `RateLimiter` (see
+`endpoint_family`), so that they do not slow down the status posts.
+
+"""
+
+import time
+import threading
+
+MEDIA_PATHS = ("/api/v1/media", "/api/v2/media")
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def endpoint_family(method, path):
+    """Return the family of the rate limits of a `method` request to the
+    `path` endpoint: "media" for the media uploads, None for the
+    other requests.
+
+    """
+    if method == "POST" and path in MEDIA_PATHS:
+        return "media"
+    return None
+
+
+def get_rate_limiter(instance, family=None):
+    """Return the `RateLimiter` shared by all the accounts of `instance`
+    for the requests of `family` (see `endpoint_family`).
+
+    """
+    with _rate_limiters_lock:
+        if (instance, family) not in _rate_limiters:
+            _rate_limiters[instance, family] = RateLimiter()
+        return _rate_limiters[instance, family]
+
+
+class RateLimiter(object):
+    """Token bucket holding the requests an instance still allows.
+
+    The bucket is refilled by `update` with the `remaining` requests
+    reported by the instance until the `reset` timestamp. `acquire`
+    takes one of them, spreading them evenly until `reset`, and waits
+    for `reset` once the bucket is empty. Until the instance reports
+    anything, or once `reset` is over, requests are not delayed.
+
+    The `clock` and `sleep` functions default to `time.time` and
+    `time.sleep`.
+
+    """
+
+    def __init__(self, clock=None, sleep=None):
+        self.clock = clock
+        self.sleep = sleep
+        self.remaining = None
+        self.reset = None
+        self.next_slot = 0
+        self.lock = threading.Lock()
+
+    def update(self, remaining, reset):
+        "Record the last `remaining` and `reset` values of the instance."
+        with self.lock:
+            self.remaining = remaining
+            self.reset = reset
+
+    def acquire(self):
+        "Wait until a request can be sent to the instance."
+        delay = self.reserve()
+        if delay > 0:
+            (self.sleep or time.sleep)(delay)
+
+    def reserve(self):
+        """Book the next request slot of the instance, and return the
+        number of seconds to wait for it.
+
+        """
+        with self.lock:
+            now = (self.clock or time.time)()
+            if self.reset is None or self.reset <= now:
+                self.remaining = self.reset = None
+                interval = 0
+            elif self.remaining <= 0:
+                interval = 0
+                self.next_slot = max(self.next_slot, self.reset)
+            else:
+                interval = (self.reset - now) / float(self.remaining)
+                self.remaining -= 1
+
+            # book the slot while holding the lock, so that concurrent
+            # callers get the next ones
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + interval
+
+        return slot - now
@@ -0,0 +1,134 @@
+"""Fair share of the sending of toots between accounts.
+
+`t2m all` renders the pending toots of every account into a queue per
+account, and a `Scheduler` interleaves them: a large backlog (after an
+outage, for instance) is sent along with the toots of the other
+accounts instead of before them.
+
+The next queue is chosen by smooth weighted round-robin, as nginx does
+for its upstreams: each account gets its `weight` (its priority, 1 by
+default) worth of turns per round, and its turns are spread over the
+round instead of being taken in a row.
+
+"""
+
+import time
+import threading
+
+from collections import OrderedDict
+
+from t2m import metrics
+
+
+class Scheduler(object):
+    """Weighted round-robin over per-account queues of items.
+
+    Queues are added with `add`, as iterables which are only consumed
+    when an item of the account is about to be processed, so that the
+    toots are rendered as late as possible.
+
+    `take` returns the next (key, item) couple to process. The account
+    is then busy, and none of its other items is returned until it is
+    `release`d, so that the toots of an account are sent in order even
+    with several threads taking items concurrently. Once released, an
+    account waits its `interval` (the `wait_seconds` of t2m) before its
+    next item, while the items of the other accounts go on.
+
+    The `clock` function defaults to `time.time`.
+
+    """
+
+    def __init__(self, clock=None):
+        self.clock = clock
+        self.queues = OrderedDict()
+        self.weights = {}
+        self.intervals = {}
+        self.current = {}
+        self.ready_at = {}
+        self.busy = set()
+        self.condition = threading.Condition()
+
+    def add(self, key, items, weight=1, interval=0):
+        """Add the `items` of the `key` account, taking `weight` turns per
+        round, and waiting `interval` seconds between two of its items.
+
+        """
+        with self.condition:
+            self.queues[key] = iter(items)
+            self.weights[key] = max(int(weight), 1)
+            self.intervals[key] = float(interval or 0)
+            self.current[key] = 0
+            self.ready_at[key] = 0
+            self.condition.notify_all()
+
+    def take(self):
+        """Return the (key, item) couple of the next item to process,
+        waiting for an account to be ready if needed, or None once all
+        the queues are drained.
+
+        The account of the item is busy until it is `release`d.
+
+        """
+        while True:
+            with self.condition:
+                while True:
+                    if not self.queues:
+                        return None
+                    now = (self.clock or time.time)()
+                    key = self._pick(now)
+                    if key is not None:
+                        break
+                    # every account is busy, or waits its interval
+                    ready_at = [self.ready_at[key] for key in self.queues
+                                if key not in self.busy]
+                    timeout = min(ready_at) - now if ready_at else None
+                    with metrics.timed("sleep"):
+                        self.condition.wait(timeout)
+                self.busy.add(key)
+                queue = self.queues[key]
+
+            # consumed out of the lock: it renders the toot
+            try:
+                return key, next(queue)
+            except StopIteration:
+                self._remove(key)
+            except Exception:
+                self._remove(key)
+                raise
+
+    def release(self, key, wait=True):
+        """Make the `key` account available again, after its `interval`
+        unless `wait` is False (when nothing was actually sent).
+
+        """
+        with self.condition:
+            self.busy.discard(key)
+            if wait and key in self.ready_at:
+                self.ready_at[key] = ((self.clock or time.time)() +
+                                      self.intervals[key])
+            self.condition.notify_all()
+
+    def _pick(self, now):
+        "Return the key of the next account, or None if none is ready."
+        ready = [key for key in self.queues
+                 if key not in self.busy and self.ready_at[key] <= now]
+        if not ready:
+            return None
+
+        total = 0
+        for key in ready:
+            self.current[key] += self.weights[key]
+            total += self.weights[key]
+        # the first added account wins ties
+        key = max(ready, key=lambda key: self.current[key])
+        self.current[key] -= total
+        return key
+
+    def _remove(self, key):
+        "Forget the drained queue of `key`."
+        with self.condition:
+            for values in (self.queues, self.weights, self.intervals,
+                           self.current, self.ready_at):
+                values.pop(key, None)
+            self.busy.discard(key)
+            self.condition.notify_all()
@@ -0,0 +1,37 @@
+"""Keep-alive HTTP sessions, shared by all the clients of the process.
+
+Each host gets its own `requests.Session`, with a pool of connections
+large enough for the threads of t2m, so that the Mastodon clients of
+the same instance and the media downloads from the same host reuse
+their connections instead of doing a new TLS handshake every time.
+
+"""
+
+import threading
+
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+# maximum number of connections kept open to each host
+POOL_SIZE = 16
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(url):
+    "Return the session shared by all the requests to the host of `url`."
+    import requests
+
+    host = urlparse(url).netloc
+    with _sessions_lock:
+        if host not in _sessions:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                    pool_maxsize=POOL_SIZE)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[host] = session
+        return _sessions[host]
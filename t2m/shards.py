@@ -0,0 +1,106 @@
+"""Partition of the accounts between several t2m processes.
+
+The accounts are spread over shards by consistent hashing of their
+Twitter handle (see `HashRing`): changing the number of shards only
+moves a few accounts from one shard to another.
+
+Each `t2m all` or `t2m daemon` process claims a shard with a `Lease`,
+an exclusive lock on a file of a directory shared by the processes
+(over NFS for several hosts), and only forwards the accounts of its
+shard. The lock is released when the process exits, even if it
+crashes, so that the shard can be claimed by the next process.
+
+"""
+
+import os
+import bisect
+import socket
+import hashlib
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# number of points of each shard on the hash ring, spreading the
+# accounts evenly
+VIRTUAL_NODES = 100
+
+
+def _hash(key):
+    return int(hashlib.md5(key.encode("utf-8")).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """Consistent hashing of the Twitter handles over `shards` shards,
+    numbered from 0.
+
+    """
+
+    def __init__(self, shards, virtual_nodes=VIRTUAL_NODES):
+        self.shards = shards
+        self.points = sorted((_hash("%s-%s" % (shard, node)), shard)
+                             for shard in range(shards)
+                             for node in range(virtual_nodes))
+        self.hashes = [point for point, _ in self.points]
+
+    def shard(self, twitter_handle):
+        "Return the shard of `twitter_handle`."
+        index = bisect.bisect(self.hashes, _hash(twitter_handle.lower()))
+        return self.points[index % len(self.points)][1]
+
+
+class Lease(object):
+    """Exclusive lease of the `shard` out of `shards`, held with a lock
+    on a file of `directory`, which tells the host and the process
+    holding it.
+
+    """
+
+    def __init__(self, directory, shard, shards):
+        self.path = os.path.join(directory, "t2m-shard-%s-of-%s.lock"
+                                 % (shard + 1, shards))
+        self.shard = shard
+        self.shards = shards
+        self.fobj = None
+
+    def acquire(self):
+        "Take the lease and return True, or return False if it is held."
+        fobj = open(self.path, "a+")
+        if fcntl is not None:
+            try:
+                fcntl.flock(fobj, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                fobj.close()
+                return False
+        fobj.seek(0)
+        fobj.truncate()
+        fobj.write("%s %s\n" % (socket.gethostname(), os.getpid()))
+        fobj.flush()
+        self.fobj = fobj
+        return True
+
+    def release(self):
+        if self.fobj is not None:
+            self.fobj.close()
+            self.fobj = None
+
+    def holder(self):
+        "Return the \"<host> <pid>\" of the last holder of the lease."
+        try:
+            with open(self.path) as fobj:
+                return fobj.read().strip()
+        except (IOError, OSError):
+            return None
+
+
+def claim(directory, shards):
+    """Return the `Lease` of the first shard out of `shards` not held
+    by another process, or None if they all are.
+
+    """
+    for shard in range(shards):
+        lease = Lease(directory, shard, shards)
+        if lease.acquire():
+            return lease
+    return None
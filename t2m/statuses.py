@@ -0,0 +1,113 @@
+"""Compact statuses, parsed straight from the timeline JSON.
+
+python-twitter builds a `twitter.Status` of dozens of attributes for
+each tweet of a timeline, along with its user, hashtags, mentions and
+so on, and t2m only reads a handful of them. The timelines are instead
+requested as raw JSON, and each tweet is decoded into a small `Status`
+record, with `__slots__`, holding only what the toots are built from:
+its id, text, URLs, medias, retweeted and quoted statuses, and the
+screen name of its author.
+
+"""
+
+TIMELINE_URL = "statuses/user_timeline.json"
+
+
+class User(object):
+    __slots__ = ("screen_name",)
+
+    def __init__(self, screen_name):
+        self.screen_name = screen_name
+
+
+class Url(object):
+    __slots__ = ("url", "expanded_url")
+
+    def __init__(self, url, expanded_url):
+        self.url = url
+        self.expanded_url = expanded_url
+
+
+class Media(object):
+    __slots__ = ("media_url", "type", "video_info")
+
+    def __init__(self, media_url, type=None, video_info=None):
+        self.media_url = media_url
+        self.type = type
+        self.video_info = video_info
+
+
+class Status(object):
+    """The attributes of a tweet t2m uses, named as the ones of
+    `twitter.Status`.
+
+    """
+
+    __slots__ = ("id", "full_text", "urls", "media", "retweeted_status",
+                 "quoted_status", "user")
+
+    def __init__(self, id, full_text, urls=(), media=(), retweeted_status=None,
+                 quoted_status=None, user=None):
+        self.id = id
+        self.full_text = full_text
+        self.urls = urls
+        self.media = media
+        self.retweeted_status = retweeted_status
+        self.quoted_status = quoted_status
+        self.user = user
+
+    @classmethod
+    def from_json(cls, data):
+        "Return the `Status` of the `data` JSON dict of a tweet."
+        # extended tweets of the streaming API
+        data = dict(data, **data.get("extended_tweet", {}))
+        entities = data.get("entities") or {}
+        # the extended entities have all the medias, with their videos
+        medias = (data.get("extended_entities") or entities).get("media", ())
+        retweeted_status = data.get("retweeted_status")
+        quoted_status = data.get("quoted_status")
+        user = data.get("user")
+        return cls(
+            data["id"],
+            data.get("full_text", data.get("text")),
+            [Url(url["url"], url["expanded_url"])
+             for url in entities.get("urls", ())],
+            [Media(media["media_url"], media.get("type"),
+                   media.get("video_info")) for media in medias],
+            retweeted_status and cls.from_json(retweeted_status),
+            quoted_status and cls.from_json(quoted_status),
+            user and User(user.get("screen_name")))
+
+
+def user_timeline(twitter_client, **params):
+    """Return the `Status` list of the statuses/user_timeline request of
+    the `params` (the arguments of `twitter.Api.GetUserTimeline`).
+
+    Clients which are not a `twitter.Api` fall back to their
+    GetUserTimeline method.
+
+    """
+    from twitter.api import Api
+
+    if not isinstance(twitter_client, Api):
+        return twitter_client.GetUserTimeline(**params)
+
+    # the defaults of GetUserTimeline
+    params.setdefault("include_rts", True)
+    params.setdefault("trim_user", False)
+    params.setdefault("exclude_replies", False)
+
+    response = twitter_client._RequestUrl(
+        "%s/%s" % (twitter_client.base_url, TIMELINE_URL), "GET", data=params)
+    data = twitter_client._ParseAndCheckTwitter(
+        response.content.decode("utf-8"))
+    return [Status.from_json(x) for x in data]
+
+
+def list_timeline(twitter_client, **params):
+    """Return the `Status` list of the timeline of a Twitter list, given
+    the `params` of `twitter.Api.GetListTimeline`.
+
+    """
+    return [Status.from_json(x) for x in
+            twitter_client.GetListTimeline(return_json=True, **params)]
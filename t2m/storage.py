@@ -0,0 +1,740 @@
+"""Storage backends for the t2m database.
+
+Whatever the backend, the database is handled in memory as the
+following model:
+
+{
+    <twitter handle>: {
+        "mastodon": <mastodon complete handle>,
+        "done": <set of forwarded tweet ids (integers)>,
+        "since_id": <id of the most recent tweet already handled>,
+        "priority": <turns of the account per round of `t2m all`>,
+        "backfill": [[<since_id>, <max_id>], <windows of missed tweets>],
+        "outbox": {
+            <tweet id>: {
+                "toot": <toot which could not be sent yet>,
+                "media_ids": {<media URL>: <id of the uploaded media>},
+                "attempts": <number of failed attempts>,
+                "next_retry": <timestamp of the next attempt>,
+                "created": <timestamp of the first failed attempt>
+            }
+        },
+        "mirrors": {
+            <mastodon complete handle>: {
+                "done": <set of forwarded tweet ids>,
+                "outbox": <same as above>
+            }
+        }
+    }
+}
+
+The "outbox" key is only present for accounts with toots to send again
+(see `t2m._defer_toot`), and the "priority" key for accounts whose
+priority is not the default one (1, see `t2m.scheduler`). The
+"backfill" key is only present for accounts with missed tweets, still to
+be forwarded by `t2m backfill`. The "mirrors" key holds the other Mastodon
+accounts the tweets are forwarded to, each one with its own "done" set
+and "outbox" (see `get_target`).
+
+Two backends are available: `JsonStorage`, which stores it in a json
+file (the historical "db.json"), and `SqliteStorage`, which stores it
+in a SQLite database where forwarded tweets are indexed rows.
+
+"""
+
+import os
+import json
+import tempfile
+import threading
+
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# keys of an account entry written by the forwarding, the other ones
+# being its configuration
+PROGRESS_KEYS = ("done", "since_id", "backfill", "outbox")
+
+# size (in bytes) above which the database journal is compacted
+JOURNAL_COMPACTION_SIZE = 64 * 1024
+
+JSON_PATH = "db.json"
+SQLITE_PATH = "db.sqlite"
+
+_storages = {}
+
+
+def get_storage(path=None):
+    """Return the storage backend for the database at `path`.
+
+    When `path` is not given, "db.sqlite" is used if it exists, and
+    "db.json" otherwise. Files ending with ".sqlite" are handled by
+    `SqliteStorage`, other ones by `JsonStorage`.
+
+    """
+    if path is None:
+        path = SQLITE_PATH if os.path.exists(SQLITE_PATH) else JSON_PATH
+
+    key = os.path.abspath(path)
+    if key not in _storages:
+        if path.endswith(".sqlite"):
+            _storages[key] = SqliteStorage(path)
+        else:
+            _storages[key] = JsonStorage(path)
+    return _storages[key]
+
+
+def get_target(db, twitter_handle, mirror=None):
+    """Return the dict of `db` holding the "done" set and the "outbox"
+    of the forwarding of `twitter_handle` to its `mirror` Mastodon
+    account, or to its main one if `mirror` is None.
+
+    """
+    account = db.setdefault(twitter_handle, {})
+    if mirror is None:
+        return account
+    return account.setdefault("mirrors", {}).setdefault(mirror, {})
+
+
+def migrate(json_path=JSON_PATH, sqlite_path=SQLITE_PATH):
+    """Copy the json database at `json_path` to a new SQLite database at
+    `sqlite_path`.
+
+    The json file is then renamed with a ".migrated" suffix, so that
+    the SQLite database is picked by `get_storage` from now on.
+
+    """
+    if os.path.exists(sqlite_path):
+        raise ValueError("%s already exists" % sqlite_path)
+
+    db = get_storage(json_path).load()
+    get_storage(sqlite_path).save(db)
+    os.rename(json_path, json_path + ".migrated")
+    if os.path.exists(_journal_path(json_path)):
+        os.remove(_journal_path(json_path))
+    return db
+
+
+def _decode_done(encoded):
+    """Return the set of tweet ids stored as `encoded` in the database.
+
+    Both the sorted delta-encoded form written by `JsonStorage.save`
+    (a {"deltas": [...]} dict) and the plain list of ids of older
+    databases are accepted.
+
+    """
+    if isinstance(encoded, dict):
+        done, tweet_id = set(), 0
+        for delta in encoded["deltas"]:
+            tweet_id += delta
+            done.add(tweet_id)
+        return done
+    return set(encoded)
+
+
+def _encode_done(done):
+    "Return the compact, sorted delta-encoded form of `done` tweet ids."
+    deltas, last_id = [], 0
+    for tweet_id in sorted(done):
+        deltas.append(tweet_id - last_id)
+        last_id = tweet_id
+    return {"deltas": deltas}
+
+
+def _set_outbox(db, twitter_handle, tweet_id, entry, mirror=None):
+    """Set the outbox `entry` of `tweet_id` of `twitter_handle` in `db`,
+    or remove it if `entry` is None (see `get_target` for `mirror`).
+
+    """
+    target = get_target(db, twitter_handle, mirror)
+    outbox = target.setdefault("outbox", {})
+    if entry is None:
+        outbox.pop(tweet_id, None)
+    else:
+        outbox[tweet_id] = entry
+    if not outbox:
+        del target["outbox"]
+
+
+def _set_backfill(db, twitter_handle, windows):
+    """Set the backfill `windows` of `twitter_handle` in `db`, or remove
+    them if there are none left.
+
+    """
+    account = db.setdefault(twitter_handle, {})
+    if windows:
+        account["backfill"] = windows
+    else:
+        account.pop("backfill", None)
+
+
+def _decode_target(target):
+    "Decode in place the \"done\" set and \"outbox\" of json `target`."
+    if "done" in target:
+        target["done"] = _decode_done(target["done"])
+    if "outbox" in target:
+        target["outbox"] = dict((entry["toot"]["id"], entry)
+                                for entry in target["outbox"])
+
+
+def _encode_target(target):
+    "Return `target` with its \"done\" set and \"outbox\" json encoded."
+    if "done" in target:
+        target = dict(target, done=_encode_done(target["done"]))
+    if "outbox" in target:
+        outbox = target["outbox"]
+        target = dict(target, outbox=[outbox[tweet_id]
+                                      for tweet_id in sorted(outbox)])
+    return target
+
+
+def _merge_progress(saved, account):
+    """Return the `saved` entry of an account with the progress of the
+    `account` one: its "done" sets, outboxes, since_id and backfill
+    windows. The configuration of the account (its Mastodon handle,
+    priority and mirrors) is the saved one, which other t2m commands may
+    have changed meanwhile.
+
+    """
+    merged = dict((key, value) for key, value in saved.items()
+                  if key not in PROGRESS_KEYS and key != "mirrors")
+    merged.update((key, value) for key, value in account.items()
+                  if key in PROGRESS_KEYS)
+    mirrors = set(saved.get("mirrors", ())) | set(account.get("mirrors", ()))
+    if mirrors:
+        merged["mirrors"] = dict(
+            (mirror, account.get("mirrors", {}).get(mirror, {}))
+            for mirror in mirrors)
+    return merged
+
+
+def _placeholders(key, extra):
+    "Return the SQL placeholders of a row of `key` and `extra` columns."
+    return ", ".join(["?"] * (len(key) + extra))
+
+
+def _journal_path(path):
+    "Return the path of the journal of the json database at `path`."
+    return path + ".journal"
+
+
+class JsonStorage(object):
+    """Database stored as a json file, and the following model:
+
+    {
+        <twitter handle>: {
+            "mastodon": <mastodon complete handle>,
+            "done": {"deltas": [<sorted tweet ids, delta-encoded>]},
+            "since_id": <id of the most recent tweet already handled>,
+            "priority": <turns of the account per round of `t2m all`>,
+            "backfill": [[<since_id>, <max_id>], ...],
+            "outbox": [<outbox entries, sorted by tweet id>],
+            "mirrors": {
+                <mastodon complete handle>: {
+                    "done": <same as above>,
+                    "outbox": <same as above>
+                }
+            }
+        }
+    }
+
+    The tweets forwarded, the outbox changes and the backfill progress
+    since the last `save` call are recorded in a journal file next to it
+    (see `mark_done`, `update_outbox` and `update_backfill`), which is
+    replayed on top of the snapshot by `load`.
+
+    Saves and journal records are serialized with the other t2m
+    processes by a lock on a "<path>.lock" file. When the process only
+    handles some accounts (see `restrict`), `save` keeps the other ones,
+    and the configuration of its own ones, as they are in the file.
+
+    """
+
+    def __init__(self, path=JSON_PATH):
+        self.path = path
+        self.owns = None
+        self.lock = threading.RLock()
+        self.lock_file = None
+        self.lock_depth = 0
+
+    def restrict(self, owns):
+        """Only save the progress of the accounts for which
+        `owns(twitter_handle)` is true from now on (see `_merge_progress`),
+        the other accounts being handled by other t2m processes (see
+        `t2m.shards`), and the configuration of the accounts by the
+        other t2m commands. The whole database is saved again once
+        `owns` is None.
+
+        """
+        self.owns = owns
+
+    @contextmanager
+    def _locked(self):
+        "Hold the lock of the database, shared with the other processes."
+        with self.lock:
+            if self.lock_depth == 0 and fcntl is not None:
+                self.lock_file = open(self.path + ".lock", "a")
+                fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+            self.lock_depth += 1
+            try:
+                yield
+            finally:
+                self.lock_depth -= 1
+                if self.lock_depth == 0 and self.lock_file is not None:
+                    self.lock_file.close()
+                    self.lock_file = None
+
+    def load(self):
+        "Return the database content."
+        with self._locked():
+            return self._load()
+
+    def _load(self):
+        db = {}
+        if os.path.isfile(self.path):
+            with open(self.path) as fobj:
+                db = json.load(fobj)
+
+        for account in db.values():
+            _decode_target(account)
+            for mirror in account.get("mirrors", {}).values():
+                _decode_target(mirror)
+
+        journal = _journal_path(self.path)
+        if os.path.isfile(journal):
+            with open(journal) as fobj:
+                for line in fobj:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # last record torn by a crash while it was written
+                        continue
+                    if isinstance(record, dict):
+                        if "backfill" in record:
+                            _set_backfill(db, *record["backfill"])
+                        else:
+                            _set_outbox(db, *record["outbox"])
+                        continue
+                    # [twitter handle, tweet id(, mirror)]
+                    get_target(db, *record[:1] + record[2:]).setdefault(
+                        "done", set()).add(record[1])
+        return db
+
+    def save(self, db):
+        """Save the whole `db` (see `restrict`).
+
+        The file is written to a temporary file first and then renamed,
+        so that a crash cannot leave a truncated database behind. The
+        journal is removed afterwards, as its records are now part of
+        the snapshot.
+
+        """
+        with self._locked():
+            if self.owns is not None:
+                # the accounts of the other processes, as they saved them
+                merged = self._load()
+                for twitter_handle, account in db.items():
+                    if not self.owns(twitter_handle):
+                        continue
+                    if twitter_handle in merged:
+                        account = _merge_progress(merged[twitter_handle],
+                                                  account)
+                    merged[twitter_handle] = account
+                db = merged
+            self._save(db)
+
+    def _save(self, db):
+        encoded = {}
+        for twitter_handle, account in db.items():
+            account = _encode_target(account)
+            if "mirrors" in account:
+                account["mirrors"] = dict(
+                    (mirror, _encode_target(target))
+                    for mirror, target in account["mirrors"].items())
+            encoded[twitter_handle] = account
+
+        fd, tmp_path = tempfile.mkstemp(
+            prefix=os.path.basename(self.path) + ".",
+            dir=os.path.dirname(os.path.abspath(self.path)))
+        try:
+            with os.fdopen(fd, "w") as fobj:
+                json.dump(encoded, fobj, indent=4)
+                fobj.flush()
+                os.fsync(fobj.fileno())
+            os.rename(tmp_path, self.path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+        if os.path.exists(_journal_path(self.path)):
+            os.remove(_journal_path(self.path))
+
+    def mark_done(self, db, twitter_handle, tweet_id, mirror=None):
+        """Record in `db` that `tweet_id` of `twitter_handle` was forwarded
+        (to its `mirror` Mastodon account if given, see `get_target`).
+
+        Instead of saving the whole database, a single record is
+        appended to its journal. Once the journal grows beyond
+        `JOURNAL_COMPACTION_SIZE` bytes, it is compacted into the
+        snapshot using `save`.
+
+        """
+        get_target(db, twitter_handle, mirror).setdefault(
+            "done", set()).add(tweet_id)
+        record = [twitter_handle, tweet_id]
+        self._journal(db, record if mirror is None else record + [mirror])
+
+    def update_outbox(self, db, twitter_handle, tweet_id, entry,
+                      mirror=None):
+        """Set the outbox `entry` of `tweet_id` of `twitter_handle` in
+        `db`, or remove it if `entry` is None, recording the change in
+        the journal like `mark_done`.
+
+        """
+        _set_outbox(db, twitter_handle, tweet_id, entry, mirror)
+        self._journal(db, {"outbox": [twitter_handle, tweet_id, entry,
+                                      mirror]})
+
+    def update_backfill(self, db, twitter_handle, windows):
+        """Set the backfill `windows` of `twitter_handle` in `db`, or
+        remove them if there are none left, recording the change in the
+        journal like `mark_done`.
+
+        """
+        _set_backfill(db, twitter_handle, windows)
+        self._journal(db, {"backfill": [twitter_handle, windows]})
+
+    def _journal(self, db, record):
+        """Append `record` to the journal, and compact it into the
+        snapshot once it is too large.
+
+        """
+        journal = _journal_path(self.path)
+        with self._locked():
+            with open(journal, "ab+") as fobj:
+                line = json.dumps(record).encode("utf-8") + b"\n"
+                fobj.seek(0, os.SEEK_END)
+                if fobj.tell():
+                    fobj.seek(-1, os.SEEK_END)
+                    if fobj.read(1) != b"\n":
+                        # the last record was torn by a crash, and is
+                        # skipped by `load`: do not append to it
+                        line = b"\n" + line
+                fobj.write(line)
+                fobj.flush()
+                os.fsync(fobj.fileno())
+
+            if os.path.getsize(journal) > JOURNAL_COMPACTION_SIZE:
+                self.save(db)
+
+    def accounts(self):
+        "Return the list of (twitter handle, mastodon handle) couples."
+        return [(twitter_handle, account.get("mastodon"))
+                for twitter_handle, account in self.load().items()]
+
+    def set_mastodon(self, twitter_handle, mastodon_handle):
+        "Link `twitter_handle` to `mastodon_handle`."
+        with self._locked():
+            db = self.load()
+            db.setdefault(twitter_handle, {})["mastodon"] = mastodon_handle
+            self._save(db)
+
+    def add_mirror(self, twitter_handle, mastodon_handle):
+        "Forward the tweets of `twitter_handle` to `mastodon_handle` too."
+        with self._locked():
+            db = self.load()
+            get_target(db, twitter_handle, mastodon_handle)
+            self._save(db)
+
+    def set_priority(self, twitter_handle, priority):
+        "Set the `priority` of `twitter_handle` (see `t2m.scheduler`)."
+        with self._locked():
+            db = self.load()
+            account = db.setdefault(twitter_handle, {})
+            if priority == 1:
+                account.pop("priority", None)
+            else:
+                account["priority"] = priority
+            self._save(db)
+
+
+class SqliteStorage(object):
+    """Database stored in SQLite, in WAL mode so that several t2m
+    processes can share it.
+
+    Accounts are stored in the "accounts" table, forwarded tweets in
+    the "forwarded" table, indexed by twitter handle and tweet id, and
+    outbox entries as json in the "outbox" table. The mirrors of the
+    accounts are stored in the "mirrors" table, and their forwarded
+    tweets and outbox entries in the "mirror_forwarded" and
+    "mirror_outbox" tables, indexed by mirror too.
+    Saving never removes rows written by other processes, except the
+    forwarded tweets older than the ones kept in memory (see
+    `t2m._prune_done`), and only writes the configuration of the
+    accounts (Mastodon handle and priority) of the new ones, unless the
+    whole database is saved (see `restrict`).
+
+    """
+
+    def __init__(self, path=SQLITE_PATH):
+        import sqlite3
+
+        self.path = path
+        self.owns = None
+        # t2m serializes the accesses of its own threads, see t2m._db_lock
+        self.connection = sqlite3.connect(path, timeout=30,
+                                          check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS accounts ("
+                " twitter_handle TEXT PRIMARY KEY,"
+                " mastodon_handle TEXT,"
+                " since_id INTEGER,"
+                " priority INTEGER,"
+                " backfill TEXT)")
+            columns = [column[1] for column in self.connection.execute(
+                "PRAGMA table_info(accounts)")]
+            # databases created before these columns
+            for column, column_type in (("priority", "INTEGER"),
+                                        ("backfill", "TEXT")):
+                if column not in columns:
+                    self.connection.execute(
+                        "ALTER TABLE accounts ADD COLUMN %s %s"
+                        % (column, column_type))
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS forwarded ("
+                " twitter_handle TEXT NOT NULL,"
+                " tweet_id INTEGER NOT NULL,"
+                " PRIMARY KEY (twitter_handle, tweet_id)"
+                ") WITHOUT ROWID")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS outbox ("
+                " twitter_handle TEXT NOT NULL,"
+                " tweet_id INTEGER NOT NULL,"
+                " entry TEXT NOT NULL,"
+                " PRIMARY KEY (twitter_handle, tweet_id)"
+                ") WITHOUT ROWID")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS mirrors ("
+                " twitter_handle TEXT NOT NULL,"
+                " mirror TEXT NOT NULL,"
+                " PRIMARY KEY (twitter_handle, mirror)"
+                ") WITHOUT ROWID")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS mirror_forwarded ("
+                " twitter_handle TEXT NOT NULL,"
+                " mirror TEXT NOT NULL,"
+                " tweet_id INTEGER NOT NULL,"
+                " PRIMARY KEY (twitter_handle, mirror, tweet_id)"
+                ") WITHOUT ROWID")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS mirror_outbox ("
+                " twitter_handle TEXT NOT NULL,"
+                " mirror TEXT NOT NULL,"
+                " tweet_id INTEGER NOT NULL,"
+                " entry TEXT NOT NULL,"
+                " PRIMARY KEY (twitter_handle, mirror, tweet_id)"
+                ") WITHOUT ROWID")
+
+    def load(self):
+        "Return the database content."
+        db = {}
+        for twitter_handle, mastodon_handle, since_id, priority, backfill in \
+                self.connection.execute(
+                    "SELECT twitter_handle, mastodon_handle, since_id,"
+                    " priority, backfill FROM accounts ORDER BY rowid"):
+            account = db[twitter_handle] = {}
+            if mastodon_handle is not None:
+                account["mastodon"] = mastodon_handle
+            if since_id is not None:
+                account["since_id"] = since_id
+            if priority is not None:
+                account["priority"] = priority
+            if backfill is not None:
+                account["backfill"] = json.loads(backfill)
+
+        for twitter_handle, tweet_id in self.connection.execute(
+                "SELECT twitter_handle, tweet_id FROM forwarded"):
+            db.setdefault(twitter_handle, {}).setdefault(
+                "done", set()).add(tweet_id)
+
+        for twitter_handle, tweet_id, entry in self.connection.execute(
+                "SELECT twitter_handle, tweet_id, entry FROM outbox"):
+            _set_outbox(db, twitter_handle, tweet_id, json.loads(entry))
+
+        for twitter_handle, mirror in self.connection.execute(
+                "SELECT twitter_handle, mirror FROM mirrors"):
+            get_target(db, twitter_handle, mirror)
+        for twitter_handle, mirror, tweet_id in self.connection.execute(
+                "SELECT twitter_handle, mirror, tweet_id"
+                " FROM mirror_forwarded"):
+            get_target(db, twitter_handle, mirror).setdefault(
+                "done", set()).add(tweet_id)
+        for twitter_handle, mirror, tweet_id, entry in \
+                self.connection.execute(
+                    "SELECT twitter_handle, mirror, tweet_id, entry"
+                    " FROM mirror_outbox"):
+            _set_outbox(db, twitter_handle, tweet_id, json.loads(entry),
+                        mirror)
+        return db
+
+    def restrict(self, owns):
+        """Only save the progress of the accounts for which
+        `owns(twitter_handle)` is true from now on (see
+        `JsonStorage.restrict`), or the whole database if `owns` is None.
+
+        """
+        self.owns = owns
+
+    def save(self, db):
+        "Save the whole `db` (see `restrict`), in a single transaction."
+        with self.connection:
+            for twitter_handle, account in db.items():
+                if self.owns is not None and not self.owns(twitter_handle):
+                    continue
+                self.connection.execute(
+                    "INSERT OR IGNORE INTO accounts (twitter_handle,"
+                    " mastodon_handle, priority) VALUES (?, ?, ?)",
+                    (twitter_handle, account.get("mastodon"),
+                     account.get("priority")))
+                if self.owns is None:
+                    self.connection.execute(
+                        "UPDATE accounts SET mastodon_handle = ?,"
+                        " priority = ? WHERE twitter_handle = ?",
+                        (account.get("mastodon"), account.get("priority"),
+                         twitter_handle))
+                self.connection.execute(
+                    "UPDATE accounts SET since_id = ?, backfill = ?"
+                    " WHERE twitter_handle = ?",
+                    (account.get("since_id"),
+                     json.dumps(account["backfill"])
+                     if account.get("backfill") else None,
+                     twitter_handle))
+
+                self._save_target(twitter_handle, None, account)
+                for mirror, target in account.get("mirrors", {}).items():
+                    self._ensure_mirror(twitter_handle, mirror)
+                    self._save_target(twitter_handle, mirror, target)
+
+    def _save_target(self, twitter_handle, mirror, target):
+        "Save the \"done\" set and \"outbox\" of `target` (see `get_target`)."
+        key, where, forwarded, outbox = self._target_tables(twitter_handle,
+                                                            mirror)
+        self.connection.execute("DELETE FROM %s WHERE %s" % (outbox, where),
+                                key)
+        self.connection.executemany(
+            "INSERT INTO %s VALUES (%s)" % (outbox, _placeholders(key, 2)),
+            [key + (tweet_id, json.dumps(entry))
+             for tweet_id, entry in target.get("outbox", {}).items()])
+
+        done = target.get("done")
+        if not done:
+            return
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO %s VALUES (%s)"
+            % (forwarded, _placeholders(key, 1)),
+            [key + (tweet_id,) for tweet_id in done])
+        self.connection.execute(
+            "DELETE FROM %s WHERE %s AND tweet_id < ?" % (forwarded, where),
+            key + (min(done),))
+
+    def mark_done(self, db, twitter_handle, tweet_id, mirror=None):
+        """Record in `db` that `tweet_id` of `twitter_handle` was forwarded
+        (to its `mirror` Mastodon account if given, see `get_target`).
+
+        """
+        get_target(db, twitter_handle, mirror).setdefault(
+            "done", set()).add(tweet_id)
+        key, _, forwarded, _ = self._target_tables(twitter_handle, mirror)
+        with self.connection:
+            self._ensure_account(twitter_handle)
+            self.connection.execute(
+                "INSERT OR IGNORE INTO %s VALUES (%s)"
+                % (forwarded, _placeholders(key, 1)), key + (tweet_id,))
+
+    def update_outbox(self, db, twitter_handle, tweet_id, entry,
+                      mirror=None):
+        """Set the outbox `entry` of `tweet_id` of `twitter_handle` in
+        `db`, or remove it if `entry` is None.
+
+        """
+        _set_outbox(db, twitter_handle, tweet_id, entry, mirror)
+        key, where, _, outbox = self._target_tables(twitter_handle, mirror)
+        with self.connection:
+            self._ensure_account(twitter_handle)
+            if entry is None:
+                self.connection.execute(
+                    "DELETE FROM %s WHERE %s AND tweet_id = ?"
+                    % (outbox, where), key + (tweet_id,))
+            else:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO %s VALUES (%s)"
+                    % (outbox, _placeholders(key, 2)),
+                    key + (tweet_id, json.dumps(entry)))
+
+    def update_backfill(self, db, twitter_handle, windows):
+        """Set the backfill `windows` of `twitter_handle` in `db`, or
+        remove them if there are none left.
+
+        """
+        _set_backfill(db, twitter_handle, windows)
+        with self.connection:
+            self._ensure_account(twitter_handle)
+            self.connection.execute(
+                "UPDATE accounts SET backfill = ? WHERE twitter_handle = ?",
+                (json.dumps(windows) if windows else None, twitter_handle))
+
+    def accounts(self):
+        "Return the list of (twitter handle, mastodon handle) couples."
+        return self.connection.execute(
+            "SELECT twitter_handle, mastodon_handle FROM accounts"
+            " ORDER BY rowid").fetchall()
+
+    def set_mastodon(self, twitter_handle, mastodon_handle):
+        "Link `twitter_handle` to `mastodon_handle`."
+        with self.connection:
+            self._ensure_account(twitter_handle)
+            self.connection.execute(
+                "UPDATE accounts SET mastodon_handle = ?"
+                " WHERE twitter_handle = ?",
+                (mastodon_handle, twitter_handle))
+
+    def add_mirror(self, twitter_handle, mastodon_handle):
+        "Forward the tweets of `twitter_handle` to `mastodon_handle` too."
+        with self.connection:
+            self._ensure_account(twitter_handle)
+            self._ensure_mirror(twitter_handle, mastodon_handle)
+
+    def set_priority(self, twitter_handle, priority):
+        "Set the `priority` of `twitter_handle` (see `t2m.scheduler`)."
+        with self.connection:
+            self._ensure_account(twitter_handle)
+            self.connection.execute(
+                "UPDATE accounts SET priority = ? WHERE twitter_handle = ?",
+                (None if priority == 1 else priority, twitter_handle))
+
+    def _ensure_account(self, twitter_handle):
+        self.connection.execute(
+            "INSERT OR IGNORE INTO accounts (twitter_handle) VALUES (?)",
+            (twitter_handle,))
+
+    def _ensure_mirror(self, twitter_handle, mirror):
+        self.connection.execute(
+            "INSERT OR IGNORE INTO mirrors VALUES (?, ?)",
+            (twitter_handle, mirror))
+
+    def _target_tables(self, twitter_handle, mirror):
+        """Return the key, its WHERE clause, and the forwarded tweets and
+        outbox tables of the `mirror` target of `twitter_handle` (see
+        `get_target`).
+
+        """
+        if mirror is None:
+            return ((twitter_handle,), "twitter_handle = ?", "forwarded",
+                    "outbox")
+        return ((twitter_handle, mirror), "twitter_handle = ? AND mirror = ?",
+                "mirror_forwarded", "mirror_outbox")
@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+"""Offline benchmarks of the hot paths of t2m.
+
+The Twitter and Mastodon clients are the fake ones of the test suite
+(see `test_t2m._all_mocked`), so that nothing is sent over the
+network, and the medias are read from the tests/data directory.
+
+Results are saved as json, so that they can be compared between
+commits:
+
+    python tests/bench_t2m.py --output before.json
+    git checkout <other commit>
+    python tests/bench_t2m.py --output after.json --compare before.json
+
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import gc
+import json
+import time
+import random
+import shutil
+import tempfile
+import argparse
+import platform
+import subprocess
+import os.path as osp
+
+HERE = osp.abspath(osp.dirname(__file__))
+sys.path[:0] = [osp.dirname(HERE), HERE]
+
+import t2m  # noqa
+
+from test_t2m import mock, _fake_tweet, _fake_twitter_client, _all_mocked  # noqa
+
+# scales of the benchmarks, close to the ones of a busy t2m instance
+TIMELINE_SIZE = 200
+DONE_SIZE = 10 ** 5
+CW_PATTERNS = 300
+ACCOUNTS = 500
+TOOTS = 50
+
+
+def _timeline(size=TIMELINE_SIZE, first_id=DONE_SIZE):
+    "Return `size` fake tweets, with urls, medias and retweets."
+    timeline = []
+    for tweet_id in range(first_id + size, first_id, -1):
+        kwargs = {
+            'id': tweet_id,
+            'full_text': (u'Tweet %s about t2m &amp; friends, see '
+                          u'https://t.co/%08d https://t.co/self%s'
+                          % (tweet_id, tweet_id, tweet_id)),
+            'urls': [mock.Mock(url='https://t.co/%08d' % tweet_id,
+                               expanded_url='https://example.com/%s'
+                               % tweet_id)],
+        }
+        if tweet_id % 5 == 0:
+            kwargs['media'] = [mock.Mock(media_url='https://pbs.example/%s'
+                                         % tweet_id)]
+        if tweet_id % 7 == 0:
+            kwargs['retweeted_status'] = mock.Mock(
+                id=tweet_id * 10, full_text=u'Retweeted %s' % tweet_id,
+                urls=(), media=(), user=mock.Mock(screen_name='someone'))
+        timeline.append(_fake_tweet(**kwargs))
+    return timeline
+
+
+def _timeline_json(size=TIMELINE_SIZE, first_id=DONE_SIZE):
+    "Return the JSON of a `size`-tweet timeline, as Twitter sends it."
+    user = {'id': 1, 'screen_name': 'tw1', 'name': 'Tw 1',
+            'description': u'A t2m user ' * 10, 'followers_count': 42,
+            'created_at': 'Mon Nov 29 21:18:15 +0000 2010'}
+    timeline = []
+    for tweet_id in range(first_id + size, first_id, -1):
+        tweet = {
+            'id': tweet_id, 'id_str': str(tweet_id), 'user': user,
+            'created_at': 'Mon Nov 29 21:18:15 +0000 2010', 'lang': 'en',
+            'full_text': u'Tweet %s https://t.co/%08d' % (tweet_id, tweet_id),
+            'entities': {'hashtags': [], 'user_mentions': [], 'urls': [{
+                'url': 'https://t.co/%08d' % tweet_id,
+                'expanded_url': 'https://example.com/%s' % tweet_id,
+                'indices': [10, 33]}]},
+            'favorite_count': 3, 'retweet_count': 2, 'source': 'web',
+        }
+        if tweet_id % 7 == 0:
+            tweet['retweeted_status'] = dict(tweet, id=tweet_id * 10)
+        timeline.append(tweet)
+    return json.dumps(timeline)
+
+
+def _write_cw(patterns=CW_PATTERNS):
+    """Write a cw.json file with `patterns` rules, one group out of ten,
+    half of them with an inline flag.
+
+    """
+    rules = {}
+    for num in range(patterns):
+        flags = '(?i)' if num % 2 else ''
+        if num % 10 == 0:
+            pattern = flags + r'\bspoiler%s\b: (\w+)' % num
+        else:
+            pattern = flags + r'\b(word%s|other%s)\b' % (num, num)
+        rules.setdefault('cw%s' % (num % 30), []).append(pattern)
+    with open('cw.json', 'w') as fobj:
+        json.dump(rules, fobj)
+
+
+def bench_collect_toots():
+    "Build the toots of a 200-tweet timeline, given 10^5 done tweets."
+    timeline = _timeline()
+    done = set(range(DONE_SIZE)) | set(range(DONE_SIZE, DONE_SIZE + 200, 3))
+    client = _fake_twitter_client({})
+
+    def run():
+        t2m._collect_toots(client, 'tw1', done=done, retweets=True,
+                           strip_trailing_url=True, timeline=timeline)
+    return run, {'timeline': TIMELINE_SIZE, 'done': len(done)}
+
+
+def bench_parse_timeline():
+    "Parse the JSON of a 200-tweet timeline into statuses."
+    data = _timeline_json()
+
+    def run():
+        [t2m.statuses.Status.from_json(x) for x in json.loads(data)]
+    return run, {'timeline': TIMELINE_SIZE}
+
+
+def bench_content_warning():
+    "Look for content warnings in 200 toots, with hundreds of cw patterns."
+    _write_cw()
+    texts = [u'Toot %s with some words, other%s and spoiler%s: end'
+             % (num, num * 7, num * 3) for num in range(TIMELINE_SIZE)]
+
+    def run():
+        for text in texts:
+            t2m._find_potential_content_warning(text)
+    return run, {'toots': len(texts), 'patterns': CW_PATTERNS}
+
+
+def bench_send_toot():
+    "Send toots with and without medias, the medias being cached."
+    data_url = 'file://%s/' % osp.join(HERE, 'data')
+    toots = [{'text': u'Toot %s' % num, 'content_warning': None, 'id': num,
+              'medias': [data_url + 'media1.txt', data_url + 'media2.txt']
+              if num % 2 else []} for num in range(TOOTS)]
+
+    def run():
+        with _all_mocked():
+            mastodon = t2m._get_mastodon_client('a1@mamot.fr')
+            for toot in toots:
+                t2m._send_toot(mastodon, toot)
+    return run, {'toots': len(toots)}
+
+
+def _database(accounts=ACCOUNTS):
+    "Return a database of `accounts` accounts, one of them with 10^5 ids."
+    db = dict(('tw%s' % num, {
+        'mastodon': 'a%s@mamot.fr' % num,
+        'done': set(random.sample(range(10 ** 9), 200)),
+        'since_id': 10 ** 9,
+    }) for num in range(accounts))
+    db['tw0']['done'] = set(range(DONE_SIZE))
+    return db
+
+
+def bench_save_db_json():
+    "Save a database of many accounts to db.json."
+    db = _database()
+
+    def run():
+        t2m._save_db(db, path='db.json')
+    return run, {'accounts': ACCOUNTS, 'done': DONE_SIZE}
+
+
+def bench_save_db_sqlite():
+    "Save a database of many accounts to db.sqlite, again and again."
+    db = _database()
+
+    def run():
+        t2m._save_db(db, path='db.sqlite')
+    return run, {'accounts': ACCOUNTS, 'done': DONE_SIZE}
+
+
+def bench_mark_done():
+    "Record forwarded tweets in the journal of db.json, one at a time."
+    db = _database(10)
+    t2m._save_db(db, path='db.json')
+    tweet_ids = iter(range(2 * 10 ** 9, 3 * 10 ** 9))
+
+    def run():
+        for _ in range(TOOTS):
+            t2m._mark_done(db, 'tw1', next(tweet_ids), path='db.json')
+    return run, {'toots': TOOTS}
+
+
+BENCHMARKS = [
+    ('collect_toots', bench_collect_toots),
+    ('parse_timeline', bench_parse_timeline),
+    ('content_warning', bench_content_warning),
+    ('send_toot', bench_send_toot),
+    ('save_db_json', bench_save_db_json),
+    ('save_db_sqlite', bench_save_db_sqlite),
+    ('mark_done', bench_mark_done),
+]
+
+
+def _measure(run, repeat):
+    "Return the durations (in seconds) of `repeat` calls of `run`."
+    run()  # warm up caches (compiled regexes, clients, media cache...)
+    durations = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.time()
+        run()
+        durations.append(time.time() - start)
+    return durations
+
+
+def _commit():
+    "Return the current git commit of the repository, if any."
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=HERE,
+            stderr=open(os.devnull, 'w')).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(names=None, repeat=5):
+    """Run the benchmarks called `names` (all of them by default) in a
+    temporary directory, and return their results.
+
+    """
+    results = {
+        'commit': _commit(),
+        'python': platform.python_version(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'benchmarks': {},
+    }
+
+    olddir = os.getcwd()
+    for name, bench in BENCHMARKS:
+        if names and name not in names:
+            continue
+
+        tmpdir = tempfile.mkdtemp()
+        for fname in os.listdir(osp.join(HERE, 'data')):
+            shutil.copy(osp.join(HERE, 'data', fname), tmpdir)
+        os.chdir(tmpdir)
+        t2m.ratelimit._rate_limiters.clear()
+        t2m._clients.clear()
+        t2m._rendered_toots.clear()
+        try:
+            run, scale = bench()
+            durations = sorted(_measure(run, repeat))
+        finally:
+            os.chdir(olddir)
+            shutil.rmtree(tmpdir)
+
+        results['benchmarks'][name] = {
+            'description': bench.__doc__,
+            'scale': scale,
+            'min': durations[0],
+            'median': durations[len(durations) // 2],
+            'runs': durations,
+        }
+        print('%-16s min %9.2f ms  median %9.2f ms'
+              % (name, durations[0] * 1000,
+                 durations[len(durations) // 2] * 1000))
+    return results
+
+
+def compare(results, previous):
+    "Print the change of the median durations from `previous` results."
+    print('\nCompared to %s:' % (previous.get('commit') or 'previous run'))
+    for name, result in sorted(results['benchmarks'].items()):
+        if name not in previous['benchmarks']:
+            continue
+        before = previous['benchmarks'][name]['median']
+        print('%-16s %+8.1f%%'
+              % (name, (result['median'] - before) / before * 100))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('names', nargs='*', metavar='benchmark',
+                        help='benchmarks to run (all by default): %s'
+                        % ', '.join(name for name, _ in BENCHMARKS))
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    parser.add_argument('-o', '--output', help='json file of the results')
+    parser.add_argument('-c', '--compare',
+                        help='json file of previous results')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.names, args.repeat)
+    if args.output:
+        with open(args.output, 'w') as fobj:
+            json.dump(results, fobj, indent=4, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as fobj:
+            compare(results, json.load(fobj))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,9 +3,15 @@
 from __future__ import print_function
 
 import os
+import sys
+import json
+import time
 import os.path as osp
+import threading
+import subprocess
 import tempfile
 import shutil
+import fcntl
 import unittest
 from contextlib import contextmanager
 
@@ -15,10 +21,21 @@ try:
 except ImportError:
     import mock
 
+import yaml
+import mastodon
 import twitter  # flake8: noqa
 
+try:
+    import asyncio
+    import aiohttp
+except (ImportError, SyntaxError):
+    aiohttp = None
+
 import t2m
 
+from t2m.scheduler import Scheduler
+from t2m.shards import HashRing
+
 
 HERE = osp.abspath(osp.dirname(__file__))
 
@@ -45,9 +62,23 @@ def _fake_twitter_client(configuration=None):
     return fake_client
 
 
-def _media_post(fpath):
-    with open(fpath) as fobj:
-        return {'id': fobj.read()}
+def _media_post(media_file, mime_type=None, file_name=None):
+    return {'id': media_file.read().decode('utf-8')}
+
+
+@contextmanager
+def _sleep_mocked(side_effect=None):
+    "Mock time.sleep in the calling thread only (thread pools sleep too)."
+    real_sleep, thread = time.sleep, threading.current_thread()
+    sleep = mock.Mock(side_effect=side_effect)
+
+    def fake_sleep(seconds):
+        if threading.current_thread() is thread:
+            return sleep(seconds)
+        real_sleep(seconds)
+
+    with mock.patch('time.sleep', side_effect=fake_sleep):
+        yield sleep
 
 
 @contextmanager
@@ -74,6 +105,10 @@ class Twitter2MastodonTC(unittest.TestCase):
         os.chdir(self._tmpdir)
         self.new_db()
         self.data_url = 'file://%s/' % osp.join(HERE, 'data')
+        t2m.ratelimit._rate_limiters.clear()
+        t2m._clients.clear()
+        t2m._rendered_toots.clear()
+        t2m.metrics.reset()
 
     def tearDown(self):
         shutil.rmtree(self._tmpdir)
@@ -103,6 +138,243 @@ class Twitter2MastodonTC(unittest.TestCase):
         self.assertEqual(set(range(10)), set(db['tw1']['done']))
         self.assertEqual(set(range(10)), set(db['tw2']['done']))
 
+    def test_all_workers(self):
+        with _all_mocked() as (status_post, media_post):
+            t2m.all(wait_seconds=0, workers=2)
+        self.assertEqual(18, status_post.call_count)
+        db = self.read_db()
+        self.assertEqual(set(range(10)), db['tw1']['done'])
+        self.assertEqual(set(range(10)), db['tw2']['done'])
+
+    def test_all_failing_account(self):
+        "An account which fails is skipped, the other ones go on"
+        def timeline(screen_name, count, since_id=None):
+            if screen_name == 'tw1':
+                raise twitter.TwitterError('Sorry, that page does not exist.')
+            return [_fake_tweet(id=id) for id in range(10)]
+
+        for workers in (1, 2):
+            self.new_db()
+            with _all_mocked() as (status_post, media_post):
+                t2m._get_twitter_client().GetUserTimeline.side_effect = \
+                    timeline
+                t2m.all(wait_seconds=0, workers=workers)
+            self.assertEqual(10, status_post.call_count)
+            db = self.read_db()
+            self.assertEqual({1, 4}, db['tw1']['done'])
+            self.assertEqual(set(range(10)), db['tw2']['done'])
+
+    def test_all_fair_share(self):
+        "The toots of the accounts are interleaved, by priority"
+        self.new_db({
+            'tw1': {'mastodon': 'a1@mamot.fr', 'done': list(range(6))},
+            'tw2': {'mastodon': 'a2@mamot.fr'},
+        })
+        t2m.priority('tw2', 2)
+        with _all_mocked() as (status_post, media_post):
+            with mock.patch('t2m._send_to_target',
+                            wraps=t2m._send_to_target) as send:
+                t2m.all(wait_seconds=0)
+        self.assertEqual(['tw2', 'tw1', 'tw2'] * 4 + ['tw2', 'tw2'],
+                         [args[1] for args, kwargs in send.call_args_list])
+        self.assertEqual(2, self.read_db()['tw2']['priority'])
+
+    def test_scheduler(self):
+        "Accounts wait their interval between their own items only"
+        scheduler = Scheduler()
+        scheduler.add('slow', range(3), interval=0.2)
+        scheduler.add('fast', range(3))
+        taken = []
+        while True:
+            item = scheduler.take()
+            if item is None:
+                break
+            taken.append(item)
+            scheduler.release(item[0])
+        self.assertEqual([('slow', 0), ('fast', 0), ('fast', 1),
+                          ('fast', 2), ('slow', 1), ('slow', 2)], taken)
+
+    def test_shards(self):
+        "Accounts are spread evenly, and mostly stay when shards are added"
+        handles = ['account%s' % num for num in range(1000)]
+        ring, bigger_ring = HashRing(4), HashRing(5)
+        for shard in range(4):
+            self.assertTrue(
+                150 < sum(ring.shard(h) == shard for h in handles) < 350)
+        self.assertLess(
+            sum(ring.shard(h) != bigger_ring.shard(h) for h in handles), 300)
+        self.assertEqual(ring.shard('Account1'), ring.shard('account1'))
+
+        leases = [t2m.shards.claim('.', 2) for _ in range(3)]
+        self.assertEqual([0, 1], [lease.shard for lease in leases[:2]])
+        self.assertIsNone(leases[2])
+        leases[0].release()
+        self.assertEqual(0, t2m.shards.claim('.', 2).shard)
+
+    def test_all_sharded(self):
+        "Each process forwards, and saves, the accounts of its shard"
+        other = t2m.shards.Lease('.', 0, 2)  # tw1 is in shard 0
+        self.assertTrue(other.acquire())
+
+        def forward_all(db, twitter_handles, **kwargs):
+            # meanwhile, the other process forwards tw1
+            other_db = t2m.storage.JsonStorage('db.json').load()
+            t2m.storage.JsonStorage('db.json').mark_done(other_db, 'tw1', 5)
+            return real_forward_all(db, twitter_handles, **kwargs)
+        real_forward_all = t2m._forward_all
+
+        with _all_mocked() as (status_post, media_post), \
+                mock.patch('t2m._forward_all', side_effect=forward_all):
+            t2m.all(wait_seconds=0, total_shards=2)
+        self.assertEqual(10, status_post.call_count)
+        db = self.read_db()
+        self.assertEqual({1, 4, 5}, db['tw1']['done'])
+        self.assertEqual(set(range(10)), db['tw2']['done'])
+
+        # nothing to do while all the shards are held
+        with open('t2m-shard-2-of-2.lock', 'a') as fobj:
+            fcntl.flock(fobj, fcntl.LOCK_EX)
+            with _all_mocked() as (status_post, media_post):
+                t2m.all(wait_seconds=0, total_shards=2)
+        self.assertEqual(0, status_post.call_count)
+        other.release()
+
+    def test_one_along_sharded_all(self):
+        "one can run along a sharded all, each one saving its accounts"
+        other = t2m.shards.Lease('.', 0, 2)  # tw1 is in shard 0
+        self.assertTrue(other.acquire())
+
+        def forward_all(db, twitter_handles, **kwargs):
+            # meanwhile, another process forwards tw1 with one, and saves
+            # while tw2 is being forwarded
+            def forward(*args, **kwargs_one):
+                real_forward_all(db, twitter_handles, **kwargs)
+                return real_forward(*args, **kwargs_one)
+
+            with mock.patch.dict(t2m.storage._storages, clear=True), \
+                    mock.patch('t2m._forward', side_effect=forward):
+                t2m.one('tw1')
+            # the progress of tw2 is not lost if all crashes now
+            self.assertEqual(set(range(10)), self.read_db()['tw2']['done'])
+        real_forward_all, real_forward = t2m._forward_all, t2m._forward
+
+        with _all_mocked() as (status_post, media_post), \
+                mock.patch('t2m._forward_all', side_effect=forward_all):
+            t2m.all(wait_seconds=0, total_shards=2)
+        other.release()
+        self.assertEqual(8 + 10, status_post.call_count)
+        db = self.read_db()
+        self.assertEqual(set(range(10)), db['tw1']['done'])
+        self.assertEqual(9, db['tw1']['since_id'])
+        self.assertEqual(set(range(10)), db['tw2']['done'])
+
+    def test_all_batch_list(self):
+        "Timelines are fetched from a Twitter list, in a few requests"
+        self.new_db({
+            'tw1': {'mastodon': 'a1@mamot.fr', 'since_id': 300},
+            'TW2': {'mastodon': 'a2@mamot.fr', 'since_id': 100},
+            'tw3': {'mastodon': 'a1@mamot.fr'},  # never fetched yet
+            'tw4': {},
+        })
+        members = []
+
+        def list_timeline(list_id, count, return_json, since_id=None,
+                          max_id=None):
+            self.assertEqual((7, 100, True), (list_id, since_id, return_json))
+            return [{'id': id, 'full_text': 'Tweet %s' % id,
+                     'user': {'screen_name': 'tw%s' % (id % 2 + 1)}}
+                    for id in range(1000, 0, -1)
+                    if since_id < id <= (max_id or id)][:count]
+
+        with _all_mocked([_fake_tweet(id=id) for id in range(3)]) as \
+                (status_post, media_post):
+            client = t2m._get_twitter_client()
+            client.configure_mock(**{
+                'GetLists.return_value': [],
+                'CreateList.return_value.id': 7,
+                'CreateListsMember.side_effect':
+                    lambda list_id, screen_name: members.extend(screen_name),
+                'GetListMembers.side_effect': lambda list_id: [
+                    mock.Mock(screen_name=name) for name in members],
+                'GetListTimeline.side_effect': list_timeline,
+            })
+            t2m.all(wait_seconds=0, batch_list='t2m')
+        client.CreateList.assert_called_once_with(
+            't2m', mode='private', description=mock.ANY)
+        self.assertEqual(['tw1', 'TW2', 'tw3'], members)
+        # the list gives the last 800 statuses only, from 201: the ones
+        # of TW2 since 100 are fetched on their own, as the new account
+        self.assertEqual(4, client.GetListTimeline.call_count)
+        self.assertEqual(
+            [mock.call(screen_name='TW2', count=200, since_id=100),
+             mock.call(screen_name='tw3', count=200)],
+            sorted(client.GetUserTimeline.call_args_list,
+                   key=lambda call: call[1]['screen_name']))
+        self.assertEqual(350 + 3 + 3, status_post.call_count)
+        texts = set(args[0] for args, kwargs in status_post.call_args_list)
+        self.assertIn('Tweet 302', texts)
+        self.assertNotIn('Tweet 300', texts)
+        self.assertNotIn('Tweet 999', texts)
+        db = self.read_db()
+        self.assertEqual(1000, db['tw1']['since_id'])
+        self.assertEqual(2, db['tw3']['since_id'])
+        self.assertEqual(100, db['TW2']['since_id'])
+
+    def test_all_batch_list_quiet(self):
+        "Accounts without new statuses in the list do not hold it back"
+        self.new_db({
+            'tw1': {'mastodon': 'a1@mamot.fr', 'since_id': 100},
+            'tw2': {'mastodon': 'a2@mamot.fr', 'since_id': 50},
+        })
+        since_ids = []
+
+        def list_timeline(list_id, count, return_json, since_id=None,
+                          max_id=None):
+            since_ids.append(since_id)
+            return [{'id': id, 'full_text': 'Tweet %s' % id,
+                     'user': {'screen_name': 'tw1'}}
+                    for id in range(120, 100, -1)
+                    if since_id < id <= (max_id or id)][:count]
+
+        with _all_mocked() as (status_post, media_post):
+            client = t2m._get_twitter_client()
+            client.configure_mock(**{
+                'GetLists.return_value': [mock.Mock(id=7)],
+                'GetListMembers.return_value': [
+                    mock.Mock(screen_name='tw1'),
+                    mock.Mock(screen_name='tw2')],
+                'GetListTimeline.side_effect': list_timeline,
+            })
+            client.GetLists.return_value[0].name = 't2m'
+            t2m.all(wait_seconds=0, batch_list='t2m')
+            self.assertEqual([50, 50], since_ids)
+            self.assertEqual(120, self.read_db()['tw2']['since_id'])
+            del since_ids[:]
+            t2m.all(wait_seconds=0, batch_list='t2m')
+        self.assertEqual([120], since_ids)
+        self.assertEqual(20, status_post.call_count)
+        self.assertEqual(0, client.GetUserTimeline.call_count)
+
+    def test_one_saves_its_account(self):
+        "one only saves its account, the other ones may be forwarded"
+        def forward(db, twitter_handle, *args, **kwargs):
+            # meanwhile, another process forwards tw1
+            other = t2m.storage.JsonStorage('db.json')
+            other_db = other.load()
+            other_db['tw1']['backfill'] = [[10, 20]]
+            other.save(other_db)
+            other.mark_done(other_db, 'tw1', 12)
+            return real_forward(db, twitter_handle, *args, **kwargs)
+        real_forward = t2m._forward
+
+        with _all_mocked() as (status_post, media_post), \
+                mock.patch('t2m._forward', side_effect=forward):
+            t2m.one('tw2')
+        db = self.read_db()
+        self.assertEqual({1, 4, 12}, db['tw1']['done'])
+        self.assertEqual([[10, 20]], db['tw1']['backfill'])
+        self.assertEqual(set(range(10)), db['tw2']['done'])
+
     def test_one_mark_1(self):
         "Marking tweets as seen adds them to the db"
         with _all_mocked() as (status_post, media_post):
@@ -163,6 +435,33 @@ class Twitter2MastodonTC(unittest.TestCase):
             (u'I quote this:\n\n« quoted full »\n\n— Retweet '
              u'https://twitter.com/quoted_user/status/quoted',), args)
 
+    def test_shared_retweet(self):
+        retweeted = mock.Mock(
+            id='retweeted', full_text='retweeted text', urls=(), media=(),
+            user=mock.Mock(screen_name='retweeted_user'))
+        client = _fake_twitter_client({})
+        with mock.patch('t2m._find_potential_content_warning',
+                        wraps=t2m._find_potential_content_warning) as find:
+            toots = [
+                t2m._collect_toots(
+                    client, handle, retweets=True,
+                    timeline=[_fake_tweet(id=tweet_id,
+                                          retweeted_status=retweeted)])
+                for handle, tweet_id in (('tw1', 1), ('tw2', 2))]
+            # rendered once, for the first account:
+            self.assertEqual(1, find.call_count)
+        self.assertEqual([1], [toot['id'] for toot in toots[0]])
+        self.assertEqual([2], [toot['id'] for toot in toots[1]])
+        self.assertEqual(toots[0][0]['text'], toots[1][0]['text'])
+
+        # rendered again once the content warnings change:
+        with open('cw.json', 'w') as fobj:
+            fobj.write('{"cw": ["retweeted"]}')
+        toots = t2m._collect_toots(
+            client, 'tw3', retweets=True,
+            timeline=[_fake_tweet(id=3, retweeted_status=retweeted)])
+        self.assertEqual('cw', toots[0]['content_warning'])
+
     def test_private_tweet(self):
         tweet = _fake_tweet(full_text='@private_response')
         with _all_mocked([tweet]) as (status_post, media_post):
@@ -202,6 +501,759 @@ class Twitter2MastodonTC(unittest.TestCase):
                     ' and an extra at the end, to be stripped:')
         self.assertEqual((expected,), args)
 
+    def test_since_id(self):
+        "Only tweets newer than the stored watermark are fetched"
+        client = _fake_twitter_client()
+        with _all_mocked() as (status_post, media_post):
+            with mock.patch('twitter.Api', return_value=client):
+                t2m.one('tw1', wait_seconds=0)
+                self.assertEqual(9, self.read_db()['tw1']['since_id'])
+                t2m.one('tw1', wait_seconds=0)
+        first_call, second_call = client.GetUserTimeline.call_args_list
+        self.assertNotIn('since_id', first_call[1])
+        self.assertEqual(9, second_call[1]['since_id'])
+
+    def test_since_id_number(self):
+        "The watermark stays below tweets left out by the number option"
+        tweets = [_fake_tweet(id=id) for id in reversed(range(10))]
+
+        def user_timeline(screen_name, count, since_id=None):
+            return [tweet for tweet in tweets
+                    if since_id is None or tweet.id > since_id][:count]
+
+        with _all_mocked() as (status_post, media_post):
+            t2m._get_twitter_client().GetUserTimeline.side_effect = \
+                user_timeline
+            t2m.one('tw1', number=2)
+            self.assertEqual(2, status_post.call_count)
+            # the next run fetches the tweets left out again
+            t2m.one('tw1')
+        self.assertEqual(8, status_post.call_count)
+        self.assertEqual(set(range(10)), self.read_db()['tw1']['done'])
+
+    def test_outbox(self):
+        "Toots which could not be sent are sent again later, in order"
+        # most recent first, as returned by Twitter
+        tweets = [_fake_tweet(id=id) for id in range(9, -1, -1)]
+        tweets[4] = _fake_tweet(id=5, media=[
+            mock.Mock(media_url=self.data_url + 'media1.txt')])
+
+        def status_post(text, **kwargs):
+            if text == 'Tweet 5 textual content':
+                return {'error': 'oops'}
+            return {}
+        with _all_mocked(tweets) as (_status_post, media_post):
+            _status_post.side_effect = status_post
+            t2m.one('tw2')
+        # the tweets after the failed one are deferred
+        self.assertEqual(6, _status_post.call_count)
+        db = self.read_db()
+        self.assertEqual(set(range(10)), db['tw2']['done'])
+        self.assertEqual([5, 6, 7, 8, 9], sorted(db['tw2']['outbox']))
+        entry = db['tw2']['outbox'][5]
+        self.assertEqual(1, entry['attempts'])
+        self.assertEqual({self.data_url + 'media1.txt': 'media1 content\n'},
+                         entry['media_ids'])
+        self.assertEqual(0, db['tw2']['outbox'][9]['attempts'])
+
+        # nothing is due yet
+        with _all_mocked(tweets) as (_status_post, media_post):
+            t2m.one('tw2')
+        self.assertEqual(0, _status_post.call_count)
+
+        now = time.time()
+        with _all_mocked(tweets) as (_status_post, media_post):
+            with mock.patch('time.time', return_value=now + 86400):
+                t2m.one('tw2')
+        self.assertEqual(
+            [('Tweet %s textual content' % i,) for i in range(5, 10)],
+            [args for args, kwargs in _status_post.call_args_list])
+        self.assertEqual(0, media_post.call_count)
+        self.assertEqual(['media1 content\n'],
+                         _status_post.call_args_list[0][1]['media_ids'])
+        self.assertNotIn('outbox', self.read_db()['tw2'])
+
+    def test_backfill(self):
+        "Tweets missed during an outage are forwarded, oldest first"
+        self.new_db({'tw2': {'mastodon': 'a2@mamot.fr', 'since_id': 10,
+                             'done': [10]}})
+
+        def timeline(screen_name, count, since_id=None, max_id=None):
+            return [_fake_tweet(id=id) for id in range(300, 0, -1)
+                    if id > (since_id or 0) and id <= (max_id or id)][:count]
+
+        def texts(status_post):
+            return [int(args[0].split()[1])
+                    for args, kwargs in status_post.call_args_list]
+
+        with _all_mocked() as (status_post, media_post):
+            t2m._get_twitter_client().GetUserTimeline.side_effect = timeline
+            t2m.one('tw2')
+        self.assertEqual(list(range(101, 301)), texts(status_post))
+        self.assertEqual([[10, 101]], self.read_db()['tw2']['backfill'])
+
+        def status_post(text, **kwargs):
+            if text == 'Tweet 50 textual content':
+                raise KeyboardInterrupt()
+            return {}
+        with _all_mocked() as (_status_post, media_post):
+            t2m._get_twitter_client().GetUserTimeline.side_effect = timeline
+            _status_post.side_effect = status_post
+            with self.assertRaises(KeyboardInterrupt):
+                t2m.backfill('tw2', wait_seconds=0)
+        # recorded along with each toot
+        self.assertEqual([[49, 101]], self.read_db()['tw2']['backfill'])
+
+        # resumed
+        with _all_mocked() as (status_post, media_post):
+            t2m._get_twitter_client().GetUserTimeline.side_effect = timeline
+            t2m.backfill('tw2', wait_seconds=0)
+        self.assertEqual(list(range(50, 101)), texts(status_post))
+        db = self.read_db()
+        self.assertNotIn('backfill', db['tw2'])
+        self.assertEqual(300, db['tw2']['since_id'])
+
+    def test_backfill_pruned(self):
+        "Tweets forgotten once forwarded are not backfilled again"
+        self.new_db({'tw2': {'mastodon': 'a2@mamot.fr', 'since_id': 300,
+                             'done': list(range(1, 301))}})
+
+        def timeline(screen_name, count, since_id=None, max_id=None):
+            return [_fake_tweet(id=id) for id in range(300, 0, -1)
+                    if id > (since_id or 0) and id <= (max_id or id)][:count]
+
+        with _all_mocked() as (status_post, media_post):
+            t2m._get_twitter_client().GetUserTimeline.side_effect = timeline
+            t2m.one('tw2')
+            self.assertEqual(set(range(101, 301)),
+                             self.read_db()['tw2']['done'])
+            t2m.backfill('tw2', since_id=50, wait_seconds=0)
+        self.assertEqual(0, status_post.call_count)
+        self.assertNotIn('backfill', self.read_db()['tw2'])
+
+    def test_backfill_debug(self):
+        "A debug backfill does not change the database"
+        self.new_db({'tw2': {'mastodon': 'a2@mamot.fr', 'since_id': 10}})
+        with open('db.json') as fobj:
+            saved = fobj.read()
+
+        with _all_mocked() as (status_post, media_post):
+            t2m._get_twitter_client().GetUserTimeline.side_effect = \
+                lambda screen_name, count, since_id=None, max_id=None: [
+                    _fake_tweet(id=id) for id in range(9, since_id, -1)
+                    if id <= (max_id or id)]
+            t2m.backfill('tw2', since_id=5, debug=True)
+        self.assertEqual(0, status_post.call_count)
+        with open('db.json') as fobj:
+            self.assertEqual(saved, fobj.read())
+        self.assertFalse(osp.exists('db.json.journal'))
+
+    def test_outbox_backoff(self):
+        "Attempts are spread over exponentially growing delays"
+        with mock.patch('random.uniform', side_effect=lambda a, b: b):
+            delays = [t2m._outbox_delay(attempts) for attempts in range(1, 12)]
+        self.assertEqual([60, 120, 240, 480, 960, 1920, 3840, 7680, 15360,
+                          21600, 21600], delays)
+        tweet = {'id': 1, 'text': 'text', 'content_warning': None,
+                 'medias': []}
+        db = {'tw2': {}}
+        t2m._defer_toot(db, 'tw2', tweet, attempts=t2m.OUTBOX_MAX_ATTEMPTS)
+        self.assertNotIn('outbox', db['tw2'])
+
+    def test_streaming(self):
+        "Toots are sent as soon as they are rendered"
+        events = []
+        find_content_warning = t2m._find_potential_content_warning
+
+        def render(text):
+            events.append('render')
+            return find_content_warning(text)
+
+        def send(text, **kwargs):
+            events.append('send')
+            return {}
+
+        with _all_mocked([_fake_tweet(id=id) for id in range(3)]) as (
+                status_post, media_post):
+            status_post.side_effect = send
+            with mock.patch('t2m._find_potential_content_warning',
+                            side_effect=render):
+                t2m.one('tw2')
+        self.assertEqual(['render', 'send'] * 3, events)
+
+    def test_done_encoding(self):
+        "Forwarded ids are stored sorted and delta-encoded"
+        self.new_db({'tw1': {'mastodon': 'a1@mamot.fr', 'done': [7, 2, 3]}})
+        with open('db.json') as fobj:
+            self.assertEqual({'deltas': [2, 1, 4]},
+                             json.load(fobj)['tw1']['done'])
+        self.assertEqual({2, 3, 7}, self.read_db()['tw1']['done'])
+
+    def test_done_pruning(self):
+        "Only the ids of the last 200 forwarded tweets are remembered"
+        self.new_db({'tw1': {'mastodon': 'a1@mamot.fr',
+                             'done': list(range(-300, 0))}})
+        with _all_mocked() as (status_post, media_post):
+            t2m.one('tw1', wait_seconds=0)
+        self.assertEqual(10, status_post.call_count)
+        self.assertEqual(set(range(-190, 10)), self.read_db()['tw1']['done'])
+
+    def test_journal(self):
+        "Forwarded ids are journaled, then compacted by a full save"
+        db = self.read_db()
+        t2m._mark_done(db, 'tw2', 12)
+        t2m._mark_done(db, 'tw2', 13)
+        with open('db.json.journal', 'a') as fobj:
+            fobj.write('["tw2", 1')  # torn record
+        self.assertEqual({12, 13}, self.read_db()['tw2']['done'])
+        # records appended after the torn one are not lost
+        t2m._mark_done(db, 'tw2', 14)
+        self.assertEqual({12, 13, 14}, self.read_db()['tw2']['done'])
+        t2m._save_db(db)
+        self.assertFalse(osp.exists('db.json.journal'))
+        self.assertEqual({12, 13, 14}, self.read_db()['tw2']['done'])
+
+    def test_journal_compaction(self):
+        with mock.patch('t2m.storage.JOURNAL_COMPACTION_SIZE', 20):
+            db = self.read_db()
+            t2m._mark_done(db, 'tw2', 12)
+            self.assertTrue(osp.exists('db.json.journal'))
+            t2m._mark_done(db, 'tw2', 13)
+            self.assertFalse(osp.exists('db.json.journal'))
+        self.assertEqual({12, 13}, self.read_db()['tw2']['done'])
+
+    def test_sqlite(self):
+        "Once migrated, the SQLite database is used by all commands"
+        t2m.migrate()
+        self.assertFalse(osp.exists('db.json'))
+        self.assertEqual({1, 4}, t2m._get_db()['tw1']['done'])
+
+        def forward_all(db, twitter_handles, **kwargs):
+            # changed by other t2m commands while all runs
+            t2m.priority('tw2', 3)
+            t2m.storage.SqliteStorage('db.sqlite').set_mastodon(
+                'tw1', 'other@mamot.fr')
+            return real_forward_all(db, twitter_handles, **kwargs)
+        real_forward_all = t2m._forward_all
+
+        with _all_mocked() as (status_post, media_post), \
+                mock.patch('t2m._forward_all', side_effect=forward_all):
+            t2m.all(wait_seconds=0)
+        self.assertEqual(18, status_post.call_count)
+        db = t2m._get_db()
+        self.assertEqual('a2@mamot.fr', db['tw2']['mastodon'])
+        self.assertEqual(set(range(10)), db['tw1']['done'])
+        self.assertEqual(set(range(10)), db['tw2']['done'])
+        self.assertEqual(9, db['tw2']['since_id'])
+        self.assertEqual(3, db['tw2']['priority'])
+        self.assertEqual('other@mamot.fr', db['tw1']['mastodon'])
+
+    def test_outbox_storage(self):
+        "Outbox changes are journaled, and stored by both backends"
+        entry = {'toot': {'id': 12, 'text': 'text', 'content_warning': None,
+                          'medias': []},
+                 'media_ids': {}, 'attempts': 1, 'next_retry': 0,
+                 'created': 0}
+        db = self.read_db()
+        t2m._update_outbox(db, 'tw2', 12, entry)
+        t2m._update_outbox(db, 'tw2', 13, dict(entry, attempts=2))
+        t2m._update_outbox(db, 'tw2', 13, None)
+        self.assertEqual({12: entry}, self.read_db()['tw2']['outbox'])
+        t2m._save_db(db)
+        self.assertEqual({12: entry}, self.read_db()['tw2']['outbox'])
+
+        t2m.migrate()
+        self.assertEqual({12: entry}, t2m._get_db()['tw2']['outbox'])
+        db = t2m._get_db()
+        t2m._update_outbox(db, 'tw2', 12, None)
+        self.assertNotIn('outbox', t2m._get_db()['tw2'])
+
+    def test_mirrors(self):
+        "Tweets are fetched and rendered once, and sent to all the mirrors"
+        from t2m import media
+        t2m.get_storage().add_mirror('tw2', 'a1@mamot.fr')
+        tweets = [_fake_tweet(id=id) for id in range(3)] + [_fake_tweet(
+            id=3, media=[mock.Mock(media_url=self.data_url + 'media1.txt')])]
+        with _all_mocked(tweets) as (status_post, media_post):
+            t2m.one('tw2')
+            twitter_client = t2m._get_twitter_client()
+        self.assertEqual(1, twitter_client.GetUserTimeline.call_count)
+        self.assertEqual(8, status_post.call_count)
+        self.assertEqual(2, media_post.call_count)
+        self.assertEqual(1, media.get_cache().misses)
+        db = self.read_db()
+        self.assertEqual(set(range(4)), db['tw2']['done'])
+        self.assertEqual(set(range(4)),
+                         db['tw2']['mirrors']['a1@mamot.fr']['done'])
+
+        t2m.migrate()
+        db = t2m._get_db()
+        self.assertEqual(set(range(4)),
+                         db['tw2']['mirrors']['a1@mamot.fr']['done'])
+        t2m._mark_done(db, 'tw2', 4, mirror='a1@mamot.fr')
+        self.assertEqual(set(range(5)), t2m._get_db()[
+            'tw2']['mirrors']['a1@mamot.fr']['done'])
+        self.assertEqual(set(range(4)), t2m._get_db()['tw2']['done'])
+
+    def test_sqlite_shared(self):
+        "Saving a SQLite database does not drop rows written by others"
+        storage = t2m.storage.SqliteStorage('db.sqlite')
+        db = storage.load()
+        t2m.storage.SqliteStorage('db.sqlite').mark_done({}, 'tw1', 12)
+        db.setdefault('tw1', {})['done'] = {11}
+        storage.save(db)
+        self.assertEqual({11, 12}, storage.load()['tw1']['done'])
+
+    def write_cw(self, rules):
+        with open('cw.json', 'w') as fobj:
+            fobj.write(rules)
+
+    def test_content_warning(self):
+        self.write_cw('{"coffee": ["coffee", "caffeine"],'
+                      ' "cw-prefix": ["^CW (.*)\\n"]}')
+        find = t2m._find_potential_content_warning
+        self.assertEqual((None, 'Tweet'), find('Tweet'))
+        self.assertEqual(('coffee', 'Some caffeine'), find('Some caffeine'))
+        self.assertEqual(('food', 'Some tea'), find('CW food\nSome tea'))
+        # rules are tried in order, whatever the position of the match
+        self.assertEqual(('coffee', 'CW food\nSome coffee'),
+                         find('CW food\nSome coffee'))
+
+    def test_content_warning_reload(self):
+        "Rules are compiled once, and reloaded when cw.json changes"
+        self.write_cw('{"coffee": ["coffee"]}')
+        find = t2m._find_potential_content_warning
+        self.assertEqual('coffee', find('Some coffee')[0])
+        with mock.patch('t2m._ContentWarningMatcher') as matcher:
+            find('Some coffee')
+        self.assertEqual(0, matcher.call_count)
+        self.write_cw('{"caffeine": ["coffee"], "tea": ["tea"]}')
+        self.assertEqual('caffeine', find('Some coffee')[0])
+
+    def test_content_warning_back_reference(self):
+        "Patterns can use back references"
+        self.write_cw('{"double": ["(a)\\\\1"], "coffee": ["coffee"]}')
+        find = t2m._find_potential_content_warning
+        self.assertEqual(('a', ' and coffee'), find('aa and coffee'))
+        self.assertEqual(('coffee', 'a and coffee'), find('a and coffee'))
+
+    def test_rate_limiter(self):
+        now, sleeps = [1000.], []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+        limiter = t2m.ratelimit.RateLimiter(clock=lambda: now[0], sleep=sleep)
+        limiter.acquire()
+        limiter.acquire()
+        self.assertEqual([], sleeps)  # nothing known yet
+        limiter.update(2, 1010)
+        limiter.acquire()
+        limiter.acquire()
+        self.assertEqual([5], sleeps)  # 2 requests spread over 10 seconds
+        limiter.update(0, 1020)
+        limiter.acquire()
+        self.assertEqual([5, 15], sleeps)  # wait for the reset
+
+    def test_rate_limit_hit(self):
+        "Toots hitting the rate limit are sent again once it is reset"
+        sleeps = []
+        with _all_mocked([_fake_tweet()]) as (status_post, media_post):
+            status_post.side_effect = [mastodon.MastodonRatelimitError(), {}]
+            with _sleep_mocked(side_effect=sleeps.append):
+                t2m.one('tw2')
+        self.assertEqual(2, status_post.call_count)
+        self.assertEqual(1, len(sleeps))
+        self.assertAlmostEqual(60, sleeps[0], delta=1)
+        self.assertEqual({1}, self.read_db()['tw2']['done'])
+
+    def test_rate_limit_reset(self):
+        "Toots hitting the rate limit wait for the reset time it gives"
+        sleeps = []
+        with _all_mocked([_fake_tweet()]) as (status_post, media_post):
+            status_post.side_effect = [mastodon.MastodonRatelimitError(), {}]
+            client = t2m._get_mastodon_client('a2@mamot.fr')
+            client.ratelimit_reset = time.time() + 5
+            with _sleep_mocked(side_effect=sleeps.append):
+                t2m.one('tw2')
+        self.assertEqual(2, status_post.call_count)
+        self.assertEqual(1, len(sleeps))
+        self.assertAlmostEqual(5, sleeps[0], delta=1)
+
+    def test_rate_limit_media(self):
+        "Media uploads have their own rate limit, apart from status posts"
+        tweet = _fake_tweet(
+            media=[mock.Mock(media_url=self.data_url + 'media1.txt')])
+        sleeps = []
+        with _all_mocked([tweet]) as (status_post, media_post):
+            client = t2m._get_mastodon_client('a2@mamot.fr')
+
+            def upload(*args, **kwargs):
+                # the last upload allowed for 30 minutes
+                client.ratelimit_remaining = 0
+                client.ratelimit_reset = time.time() + 1800
+                return _media_post(*args, **kwargs)
+            media_post.side_effect = upload
+            with _sleep_mocked(side_effect=sleeps.append):
+                t2m.one('tw2')
+        self.assertEqual(1, status_post.call_count)
+        self.assertEqual([], sleeps)
+        limiter = t2m.ratelimit.get_rate_limiter(client.api_base_url,
+                                                 'media')
+        self.assertAlmostEqual(1800, limiter.reserve(), delta=1)
+
+    def test_medias_order(self):
+        "Medias are transferred concurrently, but attached in order"
+        medias = ['media%s.txt' % (i % 2 + 1) for i in range(6)]
+        tweet = _fake_tweet(media=[mock.Mock(media_url=self.data_url + m)
+                                   for m in medias])
+        with _all_mocked([tweet]) as (status_post, media_post):
+            t2m.one('tw2')
+        self.assertEqual(6, media_post.call_count)
+        self.assertEqual({('text/plain', 'media1.txt'),
+                          ('text/plain', 'media2.txt')},
+                         set((kwargs['mime_type'], kwargs['file_name'])
+                             for args, kwargs in media_post.call_args_list))
+        args, kwargs = status_post.call_args
+        self.assertEqual(['%s content\n' % m[:-4] for m in medias],
+                         kwargs['media_ids'])
+
+    def test_media_cache(self):
+        "Medias forwarded several times are downloaded once"
+        tweet = _fake_tweet(
+            id=2, media=[mock.Mock(media_url=self.data_url + 'media1.txt')])
+        with _all_mocked([tweet]) as (status_post, media_post):
+            with mock.patch('t2m.media.urlopen',
+                            side_effect=t2m.media.urlopen) as urlopen:
+                t2m.all()
+        self.assertEqual(1, urlopen.call_count)
+        self.assertEqual(2, media_post.call_count)
+        cache = t2m.media.get_cache()
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+    def test_media_cache_eviction(self):
+        cache = t2m.media.MediaCache('cache', max_size=20)
+        cache.put('http://a', b'0123456789', 'text/plain', 'a')
+        cache.put('http://b', b'0123456789', 'text/plain', 'b')  # same
+        os.utime(osp.join('cache', 'objects', os.listdir(
+            osp.join('cache', 'objects'))[0]), (0, 0))
+        cache.put('http://c', b'abcdefghijk', 'text/plain', 'c')
+        self.assertIsNone(cache.get('http://a'))
+        self.assertEqual((b'abcdefghijk', 'text/plain', 'c'),
+                         cache.get('http://c'))
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+        # the URLs of the evicted content are removed too
+        self.assertEqual([cache._url_path('http://c')],
+                         [osp.join('cache', 'urls', name)
+                          for name in os.listdir(osp.join('cache', 'urls'))])
+
+        # and the ones of a content removed otherwise once looked up
+        for name in os.listdir(osp.join('cache', 'objects')):
+            os.remove(osp.join('cache', 'objects', name))
+        self.assertIsNone(cache.get('http://c'))
+        self.assertEqual([], os.listdir(osp.join('cache', 'urls')))
+
+        # a content evicted while it is opened is still read
+        cache.put('http://d', b'0123', 'text/plain', 'd')
+        with mock.patch('os.utime', side_effect=OSError):
+            self.assertEqual((b'0123', 'text/plain', 'd'),
+                             cache.get('http://d'))
+
+    def test_video(self):
+        "Videos are forwarded in the best quality the instance accepts"
+        with open('high.mp4', 'wb') as fobj:
+            fobj.write(b'high quality')
+        with open('low.mp4', 'wb') as fobj:
+            fobj.write(b'low quality')
+        video_url = 'file://%s/' % self._tmpdir
+        tweet = _fake_tweet(media=[mock.Mock(
+            type='video', media_url=self.data_url + 'media1.txt',
+            video_info={'duration_millis': 200000, 'variants': [
+                {'content_type': 'application/x-mpegURL',
+                 'url': video_url + 'video.m3u8'},
+                {'content_type': 'video/mp4', 'bitrate': 832000,
+                 'url': video_url + 'low.mp4'},
+                {'content_type': 'video/mp4', 'bitrate': 2176000,
+                 'url': video_url + 'high.mp4'},  # above 40 MB
+            ]})])
+        processing = [True, False]
+
+        def api_request(method, endpoint, files=None):
+            if method == 'POST':
+                self.assertEqual('/api/v2/media', endpoint)
+                self.assertEqual('video/mp4', files['file'][2])
+                self.assertEqual(b'low quality', files['file'][1].read())
+                return {'id': 'video', 'url': None}
+            self.assertEqual('/api/v1/media/video', endpoint)
+            return {'id': 'video',
+                    'url': None if processing.pop(0) else 'https://video'}
+
+        with _all_mocked([tweet]) as (status_post, media_post):
+            with mock.patch('mastodon.Mastodon._Mastodon__api_request',
+                            side_effect=api_request), _sleep_mocked():
+                t2m.one('tw2')
+        self.assertEqual(0, media_post.call_count)
+        self.assertEqual(['video'], status_post.call_args[1]['media_ids'])
+
+    def test_video_processing(self):
+        "Toots wait in the outbox while the instance processes their videos"
+        with open('video.mp4', 'wb') as fobj:
+            fobj.write(b'video')
+        video_url = 'file://%s/video.mp4' % self._tmpdir
+        tweet = _fake_tweet(media=[mock.Mock(
+            type='animated_gif', media_url=self.data_url + 'media1.txt',
+            video_info={'variants': [{'content_type': 'video/mp4',
+                                      'bitrate': 0, 'url': video_url}]})])
+        processed = []
+
+        def api_request(method, endpoint, files=None):
+            return {'id': 'video',
+                    'url': 'https://video' if processed else None}
+
+        with _all_mocked([tweet]) as (status_post, media_post):
+            with mock.patch('mastodon.Mastodon._Mastodon__api_request',
+                            side_effect=api_request) as api, \
+                    mock.patch('t2m.MEDIA_PROCESSING_WAIT', 0):
+                t2m.one('tw2')
+                self.assertEqual(0, status_post.call_count)
+                outbox = self.read_db()['tw2']['outbox']
+                self.assertEqual({video_url: 'video'}, outbox[1]['media_ids'])
+
+                # not uploaded again once processed
+                processed.append(True)
+                api.reset_mock()
+                with mock.patch('time.time', return_value=time.time() + 3600):
+                    t2m.one('tw2')
+        self.assertEqual([mock.call('GET', '/api/v1/media/video')],
+                         api.call_args_list)
+        self.assertEqual(['video'], status_post.call_args[1]['media_ids'])
+        self.assertNotIn('outbox', self.read_db()['tw2'])
+
+    def test_compact_statuses(self):
+        "Timelines are parsed straight from their JSON into compact statuses"
+        def tweet(id, **kwargs):
+            return dict(id=id, full_text='Tweet %s https://t.co/a' % id,
+                        user={'screen_name': 'tw1', 'followers_count': 3},
+                        entities={'urls': [{'url': 'https://t.co/a',
+                                            'expanded_url': 'https://a'}]},
+                        **kwargs)
+
+        video = {'media_url': 'https://pbs/1', 'type': 'video',
+                 'video_info': {'variants': [{'content_type': 'video/mp4',
+                                              'bitrate': 0,
+                                              'url': 'https://video'}]}}
+        data = [tweet(3, retweeted_status=tweet(30)),
+                tweet(2, extended_entities={'media': [video]}),
+                tweet(1)]
+        client = twitter.api.Api('key', 'secret', 'token', 'secret',
+                                 tweet_mode='extended')
+        response = mock.Mock(content=json.dumps(data).encode('utf-8'))
+        with mock.patch.object(client, '_RequestUrl',
+                               return_value=response) as request:
+            timeline = t2m._fetch_timeline(client, 'tw1', since_id=0)
+        self.assertEqual({'screen_name': 'tw1', 'count': 200, 'since_id': 0,
+                          'include_rts': True, 'trim_user': False,
+                          'exclude_replies': False},
+                         request.call_args[1]['data'])
+        self.assertEqual([3, 2, 1], [status.id for status in timeline])
+        self.assertFalse(hasattr(timeline[0], '__dict__'))
+        self.assertEqual('tw1', timeline[0].retweeted_status.user.screen_name)
+
+        toots = t2m._collect_toots(client, 'tw1', retweets=True,
+                                   timeline=timeline)
+        self.assertEqual([(1, 'Tweet 1 https://a', []),
+                          (2, 'Tweet 2 https://a', ['https://video'])],
+                         [(toot['id'], toot['text'], toot['medias'])
+                          for toot in toots[:2]])
+        self.assertIn('https://twitter.com/tw1/status/30', toots[2]['text'])
+
+    def test_shared_clients(self):
+        "Clients are built once, and share the connections to a host"
+        with _all_mocked() as (status_post, media_post):
+            with mock.patch('yaml.safe_load',
+                            side_effect=yaml.safe_load) as load:
+                t2m.all()
+                t2m.one('tw1')
+        self.assertEqual(1, load.call_count)
+        self.assertIs(t2m._get_mastodon_client('a1@mamot.fr'),
+                      t2m._get_mastodon_client('a1@mamot.fr'))
+        self.assertIs(t2m._get_mastodon_client('a1@mamot.fr').session,
+                      t2m._get_mastodon_client('a2@mamot.fr').session)
+
+    def test_daemon(self):
+        "The daemon forwards all accounts, until interrupted"
+        with _all_mocked() as (status_post, media_post):
+            with _sleep_mocked(side_effect=KeyboardInterrupt) as sleep:
+                t2m.daemon()
+        self.assertEqual(1, sleep.call_count)
+        self.assertAlmostEqual(60, sleep.call_args[0][0], delta=1)
+        self.assertEqual(18, status_post.call_count)
+        db = self.read_db()
+        self.assertEqual(set(range(10)), db['tw1']['done'])
+        self.assertEqual(set(range(10)), db['tw2']['done'])
+
+    def test_daemon_add(self):
+        "Accounts added or changed while the daemon runs are picked up"
+        real_sleep, sleeps = time.sleep, []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            if len(sleeps) == 1:
+                t2m.add('tw3', 'a1@mamot.fr')
+                t2m.add('tw2', 'a1@mamot.fr')
+            elif len(sleeps) > 3:
+                raise KeyboardInterrupt()
+            real_sleep(seconds)
+
+        with _all_mocked() as (status_post, media_post):
+            with _sleep_mocked(side_effect=sleep):
+                t2m.daemon(min_interval=0.05)
+        db = self.read_db()
+        self.assertEqual('a1@mamot.fr', db['tw2']['mastodon'])
+        self.assertEqual('a1@mamot.fr', db['tw3']['mastodon'])
+        self.assertEqual(set(range(10)), db['tw3']['done'])
+
+    def test_poll_interval(self):
+        "Active accounts are polled more often than dormant ones"
+        self.assertEqual(120, t2m._next_poll_interval(240, 3))
+        self.assertEqual(60, t2m._next_poll_interval(60, 1))
+        self.assertEqual(480, t2m._next_poll_interval(240, 0))
+        self.assertEqual(4 * 3600, t2m._next_poll_interval(4 * 3600, 0))
+
+    def test_metrics(self):
+        "The time spent in each stage is recorded per account and instance"
+        tweets = [_fake_tweet(id=id) for id in range(3)] + [_fake_tweet(
+            id=3, media=[mock.Mock(media_url=self.data_url + 'media1.txt')])]
+        with _all_mocked(tweets):
+            t2m.one('tw2', wait_seconds=0.001, prometheus_file='t2m.prom')
+
+        summary = t2m.metrics.summary()
+        for stage in ('fetch', 'content_warning', 'download', 'upload',
+                      'status_post', 'sleep', 'rate_limit_wait', 'save'):
+            self.assertIn(stage, summary)
+        self.assertIn('tw2', summary)
+
+        with open('t2m.prom') as fobj:
+            lines = fobj.read().splitlines()
+        self.assertIn('t2m_forwarded_total{account="tw2",instance="mamot.fr"}'
+                      ' 4', lines)
+        self.assertIn('t2m_stage_seconds_count{account="tw2",'
+                      'instance="mamot.fr",stage="status_post"} 4', lines)
+        self.assertIn('t2m_stage_seconds_count{account="tw2",'
+                      'instance="mamot.fr",stage="sleep"} 3', lines)
+        self.assertIn('t2m_stage_seconds_bucket{account="tw2",'
+                      'instance="mamot.fr",le="+Inf",stage="upload"} 1',
+                      lines)
+
+    @unittest.skipIf(aiohttp is None, 'aiohttp is not available')
+    def test_asyncio_engine(self):
+        tweets = [_fake_tweet(id=id) for id in range(3)] + [_fake_tweet(
+            id=3, media=[mock.Mock(media_url=self.data_url + 'media1.txt')])]
+        posts = []
+
+        def fetch_timeline(self, twitter_handle, since_id=None):
+            future = asyncio.Future()
+            future.set_result(tweets)
+            return future
+
+        def mastodon_request(self, mastodon_handle, path, payload):
+            posts.append((mastodon_handle, path, payload()))
+            future = asyncio.Future()
+            future.set_result({'id': len(posts)})
+            return future
+
+        with _all_mocked():
+            with mock.patch('t2m.aio.AsyncForwarder.fetch_timeline',
+                            fetch_timeline):
+                with mock.patch('t2m.aio.AsyncForwarder.mastodon_request',
+                                mastodon_request):
+                    t2m.all(engine='asyncio', workers=10)
+
+        statuses = [(handle, payload['json']['status'])
+                    for handle, path, payload in posts
+                    if path == '/api/v1/statuses']
+        self.assertEqual(
+            sorted([('a1@mamot.fr', 'Tweet %s textual content' % i)
+                    for i in (0, 2, 3)] +
+                   [('a2@mamot.fr', 'Tweet %s textual content' % i)
+                    for i in range(4)]),
+            sorted(statuses))
+        self.assertEqual(2, len([path for handle, path, payload in posts
+                                 if path == '/api/v1/media']))
+        db = self.read_db()
+        self.assertEqual(set(range(4)) | {4}, db['tw1']['done'])
+        self.assertEqual(set(range(4)), db['tw2']['done'])
+
+    @unittest.skipIf(aiohttp is None, 'aiohttp is not available')
+    def test_asyncio_video_older_instance(self):
+        "Videos are uploaded synchronously to instances without /api/v2"
+        with open('video.mp4', 'wb') as fobj:
+            fobj.write(b'video')
+        tweets = [_fake_tweet(id=0, media=[mock.Mock(
+            type='animated_gif', media_url=self.data_url + 'media1.txt',
+            video_info={'variants': [{
+                'content_type': 'video/mp4', 'bitrate': 0,
+                'url': 'file://%s/video.mp4' % self._tmpdir}]})])]
+        posts = []
+
+        def fetch_timeline(self, twitter_handle, since_id=None):
+            future = asyncio.Future()
+            future.set_result(tweets)
+            return future
+
+        def mastodon_request(self, mastodon_handle, path, payload,
+                             method='POST'):
+            posts.append((mastodon_handle, path))
+            future = asyncio.Future()
+            if path in ('/api/v2/media', '/api/v1/media/video'):
+                future.set_exception(t2m.aio.NotFound({'error': 'Not Found'}))
+            else:
+                future.set_result({'id': 'video', 'url': None})
+            return future
+
+        self.new_db({'tw1': {'mastodon': 'a1@mamot.fr', 'since_id': -1}})
+        with _all_mocked():
+            with mock.patch('t2m.aio.AsyncForwarder.fetch_timeline',
+                            fetch_timeline):
+                with mock.patch('t2m.aio.AsyncForwarder.mastodon_request',
+                                mastodon_request):
+                    t2m.all(engine='asyncio')
+                    self.assertEqual(
+                        ['/api/v2/media', '/api/v1/media',
+                         '/api/v1/media/video', '/api/v1/statuses'],
+                        [path for handle, path in posts])
+                    # uploaded by an earlier attempt
+                    del posts[:]
+                    forwarder = t2m.aio.AsyncForwarder(None, {
+                        'consumer_key': 'key', 'consumer_secret': 'secret',
+                        'access_token_key': 'token',
+                        'access_token_secret': 'secret'})
+                    loop = asyncio.new_event_loop()
+                    try:
+                        loop.run_until_complete(forwarder.wait_processed(
+                            'a1@mamot.fr', 'video'))
+                    finally:
+                        loop.close()
+        self.assertEqual([('a1@mamot.fr', '/api/v1/media/video')], posts)
+        self.assertEqual({0}, self.read_db()['tw1']['done'])
+
+    @unittest.skipIf(sys.version_info < (3, 7), '-X importtime needs 3.7')
+    def test_import_time(self):
+        "t2m list does not import the dependencies it does not need"
+        env = dict(os.environ, PYTHONPATH=osp.dirname(HERE))
+        output = subprocess.check_output(
+            [sys.executable, '-X', 'importtime', '-c',
+             'import sys, t2m; sys.argv = ["t2m", "list"]; t2m.main()'],
+            stderr=subprocess.STDOUT, env=env).decode('utf-8')
+        self.assertIn(' * tw1', output)
+        imported = set(line.rsplit('|', 1)[1].strip()
+                       for line in output.splitlines()
+                       if line.startswith('import time:'))
+        self.assertIn('t2m', imported)
+        for module in ('twitter', 'mastodon', 'yaml', 'requests', 'sqlite3',
+                       'aiohttp', 'dateutil'):
+            self.assertNotIn(module, imported)
+
 
 if __name__ == "__main__":
     unittest.main()